@@ -24,6 +24,11 @@ az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-nam
 az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name "podcast" --enable-partitioning true
 az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name "presentation" --enable-partitioning true
 
+# Create the queues of the batch output requests
+az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name "blog-batch" --enable-partitioning true
+az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name "podcast-batch" --enable-partitioning true
+az servicebus queue create --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name "presentation-batch" --enable-partitioning true
+
 # Get the connection string for the Service Bus namespace
 SERVICEBUS_CONNECTION_STRING=$(az servicebus namespace authorization-rule keys list --resource-group $RESOURCE_GROUP_NAME --namespace-name $SERVICEBUS_NAMESPACE_NAME --name RootManageSharedAccessKey --query primaryConnectionString --output tsv)
 
@@ -0,0 +1,277 @@
+from dotenv import load_dotenv
+from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from langchain_openai import AzureChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.documents.base import Document
+from langchain.chains.combine_documents import create_stuff_documents_chain
+import datetime
+import json
+import os
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+
+
+load_dotenv(override=True)
+
+servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
+cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
+output_status_endpoint = os.getenv("OUTPUT_STATUS_ENDPOINT")
+
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# The messages are settled once the outputs are saved, their locks are renewed
+# until then for at most DOCUMENT_MAX_LOCK_RENEWAL_SECONDS.
+document_max_lock_renewal_seconds = int(
+    os.getenv("DOCUMENT_MAX_LOCK_RENEWAL_SECONDS", "3600"))
+blog_max_words = int(os.getenv("BLOG_MAX_WORDS", "1200"))
+presentation_max_slides = int(os.getenv("PRESENTATION_MAX_SLIDES", "12"))
+
+# Documents written from the outline and the context fanned out by the
+# podcast generator: queue of each priority class, from the highest to the
+# lowest priority, maximum number of documents written at the same time,
+# role of the model and instructions on the format of the document.
+document_types = {
+    "blog": {
+        "queues": {"interactive": "blog", "batch": "blog-batch"},
+        "max_concurrent_jobs": int(
+            os.getenv("BLOG_MAX_CONCURRENT_JOBS", "4")),
+        "system": "You are a technical writer. Use the following pieces of "
+                  "retrieved context to write the blog post.",
+        "request": "Write a blog post on the following subject: {subject}.",
+        "format": f"Write at most {blog_max_words} words in Markdown. Start "
+                  "with the title of the blog post as a level 1 heading and "
+                  "use a level 2 heading for each part of the outline."
+    },
+    "presentation": {
+        "queues": {"interactive": "presentation",
+                   "batch": "presentation-batch"},
+        "max_concurrent_jobs": int(
+            os.getenv("PRESENTATION_MAX_CONCURRENT_JOBS", "4")),
+        "system": "You are a presentation designer. Use the following pieces "
+                  "of retrieved context to write the slides.",
+        "request": "Write the slides of a presentation on the following "
+                   "subject: {subject}.",
+        "format": f"Write at most {presentation_max_slides} slides in "
+                  "Markdown, separated by a line with \"---\". The first "
+                  "slide has the title of the presentation as a level 1 "
+                  "heading, the other slides have a level 2 heading and at "
+                  "most 5 short bullet points. End each slide with a "
+                  "\"Notes:\" line giving what the speaker says."
+    }
+}
+# Document types served by the worker, so that they can be scaled separately
+document_generator_types = os.getenv(
+    "DOCUMENT_GENERATOR_TYPES", ",".join(document_types)).split(",")
+
+openai_clients = {}
+
+
+def get_azure_chat_openai() -> AzureChatOpenAI:
+    """Get the chat model of the process, created on first use"""
+    if "chat" not in openai_clients:
+        openai_clients["chat"] = AzureChatOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT'],
+            temperature=0,
+            top_p=1
+        )
+    return openai_clients["chat"]
+
+
+class Output:
+    id: str
+    type: str
+    created_at: str
+    last_updated: str
+    url: str
+    subject_id: str
+    title: str
+    outline: str
+    content: str
+    request_id: str
+    fingerprint: str
+    completed: bool
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "created_at": self.created_at,
+            "last_updated": self.last_updated,
+            "url": self.url,
+            "subject_id": self.subject_id,
+            "title": self.title,
+            "outline": self.outline,
+            "content": self.content,
+            "request_id": self.request_id,
+            "fingerprint": self.fingerprint,
+            "completed": self.completed
+        }
+
+
+async def main():
+    async with ServiceBusClient.from_connection_string(
+            conn_str=servicebus_connection_string) as servicebus_client:
+        async with AutoLockRenewer(
+                max_lock_renewal_duration=document_max_lock_renewal_seconds
+        ) as lock_renewer:
+            await asyncio.gather(
+                *[receive_documents(servicebus_client, lock_renewer,
+                                    document_type)
+                  for document_type in document_generator_types])
+
+
+async def receive_documents(servicebus_client: ServiceBusClient,
+                            lock_renewer: AutoLockRenewer,
+                            document_type: str):
+    """Receive and write the documents of a type
+
+    Args:
+        servicebus_client (ServiceBusClient): Service Bus client
+        lock_renewer (AutoLockRenewer): Renewer of the locks of the messages
+        document_type (str): Type of document
+    """
+    settings = document_types[document_type]
+    receivers = [servicebus_client.get_queue_receiver(queue)
+                 for queue in settings["queues"].values()]
+    while (True):
+        # The interactive queue is drained before the batch one.
+        received_messages = []
+        for receiver in receivers:
+            received_messages = await receiver.receive_messages(
+                max_message_count=settings["max_concurrent_jobs"],
+                max_wait_time=1)
+            if received_messages:
+                break
+        if not received_messages:
+            await asyncio.sleep(5)
+            continue
+        for message in received_messages:
+            lock_renewer.register(receiver, message)
+        await asyncio.gather(
+            *[process_message(receiver, message, document_type)
+              for message in received_messages])
+
+
+async def process_message(receiver, message, document_type: str):
+    document_input = json.loads(str(message))
+    request_id = document_input['request_id']
+    try:
+        # The blocking calls run in threads, so that they do not hold the
+        # other documents written concurrently.
+        output = await asyncio.to_thread(
+            process_document, document_type, document_input)
+        await asyncio.to_thread(update_status, request_id, "Processed")
+        await asyncio.to_thread(save_to_cosmosdb, output)
+        await asyncio.to_thread(update_status, request_id, "Saved")
+    except Exception as e:
+        print(f"Failed to generate the {document_type} {request_id}: {e}")
+        await asyncio.to_thread(update_status, request_id, "Failed")
+        # The message is kept for inspection instead of being lost.
+        await receiver.dead_letter_message(
+            message, reason="JobFailed", error_description=str(e)[:4096])
+        return
+    # The message is only completed once the output is saved, so that it is
+    # received again if the worker stops before.
+    await receiver.complete_message(message)
+
+
+def process_document(document_type: str, document_input: dict) -> Output:
+    """Write a document of a subject
+
+    The message carries the outline and the context retrieved by the podcast
+    generator for all the outputs of the request, so the document is written
+    without retrieving the context or drafting the outline again.
+
+    Args:
+        document_type (str): Type of document
+        document_input (dict): Message with the subject, outline and context
+
+    Returns:
+        Document output
+    """
+    settings = document_types[document_type]
+    output = Output()
+    output.id = str(uuid.uuid4())
+    output.subject_id = document_input['subject_id']
+    output.type = document_type
+    output.created_at = datetime.datetime.now().isoformat()
+    output.last_updated = output.created_at
+    output.url = ''
+    output.outline = document_input['outline']
+    output.request_id = document_input['request_id']
+    output.fingerprint = document_input.get('fingerprint', '')
+    output.completed = False
+
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", settings["system"] + "\n\n{context}"),
+            ("human", "{input}"),
+        ]
+    )
+    document_chain = create_stuff_documents_chain(
+        get_azure_chat_openai(), prompt)
+    context = [Document(page_content=document['page_content'],
+                        metadata=document.get('metadata', {}))
+               for document in document_input['context']]
+
+    request = settings['request'].format(subject=document_input['subject'])
+    document_format = settings['format']
+    document_prompt = f"""{request}
+
+    Cover the same topics as the following reference outline document, in the same order:
+
+    {output.outline}
+
+    {document_format}
+    """
+    content = document_chain.invoke(
+        {"input": document_prompt, "context": context})
+    output.content = str(content).replace("```markdown", "").replace(
+        "```", "").strip()
+    output.title = output.content.split("\n", 1)[0].lstrip("# ").strip()
+    output.completed = True
+    print(output.content)
+    return output
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False))
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+def save_to_cosmosdb(output: Output):
+    container = get_cosmos_container("outputs")
+    container.upsert_item(body=output.to_dict())
+
+
+def update_status(request_id: str, status: str):
+    status = {"status": status}
+    requests.post(
+        f"{output_status_endpoint}/status/{request_id}", json=status)
+
+
+asyncio.run(main())
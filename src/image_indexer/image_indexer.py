@@ -1,13 +1,22 @@
 import os
+import httpx
+import threading
+import hashlib
+import importlib.util
+import io
 import json
+import math
+import time
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 from dotenv import load_dotenv
 from azure.servicebus.aio import ServiceBusClient
 from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient
-from openai import AzureOpenAI
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from openai import AsyncAzureOpenAI
 from langchain_core.documents.base import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
@@ -15,6 +24,8 @@ from langchain_community.vectorstores.azuresearch import AzureSearch
 import tiktoken
 import re
 import base64
+import sqlite3
+from PIL import Image, ImageOps
 
 load_dotenv(override=True)
 
@@ -25,6 +36,85 @@ blob_service_client = BlobServiceClient.from_connection_string(
     os.getenv("STORAGE_CONNECTION_STRING"))
 container_name = "uploads"
 
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# Preprocessing of the images before the vision calls: maximum resolution
+# used by the model, JPEG quality and tiling of very large images.
+image_max_long_side = int(os.getenv("IMAGE_MAX_LONG_SIDE", "2048"))
+image_max_short_side = int(os.getenv("IMAGE_MAX_SHORT_SIDE", "768"))
+image_jpeg_quality = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+image_tile_threshold = int(os.getenv("IMAGE_TILE_THRESHOLD", "4096"))
+image_tile_size = int(os.getenv("IMAGE_TILE_SIZE", "1536"))
+image_max_tiles = int(os.getenv("IMAGE_MAX_TILES", "16"))
+
+# Local cache of the descriptions, keyed by the perceptual hash of the image.
+# Images whose hashes differ by at most description_cache_max_distance bits
+# are considered the same.
+description_cache_path = os.getenv(
+    "DESCRIPTION_CACHE_PATH", os.path.join("cache", "descriptions.db"))
+description_cache_max_distance = int(
+    os.getenv("DESCRIPTION_CACHE_MAX_DISTANCE", "4"))
+# A cached description is only reused for an image whose aspect ratio differs
+# by at most description_cache_max_aspect_ratio_difference.
+description_cache_max_aspect_ratio_difference = float(
+    os.getenv("DESCRIPTION_CACHE_MAX_ASPECT_RATIO_DIFFERENCE", "0.05"))
+description_cache_max_entries = int(
+    os.getenv("DESCRIPTION_CACHE_MAX_ENTRIES", "10000"))
+description_cache = None
+
+# Maximum number of images received together and whose content is extracted
+# in a single call, and maximum time to wait for a batch to fill up.
+metadata_batch_size = int(os.getenv("METADATA_BATCH_SIZE", "1"))
+metadata_batch_max_wait_ms = int(os.getenv("METADATA_BATCH_MAX_WAIT_MS", "500"))
+# Maximum number of images processed at the same time, the messages are
+# received as long as this limit is not reached so that a batch can be filled
+# by several receive calls.
+image_max_concurrent_messages = int(
+    os.getenv("IMAGE_MAX_CONCURRENT_MESSAGES", "16"))
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+# Persistent cache of the chat completions sent with temperature 0, whose
+# responses are deterministic. Bypassing the cache sends every prompt to the
+# model again and refreshes the cached responses.
+llm_cache_path = os.getenv(
+    "LLM_CACHE_PATH", os.path.join("cache", "llm_responses.db"))
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+llm_cache_max_age_days = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30"))
+llm_cache_bypass = os.getenv("LLM_CACHE_BYPASS", "false").lower() == "true"
+
+# Prompt to generate the title and description.
+extract_content_prompt = """Get the content from the image and generate a title, short description (4 sentences) and full text for the content.
+       
+    Provide in following format:
+    [[Title goes here]]
+    $$Description goes here$$
+    ((Full text goes here))
+
+    """
+
 print(f"service_bus_connection_string: {servicebus_connection_string}")
 
 
@@ -41,6 +131,7 @@ class Input:
     topics: list
     entities: list
     content: str
+    summary: str
 
     def to_dict(self):
         return {
@@ -55,7 +146,8 @@ class Input:
             "thumbnail_url": self.thumbnail_url,
             "topics": self.topics,
             "entities": self.entities,
-            "content": self.content
+            "content": self.content,
+            "summary": self.summary
         }
 
 
@@ -65,27 +157,452 @@ async def main():
         async with servicebus_client:
             receiver = servicebus_client.get_queue_receiver('image')
             async with receiver:
-                received_messages = await receiver.receive_messages(
-                    max_message_count=1, max_wait_time=5)
-                for message in received_messages:
-                    image_input = json.loads(str(message))
-                    image_location = image_input['input']
-                    update_status(image_input['request_id'], "Indexing")
-                    input = await index_image(image_location)
-                    update_status(image_input['request_id'], "Indexed")
-                    save_to_cosmosdb(input)
-                    update_status(image_input['request_id'], "Saved")
-                    await receiver.complete_message(message)
-    asyncio.sleep(5)
-
-
-def save_to_cosmosdb(input: Input):
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database_name = "autopodcaster"
-    database = client.get_database_client(database_name)
-    container_name = "inputs"
-    container = database.get_container_client(container_name)
-    container.create_item(body=input.to_dict())
+                # The images are processed concurrently and share the
+                # batcher, so that the content of the images received by
+                # successive calls can be extracted in a single call.
+                metadata_batcher = MetadataBatcher(
+                    metadata_batch_size, metadata_batch_max_wait_ms,
+                    extract_content_batch)
+                tasks = set()
+                while (True):
+                    tasks = {task for task in tasks if not task.done()}
+                    if len(tasks) >= image_max_concurrent_messages:
+                        await asyncio.wait(
+                            tasks, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    received_messages = await receiver.receive_messages(
+                        max_message_count=(
+                            image_max_concurrent_messages - len(tasks)),
+                        max_wait_time=1 if tasks else 5)
+                    for message in received_messages:
+                        tasks.add(asyncio.create_task(process_message(
+                            receiver, message, metadata_batcher)))
+
+
+async def process_message(receiver, message, metadata_batcher):
+    image_input = json.loads(str(message))
+    request_id = image_input['request_id']
+    image_location = image_input['input']
+    try:
+        # The blocking calls run in threads, so that they do not hold the
+        # other images processed concurrently.
+        await asyncio.to_thread(update_status, request_id, "Indexing")
+        input = await index_image(image_location, metadata_batcher)
+        await asyncio.to_thread(update_status, request_id, "Indexed")
+        await save_to_cosmosdb(input)
+        await asyncio.to_thread(update_status, request_id, "Saved")
+    except Exception as e:
+        print(f"Failed to index the image {request_id}: {e}")
+        await receiver.abandon_message(message)
+        return
+    await receiver.complete_message(message)
+    print(f"LLM cache: {get_llm_response_cache().get_metrics()}")
+
+
+class MetadataBatcher:
+    """Gather metadata requests and send them as a single model call
+
+    The pending requests are sent when max_items requests are gathered or
+    max_wait_ms milliseconds after the first one, whichever comes first, so
+    the latency added to each request stays bounded.
+    """
+
+    def __init__(self, max_items: int, max_wait_ms: int, generate_batch):
+        self.max_items = max_items
+        self.max_wait_ms = max_wait_ms
+        self.generate_batch = generate_batch
+        self.pending = []
+        self.flush_task = None
+
+    async def submit(self, item):
+        """Submit a request and wait for its result
+
+        Args:
+            item: Content to generate the metadata for
+
+        Returns:
+            Result generated for the item by generate_batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return await future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_wait_ms / 1000)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch, self.pending = self.pending, []
+        if len(batch) > 0:
+            asyncio.create_task(self.send(batch))
+
+    async def send(self, batch):
+        try:
+            results = await self.generate_batch([item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so the inputs
+    # of the messages processed concurrently are written concurrently. At
+    # most cosmosdb_max_connections writes are in flight, the others wait
+    # for one of them to finish instead of waiting for a connection.
+    if "writes" not in cosmos_clients:
+        cosmos_clients["writes"] = asyncio.Semaphore(cosmosdb_max_connections)
+    async with cosmos_clients["writes"]:
+        container = get_cosmos_container("inputs")
+        await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+
+class LLMResponseCache:
+    """Persistent cache of the chat completion responses of temperature 0
+    prompts, keyed by the hash of the deployment, the messages and the
+    parameters of the request
+
+    The entries older than max_age_days are dropped and the least recently
+    used ones are evicted when the cache is larger than max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age_days: float,
+                 bypass: bool):
+        cache_folder = os.path.dirname(path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "status INTEGER, headers TEXT, body BLOB, size INTEGER, "
+            "created_at REAL, last_used REAL)")
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, request: httpx.Request):
+        """Get the cache key of a request
+
+        Args:
+            request (httpx.Request): Request sent to Azure OpenAI
+
+        Returns:
+            Cache key, or None if the response of the request is not
+            deterministic or not a chat completion
+        """
+        if request.method != "POST" or \
+                not request.url.path.endswith("/chat/completions"):
+            return None
+        body = json.loads(request.content)
+        if body.get("temperature") != 0 or body.get("stream"):
+            return None
+        key = json.dumps({"path": request.url.path, "body": body},
+                         sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Get a cached response
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Tuple with the status code, the headers and the body, or None
+        """
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body FROM responses WHERE key = ? "
+                "AND created_at >= ?",
+                (key, time.time() - self.max_age_seconds)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key))
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key: str, status: int, headers: dict, body: bytes):
+        """Store a response and evict the old and least recently used ones
+
+        Args:
+            key (str): Cache key
+            status (int): Status code
+            headers (dict): Headers
+            body (bytes): Body
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, json.dumps(headers), body, len(body), now, now))
+            self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (now - self.max_age_seconds,))
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, size in self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                    ).fetchall():
+                if total_size <= self.max_bytes:
+                    break
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (old_key,))
+                total_size -= size
+
+    def get_metrics(self):
+        """Get the hit rate metrics of the cache
+
+        Returns:
+            Dictionary with the number of hits and misses and the hit rate
+        """
+        requests_count = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests_count if requests_count else 0.0
+        }
+
+
+def build_cached_response(request: httpx.Request, status: int,
+                          headers: dict, body: bytes) -> httpx.Response:
+    """Build the response returned by the caching transports"""
+    return httpx.Response(status, headers=headers, content=body,
+                          request=request)
+
+
+def get_cacheable_headers(response: httpx.Response) -> dict:
+    """Get the headers of a response that still apply to its decoded body"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length",
+                                    "transfer-encoding")}
+
+
+class CachingTransport(httpx.BaseTransport):
+    """HTTP transport answering the deterministic chat completions from the
+    LLM response cache"""
+
+    def __init__(self, transport: httpx.BaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = self.transport.handle_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncCachingTransport(httpx.AsyncBaseTransport):
+    """Async HTTP transport answering the deterministic chat completions
+    from the LLM response cache"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    async def handle_async_request(
+            self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = await self.transport.handle_async_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Get the LLM response cache of the process, created on first use"""
+    if "llm_cache" not in openai_clients:
+        openai_clients["llm_cache"] = LLMResponseCache(
+            llm_cache_path, llm_cache_max_bytes, llm_cache_max_age_days,
+            llm_cache_bypass)
+    return openai_clients["llm_cache"]
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["http"] = httpx.Client(
+            timeout=options.pop("timeout"),
+            transport=CachingTransport(httpx.HTTPTransport(**options),
+                                       get_llm_response_cache()))
+    return openai_clients["http"]
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get the async HTTP client of the process, created on first use"""
+    if "async_http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["async_http"] = httpx.AsyncClient(
+            timeout=options.pop("timeout"),
+            transport=AsyncCachingTransport(
+                httpx.AsyncHTTPTransport(**options),
+                get_llm_response_cache()))
+    return openai_clients["async_http"]
+
+
+def get_async_azure_openai_client() -> AsyncAzureOpenAI:
+    """Get the async Azure OpenAI client of the process, created on first use"""
+    if "async_azure_openai" not in openai_clients:
+        openai_clients["async_azure_openai"] = AsyncAzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_async_http_client()
+        )
+    return openai_clients["async_azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+async def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_async_azure_openai_client()
+    return (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ])).choices[0].message.content.strip()
+
+
+async def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    while len(parts) > 1:
+        summaries = await asyncio.gather(
+            *[summarize_text(title, part) for part in parts])
+        parts = text_splitter.split_text('\n\n'.join(summaries))
+    return await summarize_text(title, parts[0])
 
 
 def update_status(request_id: str, status: str):
@@ -94,44 +611,229 @@ def update_status(request_id: str, status: str):
         f"{status_endpoint}/status/{request_id}", json=status)
 
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def compute_image_hash(image: Image.Image) -> int:
+    """Compute the perceptual (difference) hash of an image
 
+    The hash does not change when the image is re-saved, re-encoded or
+    resized, and only a few bits change for small edits.
 
-async def index_image(image_location: str) -> Input:
+    Args:
+        image (Image.Image): Image
 
-    blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=image_location)
-    download_file_path = get_file(image_location)
-    with open(download_file_path, "wb") as download_file:
-        download_file.write(blob_client.download_blob().readall())
+    Returns:
+        64 bits hash of the image
+    """
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            image_hash = (image_hash << 1) | (1 if left > right else 0)
+    return image_hash
 
-    base64_image = encode_image(download_file_path)
 
-    # We will generate a title and a description from the content.
-    # using OpenAI GPT-4.
+def get_description_cache():
+    """Get the connection to the local description cache, created on first use
+
+    Returns:
+        SQLite connection
+    """
+    global description_cache
+    if description_cache is None:
+        cache_folder = os.path.dirname(description_cache_path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        description_cache = sqlite3.connect(
+            description_cache_path, check_same_thread=False)
+        description_cache.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions (hash TEXT PRIMARY KEY, "
+            "title TEXT, description TEXT, full_text TEXT, last_used REAL, "
+            "aspect_ratio REAL)")
+        # The caches created before the aspect ratio was stored get the
+        # column, their entries are never matched and are evicted over time.
+        columns = [column[1] for column in description_cache.execute(
+            "PRAGMA table_info(descriptions)")]
+        if "aspect_ratio" not in columns:
+            description_cache.execute(
+                "ALTER TABLE descriptions ADD COLUMN aspect_ratio REAL")
+        description_cache.execute(
+            "CREATE INDEX IF NOT EXISTS descriptions_aspect_ratio ON "
+            "descriptions (aspect_ratio)")
+    return description_cache
 
-    # Create the prompt to generate the title and description.
-    prompt_template = """Get the content from the image and generate a title, short description (4 sentences) and full text for the content.
-       
-    Provide in following format:
-    [[Title goes here]]
-    $$Description goes here$$
-    ((Full text goes here))
 
+def is_low_detail_hash(image_hash: int) -> bool:
+    """Check if a perceptual hash is too close to the one of a blank image
+
+    A blank or nearly uniform image has almost no bit set, so all such
+    images would match each other.
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+
+    Returns:
+        True if the hash is within twice the maximum distance of the hash of
+        a blank image
     """
+    return bin(image_hash).count('1') <= 2 * description_cache_max_distance
 
-    print(f"azure openai key: {os.environ['AZURE_OPENAI_KEY']}")
 
-    # Create the gpt-4o model client
-    azure_openai_client = AzureOpenAI(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION']
-    )
+def find_cached_description(image_hash: int, aspect_ratio: float):
+    """Find the description of an image with the same or a close perceptual
+    hash and the same aspect ratio
+
+    The exact hash is looked up first, the cached hashes are only compared
+    when it is missing and then only with the images of the same aspect
+    ratio.
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+        aspect_ratio (float): Width of the image divided by its height
+
+    Returns:
+        Tuple with the title, the description and the full text, or None
+    """
+    if is_low_detail_hash(image_hash):
+        return None
+    cache = get_description_cache()
+    tolerance = 1 + description_cache_max_aspect_ratio_difference
+    min_aspect_ratio = aspect_ratio / tolerance
+    max_aspect_ratio = aspect_ratio * tolerance
+    best_match = cache.execute(
+        "SELECT hash, title, description, full_text FROM descriptions "
+        "WHERE hash = ? AND aspect_ratio BETWEEN ? AND ?",
+        (f"{image_hash:016x}", min_aspect_ratio, max_aspect_ratio)).fetchone()
+    best_distance = 0
+    if best_match is None and description_cache_max_distance > 0:
+        best_distance = description_cache_max_distance + 1
+        for cached_hash, title, description, full_text in cache.execute(
+                "SELECT hash, title, description, full_text FROM descriptions "
+                "WHERE aspect_ratio BETWEEN ? AND ?",
+                (min_aspect_ratio, max_aspect_ratio)):
+            distance = bin(int(cached_hash, 16) ^ image_hash).count('1')
+            if distance < best_distance:
+                best_match = (cached_hash, title, description, full_text)
+                best_distance = distance
+    if best_match is None:
+        return None
+    with cache:
+        cache.execute("UPDATE descriptions SET last_used = ? WHERE hash = ?",
+                      (time.time(), best_match[0]))
+    print(f"Description cache hit (distance {best_distance})")
+    return best_match[1:]
+
+
+def cache_description(image_hash: int, aspect_ratio: float, title: str,
+                      description: str, full_text: str):
+    """Store the description of an image, evicting the least recently used
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+        aspect_ratio (float): Width of the image divided by its height
+        title (str): Title
+        description (str): Description
+        full_text (str): Full text
+    """
+    if is_low_detail_hash(image_hash):
+        return
+    cache = get_description_cache()
+    with cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO descriptions (hash, title, description, "
+            "full_text, last_used, aspect_ratio) VALUES (?, ?, ?, ?, ?, ?)",
+            (f"{image_hash:016x}", title, description, full_text, time.time(),
+             aspect_ratio))
+        cache.execute(
+            "DELETE FROM descriptions WHERE hash NOT IN (SELECT hash FROM "
+            "descriptions ORDER BY last_used DESC LIMIT ?)",
+            (description_cache_max_entries,))
+
+
+def preprocess_image(image: Image.Image):
+    """Downscale and re-encode an image for the GPT-4o vision model
 
-    corrected_content = azure_openai_client.chat.completions.create(
+    The model does not use more than image_max_long_side pixels on the long
+    side and image_max_short_side pixels on the short side, larger images
+    only make the request bigger and slower. The image is encoded as JPEG,
+    or as PNG when it has transparency or when PNG is smaller (screenshots,
+    diagrams).
+
+    Args:
+        image (Image.Image): Image to preprocess
+
+    Returns:
+        Tuple with the data URL of the image and its size in bytes
+    """
+    width, height = image.size
+    scale = min(1,
+                image_max_long_side / max(width, height),
+                image_max_short_side / min(width, height))
+    if scale < 1:
+        image = image.resize(
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            Image.LANCZOS)
+
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        # CMYK (scanned or print JPEGs), YCbCr and the other modes cannot all
+        # be encoded as PNG.
+        image = image.convert('RGB')
+
+    png_buffer = io.BytesIO()
+    image.save(png_buffer, format='PNG', optimize=True)
+    encoded_image, mime_type = png_buffer.getvalue(), 'image/png'
+
+    if image.mode not in ('RGBA', 'LA'):
+        jpeg_buffer = io.BytesIO()
+        image.convert('RGB').save(
+            jpeg_buffer, format='JPEG', quality=image_jpeg_quality,
+            optimize=True)
+        if len(jpeg_buffer.getvalue()) < len(encoded_image):
+            encoded_image, mime_type = jpeg_buffer.getvalue(), 'image/jpeg'
+
+    base64_image = base64.b64encode(encoded_image).decode("utf-8")
+    return f"data:{mime_type};base64,{base64_image}", len(encoded_image)
+
+
+def get_tiles(image: Image.Image):
+    """Split a very large image (scanned poster...) in tiles
+
+    Args:
+        image (Image.Image): Image to split
+
+    Returns:
+        List of tiles in reading order, empty if the image is small enough
+        to be described as a whole
+    """
+    width, height = image.size
+    if max(width, height) <= image_tile_threshold:
+        return []
+    tile_size = image_tile_size
+    while math.ceil(width / tile_size) * math.ceil(height / tile_size) > \
+            image_max_tiles:
+        tile_size = int(tile_size * 1.25)
+    return [image.crop((left, top,
+                        min(left + tile_size, width),
+                        min(top + tile_size, height)))
+            for top in range(0, height, tile_size)
+            for left in range(0, width, tile_size)]
+
+
+async def extract_content(azure_openai_client: AsyncAzureOpenAI,
+                          image_url: str, prompt: str):
+    """Extract the title, description and full text of an image
+
+    Args:
+        azure_openai_client (AsyncAzureOpenAI): Azure OpenAI client
+        image_url (str): Data URL of the image
+        prompt (str): Prompt
+
+    Returns:
+        Tuple with the title, the description and the full text
+    """
+    corrected_content = (await azure_openai_client.chat.completions.create(
         model="gpt-4o",
         temperature=0,
         top_p=1,
@@ -140,18 +842,22 @@ async def index_image(image_location: str) -> Input:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
+                        "url": image_url
                     }
                 },
                 {
                     "type": "text",
-                    "text": prompt_template
+                    "text": prompt
                 }
             ]},
         ],
-    ).choices[0].message.content
+    )).choices[0].message.content
     print(f"Corrected content: {corrected_content}")
 
+    # No content is returned when the model refuses to answer.
+    if corrected_content is None:
+        return None, None, None
+
     # Remove the line breaks from the corrected content.
     corrected_content = corrected_content.replace('\n', ' ')
 
@@ -164,6 +870,183 @@ async def index_image(image_location: str) -> Input:
     title = title_match.group(1) if title_match else None
     description = description_match.group(1) if description_match else None
     full_text = full_text_match.group(1) if full_text_match else None
+    return title, description, full_text
+
+
+async def extract_content_batch(image_urls: list):
+    """Extract the title, description and full text of several images with
+    a single GPT-4o call using structured output
+
+    Args:
+        image_urls (list): Data URLs of the images
+
+    Returns:
+        List with a tuple (title, description, full text) for each image
+    """
+    azure_openai_client = get_async_azure_openai_client()
+    if len(image_urls) == 1:
+        return [await extract_content(azure_openai_client, image_urls[0],
+                                      extract_content_prompt)]
+
+    content = []
+    for index, image_url in enumerate(image_urls):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+    content.append({
+        "type": "text",
+        "text": "For each image, get the content from the image and generate a title, short description (4 sentences) and full text for the content. Return one item per image with the index of the image."
+    })
+
+    response = (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "user", "content": content},
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "images_content",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "items": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "index": {"type": "integer"},
+                                    "title": {"type": "string"},
+                                    "description": {"type": "string"},
+                                    "full_text": {"type": "string"}
+                                },
+                                "required": ["index", "title", "description",
+                                             "full_text"],
+                                "additionalProperties": False
+                            }
+                        }
+                    },
+                    "required": ["items"],
+                    "additionalProperties": False
+                }
+            }
+        }
+    )).choices[0].message.content
+
+    try:
+        items = {item['index']: (item['title'], item['description'],
+                                 item['full_text'])
+                 for item in json.loads(response)['items']}
+    except (TypeError, ValueError, KeyError):
+        # No content is returned when the model refuses to answer.
+        items = {}
+    # The images missing from the response are extracted one by one,
+    # concurrently.
+    missing = [index for index in range(len(image_urls))
+               if index not in items]
+    results = await asyncio.gather(
+        *[extract_content(azure_openai_client, image_urls[index],
+                          extract_content_prompt)
+          for index in missing])
+    items.update(zip(missing, results))
+    return [items[index] for index in range(len(image_urls))]
+
+
+def prepare_image(image_bytes: bytes):
+    """Decode an image, look its description up in the cache and encode the
+    requests describing it when it is not cached
+
+    Args:
+        image_bytes (bytes): Content of the image file
+
+    Returns:
+        Tuple with the format, the size, the perceptual hash and the aspect
+        ratio of the image, the cached description or None, and the data
+        URLs and sizes of the requests (empty when the description is cached)
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image_format = image.format
+    image = ImageOps.exif_transpose(image)
+
+    # The same image, or a re-saved copy of it, was maybe already described.
+    image_hash = compute_image_hash(image)
+    aspect_ratio = image.size[0] / image.size[1]
+    cached_description = find_cached_description(image_hash, aspect_ratio)
+    image_urls = []
+    if cached_description is None:
+        image_urls = [preprocess_image(image)] + \
+            [preprocess_image(tile) for tile in get_tiles(image)]
+    return image_format, image.size, image_hash, aspect_ratio, \
+        cached_description, image_urls
+
+
+def get_vector_store() -> AzureSearch:
+    """Get the vector store of the process, created on first use"""
+    if "vector_store" not in openai_clients:
+        azure_openai_embeddings = get_azure_openai_embeddings()
+
+        index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
+        if index_name is None or index_name == "":
+            index_name = "knowledgebase"
+
+        openai_clients["vector_store"] = AzureSearch(
+            azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+            azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
+            index_name=index_name,
+            embedding_function=azure_openai_embeddings.embed_query,
+        )
+    return openai_clients["vector_store"]
+
+
+async def index_image(image_location: str,
+                      metadata_batcher: MetadataBatcher = None) -> Input:
+
+    blob_client = blob_service_client.get_blob_client(
+        container=container_name, blob=image_location)
+    image_bytes = await asyncio.to_thread(
+        lambda: blob_client.download_blob().readall())
+
+    started_at = time.perf_counter()
+    # The decoding, the hash, the cache lookup and the encoding of the
+    # requests are CPU or disk bound, they run in a thread so that they do
+    # not hold the batches of the other messages.
+    image_format, image_size, image_hash, aspect_ratio, cached_description, \
+        image_urls = await asyncio.to_thread(prepare_image, image_bytes)
+
+    # Create the gpt-4o model client
+    azure_openai_client = get_async_azure_openai_client()
+
+    # We will generate a title and a description from the content.
+    # using OpenAI GPT-4.
+    if cached_description is not None:
+        title, description, full_text = cached_description
+    else:
+        # The whole image gives the title and the description. Very large
+        # images are also split in tiles described in parallel, their full
+        # texts are merged in reading order.
+        if len(image_urls) == 1 and metadata_batcher is not None:
+            results = [await metadata_batcher.submit(image_urls[0][0])]
+        else:
+            results = await asyncio.gather(
+                *[extract_content(azure_openai_client, image_url,
+                                  extract_content_prompt)
+                  for image_url, _ in image_urls])
+
+        title, description, full_text = results[0]
+        if len(results) > 1:
+            full_text = ' '.join(
+                [tile_text for _, _, tile_text in results[1:] if tile_text])
+        await asyncio.to_thread(
+            cache_description, image_hash, aspect_ratio, title, description,
+            full_text)
+
+    payload_bytes = sum([size for _, size in image_urls])
+    print(f"Image {image_location}: {image_format} {image_size[0]}x{image_size[1]}, "
+          f"{len(image_bytes)} bytes sent as {payload_bytes} bytes in "
+          f"{len(image_urls)} request(s), "
+          f"{time.perf_counter() - started_at:.2f}s")
 
     print(f"Title: {title}")
     print(f"Description: {description}")
@@ -191,7 +1074,7 @@ async def index_image(image_location: str) -> Input:
         document.metadata['description'] = description
         document.metadata['thumbnail_url'] = ''
         document.metadata['type'] = 'note'
-        document.page_content = full_text
+        document.page_content = full_text or ''
 
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
@@ -199,52 +1082,32 @@ async def index_image(image_location: str) -> Input:
     )
     splits = text_splitter.split_documents(documents)
 
-    azure_openai_embeddings = AzureOpenAIEmbeddings(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-        azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS']
-    )
-
-    index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
-    if index_name is None or index_name == "":
-        index_name = "knowledgebase"
-
-    vector_store = AzureSearch(
-        azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
-        azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
-        index_name=index_name,
-        embedding_function=azure_openai_embeddings.embed_query,
-    )
-    vector_store.add_documents(documents=splits)
+    # The vector store gets or creates the index when it is created, it is
+    # created in a thread.
+    vector_store = await asyncio.to_thread(get_vector_store)
+    await asyncio.to_thread(vector_store.add_documents, documents=splits)
 
     input.content = '\n\n'.join([doc.page_content for doc in documents])
-
-    os.remove(download_file_path)
+    input.summary = await summarize_input(input.title, input.content)
 
     return input
 
 
-def get_file(file_name: str):
-    """Get file path
-
-    Args:
-        file_name (str): File name
-
-    Returns:
-        File path
-    """
-    output_folder = 'outputs'
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    return os.path.join(output_folder, file_name)
-
-
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
     encoding = tiktoken.encoding_for_model(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
-while (True):
-    asyncio.run(main())
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+
+# The tests import this module, only poll the queue when it is run.
+if __name__ == "__main__":
+    asyncio.run(run())
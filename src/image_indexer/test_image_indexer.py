@@ -0,0 +1,104 @@
+"""Tests of the preprocessing of the images sent to the vision model and of
+the description cache"""
+import base64
+import io
+import os
+
+# The clients are created when the module is imported, they do not connect
+# until they are used.
+os.environ.setdefault(
+    "STORAGE_CONNECTION_STRING",
+    "DefaultEndpointsProtocol=https;AccountName=test;"
+    "AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+
+from PIL import Image  # noqa: E402
+
+import image_indexer  # noqa: E402
+from image_indexer import preprocess_image  # noqa: E402
+
+
+def decode_data_url(data_url):
+    header, data = data_url.split(",", 1)
+    return header, Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def test_preprocess_cmyk_jpeg():
+    buffer = io.BytesIO()
+    Image.new("CMYK", (320, 200), (0, 128, 255, 0)).save(
+        buffer, format="JPEG")
+    image = Image.open(io.BytesIO(buffer.getvalue()))
+    assert image.mode == "CMYK"
+
+    data_url, size = preprocess_image(image)
+
+    header, encoded_image = decode_data_url(data_url)
+    assert header in ("data:image/jpeg;base64", "data:image/png;base64")
+    assert encoded_image.mode in ("RGB", "L")
+    assert encoded_image.size == (320, 200)
+    assert size > 0
+
+
+def test_preprocess_keeps_transparency():
+    image = Image.new("RGBA", (64, 64), (255, 0, 0, 128))
+
+    data_url, _ = preprocess_image(image)
+
+    header, encoded_image = decode_data_url(data_url)
+    assert header == "data:image/png;base64"
+    assert encoded_image.mode == "RGBA"
+
+
+def test_preprocess_downscales_large_images():
+    image = Image.new("RGB", (4000, 1000), (10, 20, 30))
+
+    _, encoded_image = decode_data_url(preprocess_image(image)[0])
+
+    assert max(encoded_image.size) <= 2048
+    assert min(encoded_image.size) <= 768
+
+
+def load_description_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_indexer, "description_cache_path",
+                        str(tmp_path / "descriptions.db"))
+    monkeypatch.setattr(image_indexer, "description_cache_max_distance", 4)
+    monkeypatch.setattr(
+        image_indexer, "description_cache_max_aspect_ratio_difference", 0.05)
+    monkeypatch.setattr(image_indexer, "description_cache_max_entries", 10)
+    monkeypatch.setattr(image_indexer, "description_cache", None)
+    return image_indexer
+
+
+def make_gradient(width, height):
+    image = Image.new("L", (width, height))
+    image.putdata([(x * 7 + y * 3) % 256 if (x // 16) % 2 else (x * 3) % 256
+                   for y in range(height) for x in range(width)])
+    return image
+
+
+def test_description_cache_matches_resized_copy(tmp_path, monkeypatch):
+    cache = load_description_cache(tmp_path, monkeypatch)
+    image = make_gradient(200, 100)
+    image_hash = cache.compute_image_hash(image)
+    cache.cache_description(image_hash, 2.0, "Title", "Description",
+                            "Full text")
+    copy_hash = cache.compute_image_hash(image.resize((100, 50)))
+    assert cache.find_cached_description(copy_hash, 2.0) == (
+        "Title", "Description", "Full text")
+
+
+def test_description_cache_requires_same_aspect_ratio(tmp_path, monkeypatch):
+    cache = load_description_cache(tmp_path, monkeypatch)
+    image_hash = cache.compute_image_hash(make_gradient(200, 100))
+    cache.cache_description(image_hash, 2.0, "Title", "Description",
+                            "Full text")
+    assert cache.find_cached_description(image_hash, 1.0) is None
+    assert cache.find_cached_description(image_hash ^ 1, 1.0) is None
+
+
+def test_description_cache_skips_blank_images(tmp_path, monkeypatch):
+    cache = load_description_cache(tmp_path, monkeypatch)
+    blank_hash = cache.compute_image_hash(Image.new("L", (200, 100), 255))
+    cache.cache_description(blank_hash, 2.0, "Title", "Description",
+                            "Full text")
+    assert cache.find_cached_description(blank_hash, 2.0) is None
+    assert cache.find_cached_description(blank_hash | 1, 2.0) is None
@@ -29,6 +29,8 @@ servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
 blob_service_client = BlobServiceClient.from_connection_string(os.getenv("STORAGE_CONNECTION_STRING"))
 container_name = "uploads"
 
+video_extensions = (".mp4", ".mov", ".mkv", ".webm", ".mp3", ".wav", ".m4a")
+
 status_cache = {}
 app = FastAPI()
 
@@ -61,6 +63,10 @@ async def index(inputBody: InputBody):
     # If it is a URL
     if input.startswith("http"):
         queue = 'website'
+        # If it is a YouTube video or an audio/video file
+        if "youtube.com/" in input or "youtu.be/" in input or \
+                input.split("?")[0].lower().endswith(video_extensions):
+            queue = 'video'
     logger.info(f"Determined queue: {queue}")
 
     # Send the message to the Service Bus
@@ -83,6 +89,8 @@ async def upload_file(file: UploadFile = File(...)):
         queue = 'pdf'
     elif (file.filename.lower().endswith(".docx")):
         queue = 'word'
+    elif (file.filename.lower().endswith(video_extensions)):
+        queue = 'video'
     else:
         logger.error(f"Unsupported file type.")
         raise HTTPException(status_code=400, detail="Unsupported file type")
@@ -1,17 +1,26 @@
 import os
+import httpx
+import time
+import threading
+import sqlite3
+import hashlib
+import importlib.util
 import json
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 from dotenv import load_dotenv
 from azure.servicebus.aio import ServiceBusClient
-from azure.cosmos import CosmosClient
-from openai import AzureOpenAI
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from langchain_core.documents.base import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_community.vectorstores.azuresearch import AzureSearch
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv(override=True)
 
@@ -19,6 +28,75 @@ servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
 cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
 status_endpoint = os.getenv("STATUS_ENDPOINT")
 
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# How the title and the description of the notes are generated:
+# - llm: with GPT-4o
+# - local: with the local extractive summarizer, GPT-4o being used only when
+#   the confidence of the summary is below note_summary_min_confidence
+# - local_upgrade: with the local extractive summarizer, then upgraded in
+#   the background with GPT-4o
+note_metadata_mode = os.getenv("NOTE_METADATA_MODE", "llm")
+note_summary_min_confidence = float(
+    os.getenv("NOTE_SUMMARY_MIN_CONFIDENCE", "0.6"))
+metadata_upgrade_executor = ThreadPoolExecutor(max_workers=2)
+
+# Maximum number of notes received together and whose metadata is generated
+# in a single call, and maximum time to wait for a batch to fill up.
+metadata_batch_size = int(os.getenv("METADATA_BATCH_SIZE", "1"))
+metadata_batch_max_wait_ms = int(os.getenv("METADATA_BATCH_MAX_WAIT_MS", "500"))
+# Maximum number of notes processed at the same time, the messages are
+# received as long as this limit is not reached so that a batch can be filled
+# by several receive calls.
+note_max_concurrent_messages = int(
+    os.getenv("NOTE_MAX_CONCURRENT_MESSAGES", "16"))
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+# Persistent cache of the chat completions sent with temperature 0, whose
+# responses are deterministic. Bypassing the cache sends every prompt to the
+# model again and refreshes the cached responses.
+llm_cache_path = os.getenv(
+    "LLM_CACHE_PATH", os.path.join("cache", "llm_responses.db"))
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+llm_cache_max_age_days = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30"))
+llm_cache_bypass = os.getenv("LLM_CACHE_BYPASS", "false").lower() == "true"
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+WORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z'-]*")
+STOP_WORDS = set("""a about above after again against all am an and any are as
+at be because been before being below between both but by can could did do
+does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me
+more most my myself no nor not now of off on once only or other our ours
+ourselves out over own same she should so some such than that the their
+theirs them themselves then there these they this those through to too under
+until up very was we were what when where which while who whom why will with
+would you your yours yourself yourselves also may might must shall one two
+""".split())
+
 
 class Input:
     id: str
@@ -33,6 +111,11 @@ class Input:
     topics: list
     entities: list
     content: str
+    summary: str
+    # Not saved: keys of the chunks in the search index and client of the
+    # index, used to upgrade the metadata of the chunks.
+    chunk_ids: list
+    search_client: object
 
     def to_dict(self):
         return {
@@ -47,7 +130,8 @@ class Input:
             "thumbnail_url": self.thumbnail_url,
             "topics": self.topics,
             "entities": self.entities,
-            "content": self.content
+            "content": self.content,
+            "summary": self.summary
         }
 
 
@@ -57,27 +141,466 @@ async def main():
         async with servicebus_client:
             receiver = servicebus_client.get_queue_receiver('note')
             async with receiver:
-                received_messages = await receiver.receive_messages(
-                    max_message_count=1, max_wait_time=5)
-                for message in received_messages:
-                    website_input = json.loads(str(message))
-                    content = website_input['input']
-                    update_status(website_input['request_id'], "Indexing")
-                    input = await index_note(content)
-                    update_status(website_input['request_id'], "Indexed")
-                    save_to_cosmosdb(input)
-                    update_status(website_input['request_id'], "Saved")
-                    await receiver.complete_message(message)
-    asyncio.sleep(5)
-
-
-def save_to_cosmosdb(input: Input):
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database_name = "autopodcaster"
-    database = client.get_database_client(database_name)
-    container_name = "inputs"
-    container = database.get_container_client(container_name)
-    container.create_item(body=input.to_dict())
+                # The notes are processed concurrently and share the batcher,
+                # so that the metadata of the notes received by successive
+                # calls can be generated in a single call.
+                metadata_batcher = MetadataBatcher(
+                    metadata_batch_size, metadata_batch_max_wait_ms,
+                    generate_metadata_with_llm_batch)
+                tasks = set()
+                while (True):
+                    tasks = {task for task in tasks if not task.done()}
+                    if len(tasks) >= note_max_concurrent_messages:
+                        await asyncio.wait(
+                            tasks, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    received_messages = await receiver.receive_messages(
+                        max_message_count=(
+                            note_max_concurrent_messages - len(tasks)),
+                        max_wait_time=1 if tasks else 5)
+                    for message in received_messages:
+                        tasks.add(asyncio.create_task(process_message(
+                            receiver, message, metadata_batcher)))
+
+
+async def process_message(receiver, message, metadata_batcher):
+    note_input = json.loads(str(message))
+    request_id = note_input['request_id']
+    content = note_input['input']
+    try:
+        # The blocking calls run in threads, so that they do not hold the
+        # other notes processed concurrently.
+        await asyncio.to_thread(update_status, request_id, "Indexing")
+        input = await index_note(content, metadata_batcher)
+        await asyncio.to_thread(update_status, request_id, "Indexed")
+        await save_to_cosmosdb(input)
+        await asyncio.to_thread(update_status, request_id, "Saved")
+    except Exception as e:
+        print(f"Failed to index the note {request_id}: {e}")
+        await receiver.abandon_message(message)
+        return
+    if note_metadata_mode == 'local_upgrade':
+        metadata_upgrade_executor.submit(upgrade_note_metadata, input)
+    await receiver.complete_message(message)
+    print(f"LLM cache: {get_llm_response_cache().get_metrics()}")
+
+
+class MetadataBatcher:
+    """Gather metadata requests and send them as a single model call
+
+    The pending requests are sent when max_items requests are gathered or
+    max_wait_ms milliseconds after the first one, whichever comes first, so
+    the latency added to each request stays bounded.
+    """
+
+    def __init__(self, max_items: int, max_wait_ms: int, generate_batch):
+        self.max_items = max_items
+        self.max_wait_ms = max_wait_ms
+        self.generate_batch = generate_batch
+        self.pending = []
+        self.flush_task = None
+
+    async def submit(self, item):
+        """Submit a request and wait for its result
+
+        Args:
+            item: Content to generate the metadata for
+
+        Returns:
+            Result generated for the item by generate_batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return await future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_wait_ms / 1000)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch, self.pending = self.pending, []
+        if len(batch) > 0:
+            asyncio.create_task(self.send(batch))
+
+    async def send(self, batch):
+        try:
+            results = await self.generate_batch([item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so the inputs
+    # of the messages processed concurrently are written concurrently. At
+    # most cosmosdb_max_connections writes are in flight, the others wait
+    # for one of them to finish instead of waiting for a connection.
+    if "writes" not in cosmos_clients:
+        cosmos_clients["writes"] = asyncio.Semaphore(cosmosdb_max_connections)
+    async with cosmos_clients["writes"]:
+        container = get_cosmos_container("inputs")
+        await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+
+class LLMResponseCache:
+    """Persistent cache of the chat completion responses of temperature 0
+    prompts, keyed by the hash of the deployment, the messages and the
+    parameters of the request
+
+    The entries older than max_age_days are dropped and the least recently
+    used ones are evicted when the cache is larger than max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age_days: float,
+                 bypass: bool):
+        cache_folder = os.path.dirname(path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "status INTEGER, headers TEXT, body BLOB, size INTEGER, "
+            "created_at REAL, last_used REAL)")
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, request: httpx.Request):
+        """Get the cache key of a request
+
+        Args:
+            request (httpx.Request): Request sent to Azure OpenAI
+
+        Returns:
+            Cache key, or None if the response of the request is not
+            deterministic or not a chat completion
+        """
+        if request.method != "POST" or \
+                not request.url.path.endswith("/chat/completions"):
+            return None
+        body = json.loads(request.content)
+        if body.get("temperature") != 0 or body.get("stream"):
+            return None
+        key = json.dumps({"path": request.url.path, "body": body},
+                         sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Get a cached response
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Tuple with the status code, the headers and the body, or None
+        """
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body FROM responses WHERE key = ? "
+                "AND created_at >= ?",
+                (key, time.time() - self.max_age_seconds)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key))
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key: str, status: int, headers: dict, body: bytes):
+        """Store a response and evict the old and least recently used ones
+
+        Args:
+            key (str): Cache key
+            status (int): Status code
+            headers (dict): Headers
+            body (bytes): Body
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, json.dumps(headers), body, len(body), now, now))
+            self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (now - self.max_age_seconds,))
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, size in self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                    ).fetchall():
+                if total_size <= self.max_bytes:
+                    break
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (old_key,))
+                total_size -= size
+
+    def get_metrics(self):
+        """Get the hit rate metrics of the cache
+
+        Returns:
+            Dictionary with the number of hits and misses and the hit rate
+        """
+        requests_count = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests_count if requests_count else 0.0
+        }
+
+
+def build_cached_response(request: httpx.Request, status: int,
+                          headers: dict, body: bytes) -> httpx.Response:
+    """Build the response returned by the caching transports"""
+    return httpx.Response(status, headers=headers, content=body,
+                          request=request)
+
+
+def get_cacheable_headers(response: httpx.Response) -> dict:
+    """Get the headers of a response that still apply to its decoded body"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length",
+                                    "transfer-encoding")}
+
+
+class CachingTransport(httpx.BaseTransport):
+    """HTTP transport answering the deterministic chat completions from the
+    LLM response cache"""
+
+    def __init__(self, transport: httpx.BaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = self.transport.handle_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncCachingTransport(httpx.AsyncBaseTransport):
+    """Async HTTP transport answering the deterministic chat completions
+    from the LLM response cache"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    async def handle_async_request(
+            self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = await self.transport.handle_async_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Get the LLM response cache of the process, created on first use"""
+    if "llm_cache" not in openai_clients:
+        openai_clients["llm_cache"] = LLMResponseCache(
+            llm_cache_path, llm_cache_max_bytes, llm_cache_max_age_days,
+            llm_cache_bypass)
+    return openai_clients["llm_cache"]
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["http"] = httpx.Client(
+            timeout=options.pop("timeout"),
+            transport=CachingTransport(httpx.HTTPTransport(**options),
+                                       get_llm_response_cache()))
+    return openai_clients["http"]
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get the async HTTP client of the process, created on first use"""
+    if "async_http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["async_http"] = httpx.AsyncClient(
+            timeout=options.pop("timeout"),
+            transport=AsyncCachingTransport(
+                httpx.AsyncHTTPTransport(**options),
+                get_llm_response_cache()))
+    return openai_clients["async_http"]
+
+
+def get_azure_openai_client() -> AzureOpenAI:
+    """Get the Azure OpenAI client of the process, created on first use"""
+    if "azure_openai" not in openai_clients:
+        openai_clients["azure_openai"] = AzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_http_client()
+        )
+    return openai_clients["azure_openai"]
+
+
+def get_async_azure_openai_client() -> AsyncAzureOpenAI:
+    """Get the async Azure OpenAI client of the process, created on first use"""
+    if "async_azure_openai" not in openai_clients:
+        openai_clients["async_azure_openai"] = AsyncAzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_async_http_client()
+        )
+    return openai_clients["async_azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+async def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_async_azure_openai_client()
+    return (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ])).choices[0].message.content.strip()
+
+
+async def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    while len(parts) > 1:
+        summaries = await asyncio.gather(
+            *[summarize_text(title, part) for part in parts])
+        parts = text_splitter.split_text('\n\n'.join(summaries))
+    return await summarize_text(title, parts[0])
 
 
 def update_status(request_id: str, status: str):
@@ -86,11 +609,15 @@ def update_status(request_id: str, status: str):
         f"{status_endpoint}/status/{request_id}", json=status)
 
 
-async def index_note(content: str) -> Input:
+def generate_metadata_with_llm(content: str):
+    """Generate the title and the description of a note with GPT-4o
 
-    # We will generate a title and a description from the content.
-    # using OpenAI GPT-4.
+    Args:
+        content (str): Content of the note
 
+    Returns:
+        Tuple with the title and the description
+    """
     # Create the prompt to generate the title and description.
     prompt_template = """Generate a title (max 8 words) and description (max 3 sentences) for the following content: {content}.
      
@@ -99,11 +626,7 @@ async def index_note(content: str) -> Input:
     $$Description goes here$$
      """
     # Create the gpt-4o model client
-    azure_openai_client = AzureOpenAI(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION']
-    )
+    azure_openai_client = get_azure_openai_client()
 
     # Get first 500 tokens
     prompt = prompt_template.format(content=content[:500])
@@ -117,15 +640,236 @@ async def index_note(content: str) -> Input:
         ],
     ).choices[0].message.content
 
-    # Title and description is returned in following format: [[Title goes here]] and $$Description goes here$$
-    # Extract the title and description from the corrected content.
+    # No content is returned when the model refuses to answer.
+    if corrected_content is None:
+        return None, None
 
+    # Title and description is returned in following format: [[Title goes here]] and $$Description goes here$$
     # Extract the title and description from the corrected content.
     title_match = re.search(r'\[\[(.*?)\]\]', corrected_content)
     description_match = re.search(r'\$\$(.*?)\$\$', corrected_content)
 
     title = title_match.group(1) if title_match else None
     description = description_match.group(1) if description_match else None
+    return title, description
+
+
+async def generate_metadata_with_llm_batch(contents: list):
+    """Generate the title and the description of several notes with a single
+    GPT-4o call using structured output
+
+    Args:
+        contents (list): Contents of the notes
+
+    Returns:
+        List with a tuple (title, description) for each note
+    """
+    if len(contents) == 1:
+        return [await asyncio.to_thread(generate_metadata_with_llm,
+                                        contents[0])]
+
+    notes = '\n\n'.join([f"Note {index}:\n{content[:500]}"
+                          for index, content in enumerate(contents)])
+    prompt = f"""Generate a title (max 8 words) and description (max 3 sentences) for each of the following notes.
+    Return one item per note with the index of the note.
+
+    {notes}
+    """
+
+    # Create the gpt-4o model client
+    azure_openai_client = get_async_azure_openai_client()
+
+    response = (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "user", "content": prompt},
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "notes_metadata",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "items": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "index": {"type": "integer"},
+                                    "title": {"type": "string"},
+                                    "description": {"type": "string"}
+                                },
+                                "required": ["index", "title", "description"],
+                                "additionalProperties": False
+                            }
+                        }
+                    },
+                    "required": ["items"],
+                    "additionalProperties": False
+                }
+            }
+        }
+    )).choices[0].message.content
+
+    try:
+        items = {item['index']: (item['title'], item['description'])
+                 for item in json.loads(response)['items']}
+    except (TypeError, ValueError, KeyError):
+        # No content is returned when the model refuses to answer.
+        items = {}
+    # The notes missing from the response are generated one by one,
+    # concurrently.
+    missing = [index for index in range(len(contents)) if index not in items]
+    results = await asyncio.gather(
+        *[asyncio.to_thread(generate_metadata_with_llm, contents[index])
+          for index in missing])
+    items.update(zip(missing, results))
+    return [items[index] for index in range(len(contents))]
+
+
+def summarize_locally(content: str):
+    """Generate the title and the description of a note without any model
+
+    The sentences are scored by the frequency of their keywords, the
+    description is made of the 3 best sentences in their original order.
+    The title is the first line when it looks like a heading, otherwise the
+    beginning of the best sentence.
+
+    Args:
+        content (str): Content of the note
+
+    Returns:
+        Tuple with the title, the description and a confidence score
+        between 0 and 1
+    """
+    lines = [line.strip() for line in content.strip().splitlines()
+             if line.strip()]
+    if len(lines) == 0:
+        return None, None, 0.0
+
+    first_line = lines[0].lstrip('#').strip()
+    heading = len(first_line.split()) <= 8 and \
+        not first_line.endswith(('.', '?', '!', ':', ',')) and len(lines) > 1
+    body = ' '.join(lines[1:] if heading else lines)
+
+    sentences = [sentence.strip() for sentence in
+                 SENTENCE_PATTERN.split(body) if sentence.strip()]
+    words = [word.lower() for word in WORD_PATTERN.findall(body)]
+    keywords = [word for word in words
+                if word not in STOP_WORDS and len(word) > 2]
+    frequencies = {}
+    for keyword in keywords:
+        frequencies[keyword] = frequencies.get(keyword, 0) + 1
+    max_frequency = max(frequencies.values()) if frequencies else 1
+
+    def score(sentence):
+        sentence_keywords = [word.lower()
+                             for word in WORD_PATTERN.findall(sentence)
+                             if word.lower() in frequencies]
+        if len(sentence_keywords) == 0:
+            return 0.0
+        return sum([frequencies[word] / max_frequency
+                    for word in sentence_keywords]) / \
+            (len(sentence_keywords) ** 0.5)
+
+    scores = [score(sentence) for sentence in sentences]
+    best = sorted(range(len(sentences)), key=lambda i: -scores[i])[:3]
+    description = ' '.join([sentences[i] for i in sorted(best)])
+
+    if heading:
+        title = first_line
+    elif len(best) > 0:
+        title_words = sentences[best[0]].rstrip('.?!').split()
+        title = ' '.join(title_words[:8])
+    else:
+        title = ' '.join(first_line.split()[:8])
+
+    # The summary is trusted when the note has a heading, enough sentences
+    # to choose from and keywords repeated across the note.
+    repeated_keywords = len([word for word in frequencies
+                             if frequencies[word] > 1])
+    confidence = (0.4 if heading else 0.0) + \
+        0.3 * min(1.0, len(sentences) / 5) + \
+        0.3 * min(1.0, repeated_keywords / 5)
+    return title, description, round(confidence, 2)
+
+
+def upgrade_note_metadata(input: Input):
+    """Replace the locally generated title and description of a saved note
+    by the ones generated by GPT-4o, run in the background
+
+    Args:
+        input (Input): Saved note
+    """
+    try:
+        title, description = generate_metadata_with_llm(input.content)
+        if title is None and description is None:
+            return
+        input.title = title or input.title
+        input.description = description or input.description
+        container = get_cosmos_container("inputs")
+        container.upsert_item(body=input.to_dict())
+        # The metadata of the chunks is stored as JSON in the search index,
+        # it is replaced so that the retrieved chunks carry the new title
+        # and description.
+        metadata = json.dumps({
+            "id": input.id,
+            "title": input.title,
+            "source": input.source,
+            "description": input.description,
+            "thumbnail_url": input.thumbnail_url,
+            "type": input.type
+        })
+        if input.chunk_ids:
+            input.search_client.merge_documents(
+                documents=[{"id": chunk_id, "metadata": metadata}
+                           for chunk_id in input.chunk_ids])
+        print(f"Upgraded metadata of {input.id}: {title}")
+    except Exception as e:
+        print(f"Error upgrading metadata of {input.id}: {e}")
+
+
+def get_vector_store() -> AzureSearch:
+    """Get the vector store of the process, created on first use"""
+    if "vector_store" not in openai_clients:
+        azure_openai_embeddings = get_azure_openai_embeddings()
+
+        index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
+        if index_name is None or index_name == "":
+            index_name = "knowledgebase"
+
+        openai_clients["vector_store"] = AzureSearch(
+            azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+            azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
+            index_name=index_name,
+            embedding_function=azure_openai_embeddings.embed_query,
+        )
+    return openai_clients["vector_store"]
+
+
+async def index_note(content: str,
+                     metadata_batcher: MetadataBatcher = None) -> Input:
+
+    # We will generate a title and a description from the content, locally
+    # or using OpenAI GPT-4o.
+    metadata_source = 'llm'
+    if note_metadata_mode in ('local', 'local_upgrade'):
+        title, description, confidence = summarize_locally(content)
+        print(f"Local summary confidence: {confidence}")
+        metadata_source = 'local'
+        if note_metadata_mode == 'local' and \
+                confidence < note_summary_min_confidence:
+            metadata_source = 'llm'
+    if metadata_source == 'llm':
+        if metadata_batcher is not None:
+            title, description = await metadata_batcher.submit(content)
+        else:
+            title, description = await asyncio.to_thread(
+                generate_metadata_with_llm, content)
 
     print(f"Title: {title}")
     print(f"Description: {description}")
@@ -160,28 +904,25 @@ async def index_note(content: str) -> Input:
     )
     splits = text_splitter.split_documents(documents)
 
-    azure_openai_embeddings = AzureOpenAIEmbeddings(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-        azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS']
-    )
-
-    index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
-    if index_name is None or index_name == "":
-        index_name = "knowledgebase"
-
-    vector_store = AzureSearch(
-        azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
-        azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
-        index_name=index_name,
-        embedding_function=azure_openai_embeddings.embed_query,
-    )
-    vector_store.add_documents(documents=splits)
+    # The vector store gets or creates the index when it is created, it is
+    # created in a thread.
+    vector_store = await asyncio.to_thread(get_vector_store)
+    input.chunk_ids = await asyncio.to_thread(
+        vector_store.add_documents, documents=splits)
+    input.search_client = vector_store.client
 
     input.content = '\n\n'.join([doc.page_content for doc in documents])
+    input.summary = await summarize_input(input.title, input.content)
 
     return input
 
-while (True):
-    asyncio.run(main())
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+
+asyncio.run(run())
@@ -2,19 +2,37 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.cosmos import CosmosClient
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.aio import ServiceBusClient
+from azure.cosmos.aio import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import AioHttpTransport
 
-import requests
+import httpx
 import os
 import uuid
 import json
+import time
+import hashlib
+import datetime
 import logging
+import collections
+import contextlib
+import aiohttp
 
 
 class InputBody(BaseModel):
     subject_id: str
-    output_type: str
+    output_type: str = ""
+    # Several output types generated from a single retrieval and outline pass
+    output_types: list = []
+    # Generation settings the reused output must have been generated with
+    settings: dict = {}
+    # Generate a new output even if an identical one exists
+    force: bool = False
+    # Priority class of the request: interactive or batch
+    priority: str = "interactive"
+    # Tenant the request is scheduled for, the tenants share the workers
+    tenant_id: str = "default"
 
 
 class StatusBody(BaseModel):
@@ -31,8 +49,76 @@ servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
 cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
 subject_space_api_url = os.getenv("SUBJECT_SPACE_API_URL")
 
+# Completed outputs younger than this are returned instead of generating
+# identical ones (0 disables the reuse), and identical requests received
+# while one is in flight for less than the TTL are attached to it.
+output_reuse_max_age_hours = float(
+    os.getenv("OUTPUT_REUSE_MAX_AGE_HOURS", "24"))
+output_inflight_ttl_seconds = float(
+    os.getenv("OUTPUT_INFLIGHT_TTL_SECONDS", "3600"))
+
+# Queue suffix of each priority class, the batch requests are sent to their
+# own queue so that they never delay the interactive ones.
+priority_queue_suffixes = {"interactive": "", "batch": "-batch"}
+
+# Output types generated from the context and the outline of the podcast
+# generator, which retrieves and drafts them once for all the outputs of a
+# request and fans them out to their generators.
+shared_pass_queue = "podcast"
+shared_pass_output_types = ["blog", "podcast", "presentation"]
+
+# Maximum number of connections of the Cosmos DB client, created once at
+# startup and shared by all the requests.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "100"))
+cosmos_clients = {}
+# Service Bus client and HTTP client of the subject space API, created once
+# at startup and shared by all the requests
+servicebus_clients = {}
+http_clients = {}
+
 status_cache = {}
-app = FastAPI()
+# Priority class and time of the requests waiting in a queue
+queued_requests = {}
+# Last queue waits in seconds of each priority class
+queue_waits = {priority: collections.deque(maxlen=1000)
+               for priority in priority_queue_suffixes}
+# Fingerprint and settings of the requests in flight: request id and time it
+# was queued
+inflight_requests = {}
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with contextlib.AsyncExitStack() as stack:
+        session = await stack.enter_async_context(aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=cosmosdb_max_connections)))
+        cosmos_clients["client"] = await stack.enter_async_context(
+            CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=AioHttpTransport(
+                    session=session, session_owner=False)))
+        servicebus_clients["client"] = await stack.enter_async_context(
+            ServiceBusClient.from_connection_string(
+                servicebus_connection_string))
+        http_clients["subject_space"] = await stack.enter_async_context(
+            httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0)))
+        yield
+    cosmos_clients.clear()
+    servicebus_clients.clear()
+    http_clients.clear()
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached"""
+    if container_name not in cosmos_clients:
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Disable CORS checking
 app.add_middleware(
@@ -47,64 +133,278 @@ app.add_middleware(
 @app.post("/output")
 async def generate_output(inputBody: InputBody):
     subject_id = inputBody.subject_id
-    output_type = inputBody.output_type
+    output_types = inputBody.output_types or [inputBody.output_type]
     logger.info(
-        f"Received subject_id: {subject_id}, output_type: {output_type}")
+        f"Received subject_id: {subject_id}, output_types: {output_types}")
+    if inputBody.priority not in priority_queue_suffixes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown priority: {inputBody.priority}")
+    if not all(output_types):
+        raise HTTPException(status_code=400, detail="Missing output type")
+
+    response = await http_clients["subject_space"].get(
+        f"{subject_space_api_url}/subject/{subject_id}")
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Subject not found")
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Subject space error: {response.status_code}")
+    subject_json = response.json()
+
+    outputs = []
+    messages = []
+    for output_type in dict.fromkeys(output_types):
+        fingerprint = get_output_fingerprint(
+            subject_json.get('subject', ''), subject_json.get('inputs', []),
+            output_type)
+        existing_output = None
+        if not inputBody.force:
+            existing_output = await find_existing_output(
+                subject_id, output_type, fingerprint, inputBody.settings)
+        if existing_output is not None:
+            outputs.append(existing_output)
+            continue
+
+        # Generate a uuid for the request
+        request_id = str(uuid.uuid4())
+        status_cache[request_id] = "Creating"
+        logger.info(f"Generated request_id: {request_id}")
+
+        message = {
+            "request_id": request_id,
+            "subject_id": subject_id,
+            "output_type": output_type,
+            "fingerprint": fingerprint,
+            "priority": inputBody.priority,
+            "tenant_id": inputBody.tenant_id,
+            "enqueued_at": time.time()
+        }
+        logger.info(f"Created message: {message}")
+        outputs.append(message)
+        messages.append(message)
+
+    # The outputs sharing the retrieval and the outline of the podcast
+    # generator are sent to it in a single message, only a podcast alone is
+    # sent as is.
+    shared_messages = [message for message in messages
+                       if message["output_type"] in shared_pass_output_types]
+    if shared_messages and [message["output_type"]
+                            for message in shared_messages] != \
+            [shared_pass_queue]:
+        shared_message = dict(shared_messages[0])
+        shared_message["output_type"] = shared_pass_queue
+        shared_message["outputs"] = [
+            {"output_type": message["output_type"],
+             "request_id": message["request_id"],
+             "fingerprint": message["fingerprint"]}
+            for message in shared_messages]
+        messages = [message for message in messages
+                    if message not in shared_messages]
+        messages.append(shared_message)
+
+    for message in messages:
+        queue = message["output_type"] + \
+            priority_queue_suffixes[inputBody.priority]
+        logger.info(f"Determined queue: {queue}")
+        await send_message(queue, message)
+        for output in message.get("outputs", [message]):
+            status_cache[output["request_id"]] = "Queued"
+            queued_requests[output["request_id"]] = (
+                inputBody.priority, message["enqueued_at"])
+            inflight_requests[get_inflight_key(
+                output["fingerprint"], inputBody.settings)] = (
+                output["request_id"], time.time())
+
+    if not inputBody.output_types:
+        return outputs[0]
+    return {"subject_id": subject_id, "outputs": outputs}
 
-    # Generate a uuid for the request
-    request_id = str(uuid.uuid4())
-    status_cache[request_id] = "Creating"
-    logger.info(f"Generated request_id: {request_id}")
 
-    message = {
-        "request_id": request_id,
-        "subject_id": subject_id,
-        "output_type": output_type
-    }
-    logger.info(f"Created message: {message}")
+async def find_existing_output(subject_id: str, output_type: str,
+                         fingerprint: str, settings: dict):
+    """Find a completed or in flight output identical to a requested one
 
-    queue = output_type
-    logger.info(f"Determined queue: {queue}")
+    Args:
+        subject_id (str): Id of the subject
+        output_type (str): Type of output
+        fingerprint (str): Fingerprint of the output
+        settings (dict): Generation settings the output must have
 
-    # Send the message to the Service Bus
-    with ServiceBusClient.from_connection_string(servicebus_connection_string) as client:
-        with client.get_queue_sender(queue) as sender:
-            # Encode the service bus message dict as JSON string
-            message_json = json.dumps(message)
-            servicebus_message = ServiceBusMessage(message_json)
-            sender.send_messages(servicebus_message)
-            # Update the status
-            status_cache[request_id] = "Queued"
+    Returns:
+        Response of the existing output or None
+    """
+    output = await find_completed_output(fingerprint, settings)
+    if output is not None:
+        logger.info(f"Reusing output {output['id']} for {fingerprint}")
+        # The request may have been served by another instance or before a
+        # restart, its status is recorded so that it can be polled.
+        request_id = output.get('request_id') or output['id']
+        status_cache[request_id] = "Saved"
+        return {
+            "request_id": request_id,
+            "subject_id": subject_id,
+            "output_type": output_type,
+            "status": "Saved",
+            "output": output
+        }
 
-    return message
+    # A request only attaches to one in flight with the same settings.
+    inflight_request = inflight_requests.get(
+        get_inflight_key(fingerprint, settings))
+    if inflight_request is not None and \
+            time.time() - inflight_request[1] < output_inflight_ttl_seconds \
+            and status_cache.get(inflight_request[0]) not in (
+                "Saved", "Failed"):
+        logger.info(f"Attaching to request {inflight_request[0]}")
+        return {
+            "request_id": inflight_request[0],
+            "subject_id": subject_id,
+            "output_type": output_type,
+            "status": status_cache.get(inflight_request[0])
+        }
+    return None
+
+
+async def send_message(queue: str, message: dict):
+    """Send a message to a Service Bus queue with the async client of the app
+
+    Args:
+        queue (str): Name of the queue
+        message (dict): Message
+    """
+    async with servicebus_clients["client"].get_queue_sender(queue) as sender:
+        # Encode the service bus message dict as JSON string
+        message_json = json.dumps(message)
+        servicebus_message = ServiceBusMessage(message_json)
+        await sender.send_messages(servicebus_message)
+
+
+def get_inflight_key(fingerprint: str, settings: dict):
+    """Get the key of a request in flight
+
+    Args:
+        fingerprint (str): Fingerprint of the output
+        settings (dict): Generation settings of the request
+
+    Returns:
+        Fingerprint followed by the sorted settings
+    """
+    return f"{fingerprint}:{json.dumps(settings, sort_keys=True)}"
+
+
+def get_output_fingerprint(subject: str, input_ids: list, output_type: str):
+    """Get the fingerprint of an output
+
+    The podcast generator computes the same fingerprint, it must be kept in
+    sync.
+
+    Args:
+        subject (str): Text of the subject
+        input_ids (list): Ids of the inputs of the subject
+        output_type (str): Type of output
+
+    Returns:
+        SHA-256 of the subject, the sorted input ids and the output type
+    """
+    key = json.dumps({"subject": subject, "inputs": sorted(input_ids),
+                      "type": output_type}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+async def find_completed_output(fingerprint: str, settings: dict):
+    """Find a completed output with the same fingerprint
+
+    Args:
+        fingerprint (str): Fingerprint of the output
+        settings (dict): Generation settings the output must have
+
+    Returns:
+        Most recent matching output or None
+    """
+    if output_reuse_max_age_hours <= 0:
+        return None
+    container = get_cosmos_container("outputs")
+    oldest = (datetime.datetime.now() - datetime.timedelta(
+        hours=output_reuse_max_age_hours)).isoformat()
+    outputs = container.query_items(
+        query="SELECT * FROM c WHERE c.fingerprint = @fingerprint "
+              "AND c.completed = true AND c.created_at >= @oldest "
+              "ORDER BY c.created_at DESC",
+        parameters=[{"name": "@fingerprint", "value": fingerprint},
+                    {"name": "@oldest", "value": oldest}])
+    async for output in outputs:
+        generation_settings = output.get('generation_settings', {})
+        if all(generation_settings.get(name) == value
+               for name, value in settings.items()):
+            return output
+    return None
 
 
 @app.get("/output/for-subject/{subject_id}")
 async def get_output_for_subject(subject_id: str):
     # Use Cosmos DB to fetch the output for the subject
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("outputs")
+    container = get_cosmos_container("outputs")
 
     # Query the Cosmos DB container for the output
     query = f"SELECT * FROM c WHERE c.subject_id = '{subject_id}'"
-    ouputs_iterator = container.query_items(
-        query=query, enable_cross_partition_query=True)
+    ouputs_iterator = container.query_items(query=query)
     outputs = []
-    for output in ouputs_iterator:
+    async for output in ouputs_iterator:
         outputs.append(output)
     return outputs
 
 
 @app.get("/status/{request_id}")
 async def get_status(request_id: str):
-    # If request_id is not found, return HTTP 404
+    # The requests unknown to this instance are Saved if their output is in
+    # Cosmos DB, otherwise return HTTP 404
     if request_id not in status_cache:
-        raise HTTPException(status_code=404, detail="Request ID not found")
+        container = get_cosmos_container("outputs")
+        outputs = container.query_items(
+            query="SELECT VALUE c.id FROM c WHERE (c.request_id = @request_id "
+                  "OR c.id = @request_id OR "
+                  "ARRAY_CONTAINS(c.request_ids, @request_id)) "
+                  "AND c.completed = true",
+            parameters=[{"name": "@request_id", "value": request_id}])
+        async for _ in outputs:
+            status_cache[request_id] = "Saved"
+            break
+        else:
+            raise HTTPException(
+                status_code=404, detail="Request ID not found")
     return {"status": status_cache.get(request_id)}
 
 
 @app.post("/status/{request_id}")
 async def update_status(request_id: str, statusBody: StatusBody):
     status_cache[request_id] = statusBody.status
+    if request_id in queued_requests and statusBody.status != "Queued":
+        priority, enqueued_at = queued_requests.pop(request_id)
+        queue_waits[priority].append(time.time() - enqueued_at)
+    if statusBody.status in ("Saved", "Failed"):
+        for inflight_key, (inflight_request_id, _) in list(
+                inflight_requests.items()):
+            if inflight_request_id == request_id:
+                del inflight_requests[inflight_key]
     return {"status": status_cache[request_id]}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Queue wait of the requests of each priority class, from the time they
+    # are queued until a worker starts them
+    metrics = {}
+    for priority, waits in queue_waits.items():
+        waits = sorted(waits)
+        metrics[priority] = {
+            "queued": sum(1 for queued_priority, _ in queued_requests.values()
+                          if queued_priority == priority),
+            "started": len(waits),
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p50_wait": waits[len(waits) // 2] if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max_wait": waits[-1] if waits else 0.0
+        }
+    return metrics
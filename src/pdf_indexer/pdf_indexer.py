@@ -1,16 +1,24 @@
 import os
+import httpx
+import importlib.util
 import json
 import uuid
+import math
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 from azure.servicebus.aio import ServiceBusClient
 from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from openai import AzureOpenAI
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents.base import Document
+from pypdf import PdfReader
 import tiktoken
 
 load_dotenv(override=True)
@@ -22,6 +30,39 @@ blob_service_client = BlobServiceClient.from_connection_string(
     os.getenv("STORAGE_CONNECTION_STRING"))
 container_name = "uploads"
 
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# Number of worker processes used to extract the text of large PDFs and
+# minimum number of pages handled by a single extraction task.
+pdf_extract_processes = int(
+    os.getenv("PDF_EXTRACT_PROCESSES", os.cpu_count() or 1))
+pdf_min_pages_per_task = int(os.getenv("PDF_MIN_PAGES_PER_TASK", "20"))
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+input_summary_workers = int(os.getenv("INPUT_SUMMARY_WORKERS", "4"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
 
 class Input:
     id: str
@@ -36,6 +77,7 @@ class Input:
     topics: list
     entities: list
     content: str
+    summary: str
 
     def to_dict(self):
         return {
@@ -50,7 +92,8 @@ class Input:
             "thumbnail_url": self.thumbnail_url,
             "topics": self.topics,
             "entities": self.entities,
-            "content": self.content
+            "content": self.content,
+            "summary": self.summary
         }
 
 
@@ -70,17 +113,138 @@ async def main():
                     await receiver.complete_message(message)
                     input = index_pdf(file_location)
                     update_status(pdf_input['request_id'], "Indexed")
-                    save_to_cosmosdb(input)
+                    await save_to_cosmosdb(input)
                     update_status(pdf_input['request_id'], "Saved")
 
 
-def save_to_cosmosdb(input: Input):
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database_name = "autopodcaster"
-    database = client.get_database_client(database_name)
-    container_name = "inputs"
-    container = database.get_container_client(container_name)
-    container.create_item(body=input.to_dict())
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so that the
+    # loop is not blocked while it is written.
+    container = get_cosmos_container("inputs")
+    await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        openai_clients["http"] = httpx.Client(**get_http_client_options())
+    return openai_clients["http"]
+
+
+def get_azure_openai_client() -> AzureOpenAI:
+    """Get the Azure OpenAI client of the process, created on first use"""
+    if "azure_openai" not in openai_clients:
+        openai_clients["azure_openai"] = AzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_http_client()
+        )
+    return openai_clients["azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_azure_openai_client()
+    return azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ]).choices[0].message.content.strip()
+
+
+def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    with ThreadPoolExecutor(max_workers=input_summary_workers) as executor:
+        while len(parts) > 1:
+            summaries = executor.map(
+                lambda part: summarize_text(title, part), parts)
+            parts = text_splitter.split_text('\n\n'.join(summaries))
+    return summarize_text(title, parts[0])
 
 
 def update_status(request_id: str, status: str):
@@ -102,11 +266,7 @@ def index_pdf(file_location: str):
     with open(download_file_path, "wb") as download_file:
         download_file.write(blob_client.download_blob().readall())
 
-    loader = PyPDFLoader(download_file_path)
-    documents = loader.load()
-
-    title = documents[0].metadata.get('title', 'Unknown Title')
-    description = documents[0].metadata.get('description', '')
+    title, description, page_count = read_pdf_info(download_file_path)
     url = file_location
 
     input = Input()
@@ -122,26 +282,12 @@ def index_pdf(file_location: str):
     input.topics = []
     input.entities = []
 
-    for document in documents:
-        document.metadata['id'] = input.id
-        document.metadata['title'] = title
-        document.metadata['source'] = url
-        document.metadata['description'] = description
-        document.metadata['thumbnail_url'] = ''
-        document.metadata['type'] = 'pdf'
-
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=200
     )
-    splits = text_splitter.split_documents(documents)
 
-    azure_openai_embeddings = AzureOpenAIEmbeddings(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-        azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS']
-    )
+    azure_openai_embeddings = get_azure_openai_embeddings()
 
     index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
     if index_name is None or index_name == "":
@@ -153,15 +299,120 @@ def index_pdf(file_location: str):
         index_name=index_name,
         embedding_function=azure_openai_embeddings.embed_query,
     )
-    vector_store.add_documents(documents=splits)
 
-    input.content = '\n\n'.join([doc.page_content for doc in documents])
+    # Pages are extracted in parallel and come back in page order, one
+    # page range at a time, so each range is chunked and embedded while the
+    # next ones are still being extracted.
+    page_contents = []
+    for documents in load_pdf_pages(download_file_path, page_count):
+        for document in documents:
+            document.metadata['id'] = input.id
+            document.metadata['title'] = title
+            document.metadata['source'] = url
+            document.metadata['description'] = description
+            document.metadata['thumbnail_url'] = ''
+            document.metadata['type'] = 'pdf'
+            page_contents.append(document.page_content)
+
+        splits = text_splitter.split_documents(documents)
+        if len(splits) > 0:
+            vector_store.add_documents(documents=splits)
+
+    input.content = '\n\n'.join(page_contents)
+    input.summary = summarize_input(input.title, input.content)
 
     os.remove(download_file_path)
 
     return input
 
 
+def read_pdf_info(file_path: str):
+    """Read the title, description and page count of a PDF
+
+    Args:
+        file_path (str): Path of the PDF file
+
+    Returns:
+        Tuple with the title, the description and the number of pages
+    """
+    reader = PdfReader(file_path)
+    metadata = reader.metadata
+    title = metadata.title if metadata and metadata.title else 'Unknown Title'
+    description = metadata.subject if metadata and metadata.subject else ''
+    return title, description, len(reader.pages)
+
+
+def get_page_ranges(page_count: int, processes: int,
+                    min_pages_per_task: int):
+    """Split the pages of a PDF into contiguous ranges
+
+    There are a few ranges per process so that slow pages do not leave the
+    other processes idle, but never less than min_pages_per_task pages per
+    range.
+
+    Args:
+        page_count (int): Number of pages
+        processes (int): Number of extraction processes
+        min_pages_per_task (int): Minimum number of pages per range
+
+    Returns:
+        List of (start, end) page ranges, end excluded
+    """
+    pages_per_task = max(min_pages_per_task,
+                         math.ceil(page_count / (max(processes, 1) * 4)), 1)
+    return [(start, min(start + pages_per_task, page_count))
+            for start in range(0, page_count, pages_per_task)]
+
+
+def extract_pages(file_path: str, start: int, end: int):
+    """Extract the text of a range of pages, run in a worker process
+
+    Args:
+        file_path (str): Path of the PDF file
+        start (int): First page of the range
+        end (int): Page after the last page of the range
+
+    Returns:
+        List with the text of each page of the range
+    """
+    reader = PdfReader(file_path)
+    return [reader.pages[page].extract_text() for page in range(start, end)]
+
+
+def load_pdf_pages(file_path: str, page_count: int):
+    """Load the pages of a PDF, one page range at a time and in page order
+
+    Small PDFs are extracted in the current process, larger ones are split
+    in page ranges extracted by a pool of worker processes.
+
+    Args:
+        file_path (str): Path of the PDF file
+        page_count (int): Number of pages
+
+    Yields:
+        List of documents, one per page, for each page range
+    """
+    page_ranges = get_page_ranges(
+        page_count, pdf_extract_processes, pdf_min_pages_per_task)
+
+    def to_documents(start, texts):
+        return [Document(page_content=text,
+                         metadata={'source': file_path, 'page': start + i})
+                for i, text in enumerate(texts)]
+
+    if pdf_extract_processes <= 1 or len(page_ranges) <= 1:
+        for start, end in page_ranges:
+            yield to_documents(start, extract_pages(file_path, start, end))
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=min(pdf_extract_processes, len(page_ranges))) as executor:
+        futures = [executor.submit(extract_pages, file_path, start, end)
+                   for start, end in page_ranges]
+        for (start, _), future in zip(page_ranges, futures):
+            yield to_documents(start, future.result())
+
+
 def get_file(file_name: str):
     """Get file path
 
@@ -177,6 +428,16 @@ def get_file(file_name: str):
     return os.path.join(output_folder, file_name)
 
 
-while (True):
-    asyncio.run(main())
-    asyncio.sleep(5)
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+
+# The worker processes re-import this module, only poll the queue from the
+# main process.
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+"""Tests of the split of the PDFs in page ranges and of the extraction of
+their pages"""
+import os
+
+# The clients are created when the module is imported, they do not connect
+# until they are used.
+os.environ.setdefault(
+    "STORAGE_CONNECTION_STRING",
+    "DefaultEndpointsProtocol=https;AccountName=test;"
+    "AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+
+import pdf_indexer  # noqa: E402
+from pdf_indexer import get_page_ranges, load_pdf_pages  # noqa: E402
+
+
+def make_pdf(path, page_count):
+    """Write a PDF whose page i contains the text "Page i" """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+                   " ".join(f"{4 + 2 * page} 0 R"
+                            for page in range(page_count)), page_count),
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for page in range(page_count):
+        content = f"BT /F1 12 Tf 72 720 Td (Page {page}) Tj ET"
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {5 + 2 * page} 0 R >>")
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\n"
+                       "endstream")
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, pdf_object in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{pdf_object}\nendobj\n".encode("latin-1")
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+    pdf += (f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n").encode()
+    path.write_bytes(pdf)
+    return str(path)
+
+
+def test_page_ranges_of_an_empty_pdf():
+    assert get_page_ranges(0, 4, 1) == []
+
+
+def test_page_ranges_with_fewer_pages_than_processes():
+    assert get_page_ranges(3, 8, 1) == [(0, 1), (1, 2), (2, 3)]
+    assert get_page_ranges(3, 8, 20) == [(0, 3)]
+
+
+def test_page_ranges_cover_the_pages_in_order():
+    page_ranges = get_page_ranges(101, 4, 1)
+
+    assert len(page_ranges) == 15
+    assert page_ranges[0] == (0, 7)
+    assert page_ranges[-1] == (98, 101)
+    assert all(end == next_start for (_, end), (next_start, _)
+               in zip(page_ranges, page_ranges[1:]))
+    assert get_page_ranges(101, 0, 1) == [(0, 26), (26, 52), (52, 78),
+                                          (78, 101)]
+
+
+def test_load_pdf_pages_of_an_empty_pdf(tmp_path):
+    assert list(load_pdf_pages(str(tmp_path / "empty.pdf"), 0)) == []
+
+
+def test_load_pdf_pages_with_fewer_pages_than_processes(tmp_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(pdf_indexer, "pdf_extract_processes", 4)
+    monkeypatch.setattr(pdf_indexer, "pdf_min_pages_per_task", 1)
+    file_path = make_pdf(tmp_path / "document.pdf", 3)
+
+    page_ranges = list(load_pdf_pages(file_path, 3))
+
+    assert len(page_ranges) == 3
+    documents = [document for documents in page_ranges
+                 for document in documents]
+    assert [document.page_content for document in documents] == [
+        "Page 0", "Page 1", "Page 2"]
+    assert [document.metadata["page"] for document in documents] == [0, 1, 2]
+
+
+def test_load_pdf_pages_in_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_indexer, "pdf_extract_processes", 1)
+    monkeypatch.setattr(pdf_indexer, "pdf_min_pages_per_task", 2)
+    file_path = make_pdf(tmp_path / "document.pdf", 5)
+
+    page_ranges = list(load_pdf_pages(file_path, 5))
+
+    assert [[document.metadata["page"] for document in documents]
+            for documents in page_ranges] == [[0, 1], [2, 3], [4]]
+    assert page_ranges[2][0].page_content == "Page 4"
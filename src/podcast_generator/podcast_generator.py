@@ -1,22 +1,41 @@
 from dotenv import load_dotenv
-from azure.servicebus.aio import ServiceBusClient
-from azure.cosmos import CosmosClient
+from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
+from azure.servicebus import ServiceBusMessage
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
 from openai import AzureOpenAI
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.documents.base import Document
 from langchain_openai import AzureChatOpenAI
 from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 import azure.cognitiveservices.speech as speechsdk
 import json
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, BlobBlock, ContentSettings
 import datetime
 import os
+import httpx
+import time
+import threading
+import sqlite3
+import hashlib
+import tiktoken
+import importlib.util
 import json
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+import re
+import base64
+import queue
+import collections
+import subprocess
+import tempfile
 
 load_dotenv(override=True)
 
@@ -29,13 +48,362 @@ container_name = "downloads"
 downloads_sas_token = os.getenv("DOWNLOADS_SAS_TOKEN")
 subject_space_endpoint = os.getenv("SUBJECT_SPACE_ENDPOINT")
 
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+# Persistent cache of the chat completions sent with temperature 0, whose
+# responses are deterministic. Bypassing the cache sends every prompt to the
+# model again and refreshes the cached responses.
+llm_cache_path = os.getenv(
+    "LLM_CACHE_PATH", os.path.join("cache", "llm_responses.db"))
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+llm_cache_max_age_days = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30"))
+llm_cache_bypass = os.getenv("LLM_CACHE_BYPASS", "false").lower() == "true"
+
+# Number of script lines styled with SSML at the same time and number of
+# attempts for each line.
+ssml_max_concurrency = int(os.getenv("SSML_MAX_CONCURRENCY", "8"))
+ssml_line_retries = int(os.getenv("SSML_LINE_RETRIES", "3"))
+
+# How the lines of the script are styled with SSML: "llm" asks GPT-4o to
+# style each line, "rules" builds the SSML locally from the intonations.
+ssml_mode = os.getenv("SSML_MODE", "llm")
+
+# Speech synthesis: backend ("azure" or "local", a stand-in for tests),
+# number of segments synthesized at the same time, maximum size of a segment
+# (0 for one segment per speaker turn) and cache of the synthesized segments.
+speech_backend = os.getenv("SPEECH_BACKEND", "azure")
+speech_max_concurrency = int(os.getenv("SPEECH_MAX_CONCURRENCY", "4"))
+speech_segment_max_chars = int(os.getenv("SPEECH_SEGMENT_MAX_CHARS", "0"))
+speech_cache_path = os.getenv(
+    "SPEECH_CACHE_PATH", os.path.join("cache", "speech_segments.db"))
+speech_cache_max_bytes = int(
+    os.getenv("SPEECH_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+speech_cache_lock = threading.Lock()
+speech_sample_rate = 24000
+
+# Format and bitrate of the podcast audio, encoded with ffmpeg while it is
+# synthesized and uploaded to Blob Storage in blocks of the given size.
+podcast_audio_format = os.getenv("PODCAST_AUDIO_FORMAT", "mp3")
+podcast_audio_bitrate = os.getenv("PODCAST_AUDIO_BITRATE", "64k")
+podcast_upload_block_bytes = int(
+    os.getenv("PODCAST_UPLOAD_BLOCK_BYTES", str(4 * 1024 * 1024)))
+
+# How the podcast is delivered: "file" uploads a single audio file, "hls"
+# publishes a playlist and segments of the given length while it is
+# synthesized.
+podcast_delivery = os.getenv("PODCAST_DELIVERY", "file")
+podcast_hls_segment_seconds = int(
+    os.getenv("PODCAST_HLS_SEGMENT_SECONDS", "10"))
+
+# Whether the script is streamed by the model, each line being styled and
+# synthesized as soon as it has been written.
+podcast_script_streaming = os.getenv(
+    "PODCAST_SCRIPT_STREAMING", "true").lower() == "true"
+
+# How the script is written: "single" writes it with one completion,
+# "sections" writes the sections of the outline concurrently, each with its
+# own retrieved context.
+podcast_script_mode = os.getenv("PODCAST_SCRIPT_MODE", "single")
+podcast_section_workers = int(os.getenv("PODCAST_SECTION_WORKERS", "4"))
+
+# Whether the script is constrained by a JSON schema and number of attempts
+# to regenerate an invalid line before it is fixed by rules or dropped.
+podcast_script_structured = os.getenv(
+    "PODCAST_SCRIPT_STRUCTURED", "true").lower() == "true"
+podcast_repair_retries = int(os.getenv("PODCAST_REPAIR_RETRIES", "2"))
+
+# Completed podcasts younger than this, generated for the same subject,
+# inputs and settings, are reused instead of generating a new one (0
+# disables the reuse).
+output_reuse_max_age_hours = float(
+    os.getenv("OUTPUT_REUSE_MAX_AGE_HOURS", "24"))
+
+# Retrieval of the context of a podcast, done once and shared by the outline
+# and the script: number of chunks kept by maximal marginal relevance out of
+# the fetched ones, maximum number of chunks of a same input and maximum
+# number of tokens of the context.
+podcast_retrieval_k = int(os.getenv("PODCAST_RETRIEVAL_K", "20"))
+podcast_retrieval_fetch_k = int(os.getenv("PODCAST_RETRIEVAL_FETCH_K", "60"))
+podcast_retrieval_lambda = float(os.getenv("PODCAST_RETRIEVAL_LAMBDA", "0.5"))
+podcast_max_chunks_per_input = int(
+    os.getenv("PODCAST_MAX_CHUNKS_PER_INPUT", "4"))
+podcast_context_max_tokens = int(
+    os.getenv("PODCAST_CONTEXT_MAX_TOKENS", "6000"))
+
+# Scheduling of the podcast jobs: maximum number of podcasts generated at the
+# same time by the worker, maximum number of received jobs waiting per
+# priority class and one job out of PODCAST_SCHEDULER_BATCH_EVERY taken from
+# the batch class while interactive jobs are waiting (0 for strict priority).
+podcast_max_concurrent_jobs = int(
+    os.getenv("PODCAST_MAX_CONCURRENT_JOBS", "2"))
+podcast_scheduler_buffer = int(os.getenv("PODCAST_SCHEDULER_BUFFER", "4"))
+podcast_scheduler_batch_every = int(
+    os.getenv("PODCAST_SCHEDULER_BATCH_EVERY", "4"))
+# Queue of each priority class, from the highest to the lowest priority
+podcast_queues = {"interactive": "podcast", "batch": "podcast-batch"}
+# The messages of the jobs are settled once the jobs are finished, their locks
+# are renewed until then for at most PODCAST_MAX_LOCK_RENEWAL_SECONDS.
+podcast_max_lock_renewal_seconds = int(
+    os.getenv("PODCAST_MAX_LOCK_RENEWAL_SECONDS", "3600"))
+
+# Codec, ffmpeg format, file extension and content type of each format.
+podcast_audio_formats = {
+    "mp3": ("libmp3lame", "mp3", "mp3", "audio/mpeg"),
+    "opus": ("libopus", "ogg", "opus", "audio/ogg"),
+    "wav": ("pcm_s16le", "wav", "wav", "audio/wav"),
+}
+
+
+class LLMResponseCache:
+    """Persistent cache of the chat completion responses of temperature 0
+    prompts, keyed by the hash of the deployment, the messages and the
+    parameters of the request
+
+    The entries older than max_age_days are dropped and the least recently
+    used ones are evicted when the cache is larger than max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age_days: float,
+                 bypass: bool):
+        cache_folder = os.path.dirname(path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "status INTEGER, headers TEXT, body BLOB, size INTEGER, "
+            "created_at REAL, last_used REAL)")
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, request: httpx.Request):
+        """Get the cache key of a request
+
+        Args:
+            request (httpx.Request): Request sent to Azure OpenAI
+
+        Returns:
+            Cache key, or None if the response of the request is not
+            deterministic or not a chat completion
+        """
+        if request.method != "POST" or \
+                not request.url.path.endswith("/chat/completions"):
+            return None
+        body = json.loads(request.content)
+        if body.get("temperature") != 0 or body.get("stream"):
+            return None
+        key = json.dumps({"path": request.url.path, "body": body},
+                         sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Get a cached response
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Tuple with the status code, the headers and the body, or None
+        """
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body FROM responses WHERE key = ? "
+                "AND created_at >= ?",
+                (key, time.time() - self.max_age_seconds)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key))
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key: str, status: int, headers: dict, body: bytes):
+        """Store a response and evict the old and least recently used ones
+
+        Args:
+            key (str): Cache key
+            status (int): Status code
+            headers (dict): Headers
+            body (bytes): Body
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, json.dumps(headers), body, len(body), now, now))
+            self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (now - self.max_age_seconds,))
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, size in self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                    ).fetchall():
+                if total_size <= self.max_bytes:
+                    break
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (old_key,))
+                total_size -= size
+
+    def get_metrics(self):
+        """Get the hit rate metrics of the cache
+
+        Returns:
+            Dictionary with the number of hits and misses and the hit rate
+        """
+        requests_count = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests_count if requests_count else 0.0
+        }
+
+
+def build_cached_response(request: httpx.Request, status: int,
+                          headers: dict, body: bytes) -> httpx.Response:
+    """Build the response returned by the caching transports"""
+    return httpx.Response(status, headers=headers, content=body,
+                          request=request)
+
+
+def get_cacheable_headers(response: httpx.Response) -> dict:
+    """Get the headers of a response that still apply to its decoded body"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length",
+                                    "transfer-encoding")}
+
+
+class CachingTransport(httpx.BaseTransport):
+    """HTTP transport answering the deterministic chat completions from the
+    LLM response cache"""
+
+    def __init__(self, transport: httpx.BaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = self.transport.handle_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    def close(self):
+        self.transport.close()
+
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Get the LLM response cache of the process, created on first use"""
+    if "llm_cache" not in openai_clients:
+        openai_clients["llm_cache"] = LLMResponseCache(
+            llm_cache_path, llm_cache_max_bytes, llm_cache_max_age_days,
+            llm_cache_bypass)
+    return openai_clients["llm_cache"]
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["http"] = httpx.Client(
+            timeout=options.pop("timeout"),
+            transport=CachingTransport(httpx.HTTPTransport(**options),
+                                       get_llm_response_cache()))
+    return openai_clients["http"]
+
+
+def get_azure_openai_client() -> AzureOpenAI:
+    """Get the Azure OpenAI client of the process, created on first use"""
+    if "azure_openai" not in openai_clients:
+        openai_clients["azure_openai"] = AzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_http_client()
+        )
+    return openai_clients["azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+def get_azure_chat_openai() -> AzureChatOpenAI:
+    """Get the chat model of the process, created on first use"""
+    if "chat" not in openai_clients:
+        openai_clients["chat"] = AzureChatOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT'],
+            temperature=0,
+            top_p=1,
+            http_client=get_http_client()
+        )
+    return openai_clients["chat"]
+
+
 # Define the embeddings model
-azure_openai_embeddings = AzureOpenAIEmbeddings(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-        azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS']
-)
+azure_openai_embeddings = get_azure_openai_embeddings()
 
 
 class Output:
@@ -48,6 +416,15 @@ class Output:
     outline: str
     content: str
     ssml: str
+    audio: dict
+    request_id: str
+    # Requests served by the podcast, the first one and the ones it was
+    # reused for
+    request_ids: list
+    fingerprint: str
+    generation_settings: dict
+    generation_fingerprint: str
+    completed: bool
 
     def to_dict(self):
         return {
@@ -59,36 +436,275 @@ class Output:
             "subject_id": self.subject_id,
             "outline": self.outline,
             "content": self.content,
-            "ssml": self.ssml
+            "ssml": self.ssml,
+            "audio": self.audio,
+            "request_id": self.request_id,
+            "request_ids": self.request_ids,
+            "fingerprint": self.fingerprint,
+            "generation_settings": self.generation_settings,
+            "generation_fingerprint": self.generation_fingerprint,
+            "completed": self.completed
         }
 
 
+class JobScheduler:
+    """Scheduler of the jobs received by the worker
+
+    The interactive jobs are taken before the batch ones, except one job out
+    of batch_every which is taken from the batch class so that bulk runs keep
+    progressing. Within a class, the tenants are served in turn so that a
+    tenant with many jobs does not delay the others. The time the jobs waited
+    in the queue and in the scheduler is recorded per class.
+    """
+
+    def __init__(self, priorities: list, batch_every: int):
+        self.priorities = priorities
+        self.batch_every = batch_every
+        self.picks = 0
+        # Jobs of each class, grouped per tenant in the order they are served
+        self.jobs = {priority: collections.OrderedDict()
+                     for priority in priorities}
+        self.waits = {priority: collections.deque(maxlen=1000)
+                      for priority in priorities}
+
+    def pending(self, priority: str):
+        """Get the number of jobs of a class waiting to be started"""
+        return sum(len(jobs) for jobs in self.jobs[priority].values())
+
+    def push(self, priority: str, job: dict, message=None):
+        """Add a job received from the queue of a class
+
+        Args:
+            priority (str): Priority class of the job
+            job (dict): Message of the job
+            message: Received message, settled once the job is finished
+        """
+        tenant_id = job.get('tenant_id', 'default')
+        self.jobs[priority].setdefault(
+            tenant_id, collections.deque()).append((job, message))
+
+    def pop(self):
+        """Take the next job to start
+
+        Returns:
+            Priority class, message of the job and received message, or None
+            if no job waits
+        """
+        priorities = [priority for priority in self.priorities
+                      if self.jobs[priority]]
+        if not priorities:
+            return None
+        self.picks += 1
+        priority = priorities[0]
+        if self.batch_every > 0 and self.picks % self.batch_every == 0:
+            priority = priorities[-1]
+        tenants = self.jobs[priority]
+        tenant_id, jobs = next(iter(tenants.items()))
+        job, message = jobs.popleft()
+        if jobs:
+            tenants.move_to_end(tenant_id)
+        else:
+            del tenants[tenant_id]
+        enqueued_at = job.get('enqueued_at')
+        if enqueued_at is not None:
+            self.waits[priority].append(time.time() - enqueued_at)
+        return priority, job, message
+
+    def get_metrics(self):
+        """Get the queue wait metrics of each class
+
+        Returns:
+            Dictionary with the number of jobs started, the average, median,
+            95th percentile and maximum wait in seconds of each class
+        """
+        metrics = {}
+        for priority, waits in self.waits.items():
+            waits = sorted(waits)
+            metrics[priority] = {
+                "started": len(waits),
+                "pending": self.pending(priority),
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "p50_wait": waits[len(waits) // 2] if waits else 0.0,
+                "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "max_wait": waits[-1] if waits else 0.0
+            }
+        return metrics
+
+
 async def main():
+    scheduler = JobScheduler(
+        list(podcast_queues), podcast_scheduler_batch_every)
+    wakeup = asyncio.Event()
     async with ServiceBusClient.from_connection_string(
             conn_str=servicebus_connection_string) as servicebus_client:
-        async with servicebus_client:
-            receiver = servicebus_client.get_queue_receiver('podcast')
-            async with receiver:
-                received_messages = await receiver.receive_messages(
-                    max_message_count=1, max_wait_time=5)
-                for message in received_messages:
-                    podcast_input = json.loads(str(message))
-                    subject_id = podcast_input['subject_id']
-                    update_status(podcast_input['request_id'], "Processing")
-                    await receiver.complete_message(message)
-                    output = process_podcast(subject_id)
-                    update_status(podcast_input['request_id'], "Processed")
-                    save_to_cosmosdb(output)
-                    update_status(podcast_input['request_id'], "Saved")
+        async with AutoLockRenewer(
+                max_lock_renewal_duration=podcast_max_lock_renewal_seconds
+        ) as lock_renewer:
+            receivers = {
+                priority: servicebus_client.get_queue_receiver(queue)
+                for priority, queue in podcast_queues.items()}
+            # The queues are polled concurrently, so that an interactive job
+            # is started as soon as it is received whatever the batch queue
+            # holds.
+            await asyncio.gather(
+                dispatch_jobs(scheduler, wakeup),
+                *[receive_jobs(scheduler, priority, receiver, lock_renewer,
+                               wakeup)
+                  for priority, receiver in receivers.items()])
+
+
+async def receive_jobs(scheduler: JobScheduler, priority: str, receiver,
+                       lock_renewer: AutoLockRenewer, wakeup: asyncio.Event):
+    """Receive the jobs of a class and add them to the scheduler
+
+    Args:
+        scheduler (JobScheduler): Scheduler of the jobs
+        priority (str): Priority class of the queue
+        receiver: Receiver of the queue of the class
+        lock_renewer (AutoLockRenewer): Renewer of the locks of the messages
+        wakeup (asyncio.Event): Event set when jobs are received
+    """
+    while (True):
+        # Each class only receives the jobs it can buffer, so that a backlog
+        # of batch jobs never keeps interactive jobs in the queue.
+        free = podcast_scheduler_buffer - scheduler.pending(priority)
+        if free <= 0:
+            await asyncio.sleep(1)
+            continue
+        received_messages = await receiver.receive_messages(
+            max_message_count=free, max_wait_time=5)
+        for message in received_messages:
+            # The message stays locked until the job is finished, so that
+            # it is received again if the worker stops before.
+            lock_renewer.register(receiver, message)
+            scheduler.push(priority, json.loads(str(message)),
+                           (receiver, message))
+        if received_messages:
+            wakeup.set()
+
+
+async def dispatch_jobs(scheduler: JobScheduler, wakeup: asyncio.Event):
+    """Start the jobs of the scheduler as long as the worker has capacity
+
+    Args:
+        scheduler (JobScheduler): Scheduler of the jobs
+        wakeup (asyncio.Event): Event set when jobs are received or finished
+    """
+    running = set()
+    while (True):
+        wakeup.clear()
+        running = {task for task in running if not task.done()}
+        while len(running) < podcast_max_concurrent_jobs:
+            job = scheduler.pop()
+            if job is None:
+                break
+            task = asyncio.create_task(run_job(*job))
+            task.add_done_callback(lambda _: wakeup.set())
+            running.add(task)
+        if running:
+            print(f"Queue wait: {scheduler.get_metrics()}")
+        await wakeup.wait()
+
+
+async def run_job(priority: str, podcast_input: dict, message=None):
+    """Generate the outputs of a job
+
+    The outputs other than the podcast are fanned out to their generators
+    with the context and the outline retrieved and drafted once for all the
+    outputs of the job. The message of the job is completed once all the
+    outputs are generated or fanned out, and dead-lettered if the job fails.
+
+    Args:
+        priority (str): Priority class of the job
+        podcast_input (dict): Message of the job
+        message: Receiver and received message of the job
+    """
+    outputs = podcast_input.get('outputs') or [
+        {"output_type": "podcast", "request_id": podcast_input['request_id']}]
+    pending_request_ids = [output['request_id'] for output in outputs]
+    try:
+        for request_id in pending_request_ids:
+            update_status(request_id, "Processing")
+        subject_json = await asyncio.to_thread(
+            get_subject, podcast_input['subject_id'])
+        podcasts = [output for output in outputs
+                    if output['output_type'] == 'podcast']
+        fan_outs = [output for output in outputs
+                    if output['output_type'] != 'podcast']
+        # An identical podcast generated with the same settings is looked up
+        # first, the retrieval and the outline are then only prepared for
+        # the outputs that are generated.
+        reused_podcast = None
+        if podcasts:
+            reused_podcast = await asyncio.to_thread(
+                find_reusable_podcast, subject_json)
+        prepared = None
+        if fan_outs:
+            prepared = await asyncio.to_thread(prepare_subject, subject_json)
+            async with ServiceBusClient.from_connection_string(
+                    conn_str=servicebus_connection_string) as servicebus_client:
+                for fan_out in fan_outs:
+                    queue = fan_out['output_type']
+                    if priority == "batch":
+                        queue += "-batch"
+                    async with servicebus_client.get_queue_sender(
+                            queue) as sender:
+                        await sender.send_messages(ServiceBusMessage(
+                            json.dumps(fan_out_message(
+                                podcast_input, fan_out, prepared),
+                                default=str)))
+                    pending_request_ids.remove(fan_out['request_id'])
+        for output in podcasts:
+            request_id = output['request_id']
+            if reused_podcast is not None:
+                print(f"Reusing output {reused_podcast.id}")
+                podcast = add_request_id(reused_podcast, request_id)
+            else:
+                podcast = await asyncio.to_thread(
+                    process_podcast, subject_json, request_id, prepared)
+            update_status(request_id, "Processed")
+            save_to_cosmosdb(podcast)
+            update_status(request_id, "Saved")
+            pending_request_ids.remove(request_id)
+    except Exception as e:
+        print(f"Failed to process the {priority} job "
+              f"{podcast_input['request_id']}: {e}")
+        for request_id in pending_request_ids:
+            update_status(request_id, "Failed")
+        if message is not None:
+            receiver, received_message = message
+            await receiver.dead_letter_message(
+                received_message, reason="JobFailed",
+                error_description=str(e)[:4096])
+    else:
+        if message is not None:
+            receiver, received_message = message
+            await receiver.complete_message(received_message)
+    print(f"LLM cache: {get_llm_response_cache().get_metrics()}")
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False))
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
 
 
 def save_to_cosmosdb(output: Output):
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database_name = "autopodcaster"
-    database = client.get_database_client(database_name)
-    container_name = "outputs"
-    container = database.get_container_client(container_name)
-    container.create_item(body=output.to_dict())
+    container = get_cosmos_container("outputs")
+    container.upsert_item(body=output.to_dict())
 
 
 def update_status(request_id: str, status: str):
@@ -97,24 +713,149 @@ def update_status(request_id: str, status: str):
         f"{output_status_endpoint}/status/{request_id}", json=status)
 
 
-def process_podcast(subject_id: str) -> Output:
-    response = requests.get(f"{subject_space_endpoint}/subject/{subject_id}")
-    if response.status_code != 200:
-        raise Exception("Subject not found")
-    subject_json = response.json()
+def get_output_fingerprint(subject: str, input_ids: list, output_type: str):
+    """Get the fingerprint of an output
+
+    The output API computes the same fingerprint, it must be kept in sync.
 
+    Args:
+        subject (str): Text of the subject
+        input_ids (list): Ids of the inputs of the subject
+        output_type (str): Type of output
+
+    Returns:
+        SHA-256 of the subject, the sorted input ids and the output type
+    """
+    key = json.dumps({"subject": subject, "inputs": sorted(input_ids),
+                      "type": output_type}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_generation_settings():
+    """Get the settings that change the podcast generated for a subject
+
+    Returns:
+        Dictionary with the settings
+    """
+    return {
+        "deployment": os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        "ssml_mode": ssml_mode,
+        "speech_backend": speech_backend,
+        "audio_format": podcast_audio_format,
+        "audio_bitrate": podcast_audio_bitrate,
+        "delivery": podcast_delivery,
+        "script_mode": podcast_script_mode,
+        "script_structured": podcast_script_structured,
+        "retrieval_k": podcast_retrieval_k,
+        "retrieval_fetch_k": podcast_retrieval_fetch_k,
+        "retrieval_lambda": podcast_retrieval_lambda,
+        "max_chunks_per_input": podcast_max_chunks_per_input,
+        "context_max_tokens": podcast_context_max_tokens
+    }
+
+
+def find_completed_output(generation_fingerprint: str):
+    """Find a completed podcast generated with the same fingerprint and
+    settings
+
+    Args:
+        generation_fingerprint (str): Fingerprint of the output and settings
+
+    Returns:
+        Most recent matching output or None
+    """
+    if output_reuse_max_age_hours <= 0:
+        return None
+    container = get_cosmos_container("outputs")
+    oldest = (datetime.datetime.now() - datetime.timedelta(
+        hours=output_reuse_max_age_hours)).isoformat()
+    for item in container.query_items(
+            query="SELECT * FROM c WHERE c.generation_fingerprint = "
+                  "@generation_fingerprint AND c.completed = true AND "
+                  "c.created_at >= @oldest ORDER BY c.created_at DESC",
+            parameters=[{"name": "@generation_fingerprint",
+                         "value": generation_fingerprint},
+                        {"name": "@oldest", "value": oldest}],
+            enable_cross_partition_query=True):
+        output = Output()
+        for name in Output.__annotations__:
+            setattr(output, name, item.get(name))
+        return output
+    return None
+
+
+def get_podcast_fingerprints(subject_json: dict):
+    """Get the fingerprint of the podcast of a subject and the fingerprint of
+    the podcast and its generation settings
+
+    Args:
+        subject_json (dict): Subject
+
+    Returns:
+        Tuple with the fingerprint, the generation settings and the
+        generation fingerprint
+    """
     subject = subject_json.get('subject', '')
     input_ids = subject_json.get('inputs', '')
-    index_name = subject_json.get('index_name', '')
+    fingerprint = get_output_fingerprint(subject, input_ids, "podcast")
+    generation_settings = get_generation_settings()
+    generation_fingerprint = hashlib.sha256(json.dumps(
+        {"fingerprint": fingerprint, "settings": generation_settings},
+        sort_keys=True).encode("utf-8")).hexdigest()
+    return fingerprint, generation_settings, generation_fingerprint
 
-    output = Output()
-    output.id = str(uuid.uuid4())
-    output.subject_id = subject_id
-    output.type = "podcast"
-    output.created_at = datetime.datetime.now().isoformat()
-    output.last_updated = output.created_at
-    output.url = ''
 
+def find_reusable_podcast(subject_json: dict):
+    """Find a completed podcast of the subject generated with the same
+    settings
+
+    Args:
+        subject_json (dict): Subject
+
+    Returns:
+        Most recent matching output or None
+    """
+    _, _, generation_fingerprint = get_podcast_fingerprints(subject_json)
+    return find_completed_output(generation_fingerprint)
+
+
+def add_request_id(output: Output, request_id: str) -> Output:
+    """Add a request served by a reused output to its request ids
+
+    The output is saved again with the request id, so that the status of the
+    request can be polled from any instance of the output API.
+
+    Args:
+        output (Output): Reused output
+        request_id (str): Id of the request
+
+    Returns:
+        The output
+    """
+    output.request_ids = list(output.request_ids or [output.request_id])
+    if request_id not in output.request_ids:
+        output.request_ids.append(request_id)
+    output.last_updated = datetime.datetime.now().isoformat()
+    return output
+
+
+def get_subject(subject_id: str) -> dict:
+    """Get a subject from the subject space
+
+    Args:
+        subject_id (str): Id of the subject
+
+    Returns:
+        Subject
+    """
+    response = requests.get(f"{subject_space_endpoint}/subject/{subject_id}")
+    if response.status_code != 200:
+        raise Exception("Subject not found")
+    return response.json()
+
+
+def get_question_answer_prompt() -> ChatPromptTemplate:
+    """Get the prompt answering a question from the retrieved context"""
     system_prompt = (
         "You are an assistant for question-answering tasks. "
         "Use the following pieces of retrieved context to answer "
@@ -125,21 +866,30 @@ def process_podcast(subject_id: str) -> Output:
         "{context}"
     )
 
-    prompt = ChatPromptTemplate.from_messages(
+    return ChatPromptTemplate.from_messages(
         [
             ("system", system_prompt),
             ("human", "{input}"),
         ]
     )
 
-    llm = AzureChatOpenAI(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-        azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT'],
-        temperature=0,
-        top_p=1
-    )
+
+def prepare_subject(subject_json: dict) -> dict:
+    """Retrieve the context of a subject and draft its outline
+
+    The retrieval and the outline are done once per request and shared by
+    the podcast and the outputs fanned out to the other generators.
+
+    Args:
+        subject_json (dict): Subject
+
+    Returns:
+        Dictionary with the subject, the retrieval function of its index,
+        the retrieved context and the outline
+    """
+    subject = subject_json.get('subject', '')
+    index_name = subject_json.get('index_name', '')
+    digest = subject_json.get('digest', '')
 
     vector_store = AzureSearch(
         azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
@@ -148,20 +898,107 @@ def process_podcast(subject_id: str) -> Output:
         embedding_function=azure_openai_embeddings.embed_query,
     )
 
+    # RETRIEVE CONTEXT
+
+    # The context is retrieved once and used for the outline and the script.
+    def retrieve(query):
+        return retrieve_context(vector_store, query)
+
+    context = retrieve(subject)
+
     # GENERATE OUTLINE
 
-    # TODO add the filtering here
-    retriever = vector_store.as_retriever()
+    question_answer_chain = create_stuff_documents_chain(
+        get_azure_chat_openai(), get_question_answer_prompt())
 
-    question_answer_chain = create_stuff_documents_chain(llm, prompt)
-    rag_chain = create_retrieval_chain(retriever, question_answer_chain)
+    # The outline is drafted from the digest of the whole subject, rolled up
+    # from the summaries of its inputs, when the subject space has one.
+    outline_context = context
+    if digest:
+        outline_context = [Document(page_content=digest)]
+
+    outline = question_answer_chain.invoke(
+        {"input": "Create an outline for a podcast on the following subject: " + subject + ".",
+         "context": outline_context})
+    print(outline)
+
+    return {
+        "subject": subject,
+        "retrieve": retrieve,
+        "context": context,
+        "outline": outline
+    }
+
+
+def fan_out_message(podcast_input: dict, fan_out: dict,
+                    prepared: dict) -> dict:
+    """Build the message of an output generated from the shared pass
+
+    Args:
+        podcast_input (dict): Message of the request
+        fan_out (dict): Output type, request id and fingerprint of the output
+        prepared (dict): Subject, context and outline of the shared pass
 
-    podcast_outline_response = rag_chain.invoke(
-        {"input": "Create an outline for a podcast on the following subject: " + subject + "."})
-    podcast_outline = podcast_outline_response['answer']
-    print(podcast_outline)
+    Returns:
+        Message of the generator of the output, with the outline and the
+        context so that they are not retrieved and drafted again
+    """
+    return {
+        "request_id": fan_out['request_id'],
+        "subject_id": podcast_input['subject_id'],
+        "output_type": fan_out['output_type'],
+        "fingerprint": fan_out.get('fingerprint', ''),
+        "priority": podcast_input.get('priority', 'interactive'),
+        "tenant_id": podcast_input.get('tenant_id', 'default'),
+        "enqueued_at": time.time(),
+        "subject": prepared['subject'],
+        "outline": prepared['outline'],
+        "context": [{"page_content": document.page_content,
+                     "metadata": document.metadata}
+                    for document in prepared['context']]
+    }
+
+
+def process_podcast(subject_json: dict, request_id: str = '',
+                    prepared: dict = None) -> Output:
+    fingerprint, generation_settings, generation_fingerprint = \
+        get_podcast_fingerprints(subject_json)
+
+    output = Output()
+    output.id = str(uuid.uuid4())
+    output.subject_id = subject_json['id']
+    output.type = "podcast"
+    output.created_at = datetime.datetime.now().isoformat()
+    output.last_updated = output.created_at
+    output.url = ''
+    output.content = ''
+    output.ssml = ''
+    output.audio = {}
+    output.request_id = request_id
+    output.request_ids = [request_id]
+    output.fingerprint = fingerprint
+    output.generation_settings = generation_settings
+    output.generation_fingerprint = generation_fingerprint
+    output.completed = False
+
+    # The retrieval and the outline are shared with the other outputs of the
+    # request when it has some.
+    if prepared is None:
+        prepared = prepare_subject(subject_json)
+    retrieve = prepared['retrieve']
+    context = prepared['context']
+    podcast_outline = prepared['outline']
     output.outline = podcast_outline
 
+    prompt = get_question_answer_prompt()
+    llm = get_azure_chat_openai()
+    question_answer_chain = create_stuff_documents_chain(llm, prompt)
+    script_chain = question_answer_chain
+    if podcast_script_structured:
+        script_chain = create_stuff_documents_chain(
+            llm.bind(response_format=get_script_response_format(True)),
+            prompt)
+
     # GENERATE SCRIPT
 
     podcast_prompt = f"""Create a podcast complete text based on the following reference outline document:
@@ -183,35 +1020,463 @@ def process_podcast(subject_id: str) -> Output:
     """
 
     formatted_podcast_prompt = podcast_prompt.format(podcast_outline)
-    podcast_script_response = rag_chain.invoke(
-        {"input": formatted_podcast_prompt})
-    podcast_script_text = str(podcast_script_response['answer']).replace(
-        "```json", "").replace("```", "")
-    print(podcast_script_text)
-    output.content = podcast_script_text
+    sections = []
+    if podcast_script_mode == "sections":
+        sections = split_outline_sections(podcast_outline)
+    if len(sections) > 1:
+        # The sections are written concurrently and their lines are
+        # returned in script order.
+        podcast_script = {"title": "", "text": []}
+        script_lines = stream_section_lines(
+            retrieve, script_chain, sections, podcast_script)
+    elif podcast_script_streaming:
+        script_chunks = []
+        script_lines = stream_script_lines(
+            script_chain, formatted_podcast_prompt, context, script_chunks)
 
-    ssml_script = generate_ssml_script(podcast_script_text)
-    output.ssml = ssml_script
-    print(ssml_script)
+    if podcast_script_streaming:
+        # Generation, styling and synthesis overlap: each line of the script
+        # is styled and synthesized as soon as the model has written it.
+        voices = []
+        segment_ssmls = stream_ssml_segments(
+            repair_script_lines(script_lines), voices)
+    else:
+        if len(sections) > 1:
+            for _ in script_lines:
+                pass
+            podcast_script_text = json.dumps(podcast_script)
+        else:
+            podcast_script_response = script_chain.invoke(
+                {"input": formatted_podcast_prompt, "context": context})
+            podcast_script_text = str(podcast_script_response).replace(
+                "```json", "").replace("```", "")
+        print(podcast_script_text)
+        output.content = podcast_script_text
+
+        ssml_script = generate_ssml_script(podcast_script_text)
+        output.ssml = ssml_script
+        print(ssml_script)
+        segment_ssmls = split_ssml_segments(ssml_script)
 
-    blob_url_with_sas = generate_podcast_audio(output.id, ssml_script)
+    segment_audios = iter_in_order(
+        synthesize_segment, segment_ssmls, speech_max_concurrency)
+    if podcast_delivery == "hls":
+        # The output is saved with the URL of the playlist as soon as the
+        # first segment can be played.
+        def on_first_segment(playlist_url):
+            output.url = playlist_url
+            save_to_cosmosdb(output)
+
+        blob_url_with_sas, audio_stats = generate_podcast_hls(
+            output.id, segment_audios, on_first_segment)
+    else:
+        blob_url_with_sas, audio_stats = generate_podcast_audio(
+            output.id, segment_audios)
     output.url = blob_url_with_sas
+    output.audio = audio_stats
+    output.completed = True
+
+    if podcast_script_streaming:
+        if len(sections) > 1:
+            output.content = json.dumps(podcast_script)
+        else:
+            output.content = "".join(script_chunks).replace(
+                "```json", "").replace("```", "")
+        print(output.content)
+        output.ssml = ssml_speak_start + "".join(voices) + "</speak>"
+        print(output.ssml)
 
     return output
 
 
+def count_tokens(text):
+    """Count the tokens of a text for the chat model
+
+    Args:
+        text (str): Text
+
+    Returns:
+        Number of tokens
+    """
+    if "tokenizer" not in openai_clients:
+        openai_clients["tokenizer"] = tiktoken.get_encoding("o200k_base")
+    return len(openai_clients["tokenizer"].encode(text))
+
+
+def retrieve_context(vector_store, query):
+    """Retrieve the context of a query, diverse and within a token budget
+
+    The chunks are selected by maximal marginal relevance, the duplicates
+    and the chunks above podcast_max_chunks_per_input for an input are
+    dropped and the chunks are packed in podcast_context_max_tokens tokens,
+    taking the best chunk of each input first so that all the inputs are
+    covered.
+
+    Args:
+        vector_store (AzureSearch): Index of the subject
+        query (str): Query
+
+    Returns:
+        List of documents
+    """
+    results = vector_store.max_marginal_relevance_search_with_score(
+        query, k=podcast_retrieval_k, fetch_k=podcast_retrieval_fetch_k,
+        lambda_mult=podcast_retrieval_lambda)
+
+    input_documents = {}
+    contents = set()
+    for document, _ in results:
+        if document.page_content in contents:
+            continue
+        contents.add(document.page_content)
+        input_documents.setdefault(document.metadata.get("id"), []).append(
+            document)
+
+    ranks = []
+    for documents in input_documents.values():
+        ranks.extend(enumerate(documents[:podcast_max_chunks_per_input]))
+    ranks.sort(key=lambda rank: rank[0])
+
+    context = []
+    tokens = 0
+    for _, document in ranks:
+        document_tokens = count_tokens(document.page_content)
+        if tokens + document_tokens <= podcast_context_max_tokens:
+            context.append(document)
+            tokens += document_tokens
+    print(f"Retrieved {len(context)} chunks of {len(input_documents)} inputs "
+          f"({tokens} tokens)")
+    return context
+
+
+def split_outline_sections(podcast_outline):
+    """Split the outline of a podcast in sections
+
+    The sections start at the numbered items that are not indented, e.g.
+    "1. Introduction" or "### 2. Key features", or at the most frequent
+    level of Markdown headings if the outline is not numbered. The text
+    before the first section is kept with it.
+
+    Args:
+        podcast_outline (str): Outline of the podcast
+
+    Returns:
+        List with the text of each section
+    """
+    lines = podcast_outline.splitlines()
+    starts = [index for index, line in enumerate(lines)
+              if OUTLINE_NUMBERED_PATTERN.match(line)]
+    if len(starts) < 2:
+        levels = [len(match.group(1)) for match in
+                  map(OUTLINE_HEADING_PATTERN.match, lines) if match]
+        if len(levels) == 0:
+            return [podcast_outline]
+        level = max(set(levels), key=levels.count)
+        starts = [index for index, line in enumerate(lines)
+                  if (match := OUTLINE_HEADING_PATTERN.match(line)) and
+                  len(match.group(1)) == level]
+    starts[0] = 0
+    return ["\n".join(lines[start:end]).strip()
+            for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+
+def get_section_title(section):
+    """Get the title of a section of the outline
+
+    Args:
+        section (str): Section of the outline
+
+    Returns:
+        First numbered line of the section, or its first line, without
+        Markdown
+    """
+    lines = section.splitlines()
+    numbered_lines = [line for line in lines
+                      if OUTLINE_NUMBERED_PATTERN.match(line)]
+    return (numbered_lines + lines)[0].strip("#* ")
+
+
+def generate_section_script(retrieve, question_answer_chain, sections,
+                            index):
+    """Write the dialogue of a section of the podcast
+
+    The context is retrieved for the section only and a short overview of
+    all the sections is shared by the prompts so that the sections follow
+    each other.
+
+    Args:
+        retrieve: Function retrieving the context of a query
+        question_answer_chain: Chain answering with the retrieved context
+        sections (list): Sections of the outline
+        index (int): Index of the section to write
+
+    Returns:
+        Dictionary with the title (first section only) and the lines of the
+        section
+    """
+    overview = "\n".join(
+        f"{number}. {get_section_title(section)}"
+        for number, section in enumerate(sections, start=1))
+    if index == 0:
+        role = ("This is the first section: the host Bill introduces the "
+                "podcast and the cohost Melinda before they start covering "
+                "the section. Also give the title of the podcast.")
+    elif index == len(sections) - 1:
+        role = ("This is the last section: it continues the conversation "
+                "without greetings and, once the section is covered, the host "
+                "Bill thanks the audience and closes the podcast.")
+    else:
+        role = ("This section continues the conversation: do not greet, do "
+                "not introduce the podcast and do not close it.")
+
+    section_prompt = f"""Write the dialogue of section {index + 1} of {len(sections)} of a podcast named "Advanced AI Podcast".
+
+    The podcast covers these sections:
+    {overview}
+
+    Section to write:
+    {sections[index]}
+
+    {role}
+    There are 2 participants in the podcast: the host Bill, the listener's podcast assistant, asks questions and the cohost Melinda, the expert in the podcast topic, answers them.
+    When you thanks someone, write "Thank you" and the name of the person without a comma. For example, "Thank you Bill".
+
+    Output as a JSON with the following fields:
+    - title: Title of the podcast, only for the first section
+    - text: an array of objects with the speaker, the intonation and the text to be spoken
+    If the host Bill is speaking the intonation can be one of these values: {json.dumps(Jason_styles)}
+    If the cohost Melinda is speaking the intonation can be one of these: {json.dumps(Aria_styles)}
+    Return only the json as plain text.
+    """
+
+    documents = retrieve(sections[index])
+    section_script_text = str(question_answer_chain.invoke(
+        {"input": section_prompt, "context": documents})).replace(
+        "```json", "").replace("```", "")
+    return parse_script(section_script_text)
+
+
+def stream_section_lines(retrieve, question_answer_chain, sections,
+                         podcast_script):
+    """Write the sections of the podcast concurrently and yield their lines
+    in script order
+
+    Args:
+        retrieve: Function retrieving the context of a query
+        question_answer_chain: Chain answering with the retrieved context
+        sections (list): Sections of the outline
+        podcast_script (dict): Filled with the title and the lines of the
+            podcast
+
+    Yields:
+        Lines of the script with the speaker, the intonation and the text
+    """
+    def generate(index):
+        return generate_section_script(
+            retrieve, question_answer_chain, sections, index)
+
+    for section_script in iter_in_order(
+            generate, range(len(sections)), podcast_section_workers):
+        if not podcast_script["title"]:
+            podcast_script["title"] = section_script.get("title", "")
+        for line in section_script["text"]:
+            podcast_script["text"].append(line)
+            yield line
+
+
 Jason_styles = ["Default", "Angry", "Cheerful", "Excited", "Friendly",
                 "Hopeful", "Sad", "Shouting", "Terrified", "Unfriendly", "Whispering"]
 Aria_styles = ["Default", "Chat", "Customer service", "Narration - professional", "Newscast - casual", "Newscast - formal",
                "Cheerful", "Empathetic", "Angry", "Sad", "Excited", "Friendly", "Terrified", "Shouting", "Unfriendly", "Whispering", "Hopeful"]
 
+# Style degree used by the rule-based SSML builder for each intonation,
+# 1 being the default intensity of the style.
+style_degrees = {"Angry": 1.3, "Excited": 1.4, "Shouting": 1.5,
+                 "Terrified": 1.3, "Whispering": 1.2, "Sad": 1.2,
+                 "Cheerful": 1.2, "Friendly": 1.1}
+
+# Beginning of the lines starting a section of the outline.
+OUTLINE_NUMBERED_PATTERN = re.compile(
+    r"^(?:#{1,6}\s*)?(?:\*\*)?(?:\d+|[IVX]+)[.)]\s")
+OUTLINE_HEADING_PATTERN = re.compile(r"^(#{1,6})\s")
+
+# Root element of the SSML of the podcast and of its segments.
+ssml_speak_start = "<speak version='1.0' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'>"
+
+# Elements that can be used in the text of a voice.
+ssml_elements = ["{https://www.w3.org/2001/mstts}express-as", "break",
+                 "prosody", "emphasis", "say-as", "s", "p", "sub"]
+# Rates allowed in the prosody elements, besides relative rates from -50% to
+# +100% or from 0.5 to 2 times the default rate. The pitch is not changed.
+ssml_prosody_rates = ["x-slow", "slow", "medium", "fast", "x-fast", "default"]
+SSML_RELATIVE_RATE_PATTERN = re.compile(r"^([+-]?\d+(?:\.\d+)?)(%?)$")
+
+
+def get_ssml_style_name(line_style):
+    """Get the name of the mstts:express-as style of an intonation
+
+    Args:
+        line_style (str): Intonation, e.g. "Narration - professional"
+
+    Returns:
+        Style name, e.g. "narration-professional"
+    """
+    return line_style.lower().replace(" - ", "-").replace(" ", "")
+
+
+# Intonations and voice of each speaker of the script.
+speaker_styles = {"Bill": Jason_styles, "Melinda": Aria_styles}
+speaker_voices = {"Bill": "en-US-AndrewMultilingualNeural",
+                  "Melinda": "en-US-AriaNeural"}
+
+ssml_style_names = [get_ssml_style_name(style)
+                    for style in set(Jason_styles + Aria_styles)]
+
+
+def add_ssml_style_with_rules(line, line_style, speaker):
+    """Add the SSML style to a line without calling a model
+
+    The intonation of the script is used as style when the voice of the
+    speaker supports it. The style degree depends on the intonation and is
+    raised for exclamations.
+
+    Args:
+        line (str): Text of the line
+        line_style (str): Intonation of the line
+        speaker (str): Speaker of the line
+
+    Returns:
+        Text of the line, escaped for XML, with SSML
+    """
+    styles = Jason_styles if speaker == 'Bill' else Aria_styles
+    text = escape(line)
+    if line_style not in styles or line_style == "Default":
+        return text
+    style_degree = style_degrees.get(line_style, 1.0)
+    if line.rstrip().endswith('!'):
+        style_degree += 0.2
+    style_degree = min(2.0, max(0.01, style_degree))
+    return f'<mstts:express-as style="{get_ssml_style_name(line_style)}" styledegree="{style_degree:g}">{text}</mstts:express-as>'
+
+
+def validate_ssml_rate(rate):
+    """Validate the rate of a prosody element
+
+    Args:
+        rate (str): Value of the rate attribute
+
+    Raises:
+        ValueError: If the rate is not allowed
+    """
+    if rate in ssml_prosody_rates:
+        return
+    match = SSML_RELATIVE_RATE_PATTERN.match(rate)
+    if match is not None:
+        value = float(match.group(1))
+        if match.group(2) == '%' and -50 <= value <= 100:
+            return
+        if match.group(2) == '' and 0.5 <= value <= 2:
+            return
+    raise ValueError(f"Rate {rate} is not allowed")
+
+
+def validate_ssml_elements(element, style_names=None):
+    """Validate the elements used in the text of a voice and their attributes
+
+    Args:
+        element: Parent element of the text
+        style_names (list): Styles supported by the voice, all the styles of
+            the speakers if None
+
+    Raises:
+        ValueError: If an element, a style or an attribute is not allowed
+    """
+    if style_names is None:
+        style_names = ssml_style_names
+    for child in element.iter():
+        if child is element:
+            continue
+        if child.tag not in ssml_elements:
+            raise ValueError(f"Element {child.tag} is not allowed")
+        if child.tag == ssml_elements[0]:
+            style = child.get('style', '').lower()
+            if style not in style_names:
+                raise ValueError(f"Style {style} is not allowed")
+            try:
+                style_degree = float(child.get('styledegree', '1'))
+            except ValueError:
+                style_degree = None
+            if style_degree is None or not 0.01 <= style_degree <= 2:
+                raise ValueError(
+                    f"Style degree {child.get('styledegree')} is not allowed")
+        if child.tag == 'prosody':
+            if child.get('pitch') is not None:
+                raise ValueError("Pitch changes are not allowed")
+            if child.get('rate') is not None:
+                validate_ssml_rate(child.get('rate'))
+
+
+def validate_ssml_line(styled_line, speaker=None):
+    """Check that a line with SSML can be put in a voice element
+
+    Args:
+        styled_line (str): Text of the line with SSML
+        speaker (str): Speaker of the line, whose voice must support the
+            styles, or None to allow the styles of all the speakers
+
+    Returns:
+        True if the line is well-formed, only uses allowed elements,
+        styles and attributes and has no code fence
+    """
+    if "```" in styled_line:
+        print("Invalid SSML line: code fence")
+        return False
+    style_names = None
+    if speaker in speaker_styles:
+        style_names = [get_ssml_style_name(style)
+                       for style in speaker_styles[speaker]]
+    try:
+        element = ET.fromstring(
+            f"<voice xmlns:mstts='https://www.w3.org/2001/mstts'>{styled_line}</voice>")
+        validate_ssml_elements(element, style_names)
+        return True
+    except (ET.ParseError, ValueError) as e:
+        print(f"Invalid SSML line: {e}")
+        return False
+
+
+def validate_ssml(ssml_text):
+    """Validate the SSML of a podcast before it is synthesized: a speak
+    element with a voice element per line, in the voice of a speaker, whose
+    text only uses allowed elements, styles supported by the voice and
+    allowed prosody attributes
+
+    Args:
+        ssml_text (str): SSML of the podcast
+
+    Raises:
+        ValueError: If the SSML is not valid
+    """
+    try:
+        speak = ET.fromstring(ssml_text)
+    except ET.ParseError as e:
+        raise ValueError(f"SSML is not well-formed: {e}")
+    if speak.tag != 'speak' or speak.get('version') != '1.0':
+        raise ValueError("SSML root must be a speak element with version 1.0")
+    voice_speakers = {voice: speaker
+                      for speaker, voice in speaker_voices.items()}
+    for voice in speak:
+        if voice.tag != 'voice' or not voice.get('name'):
+            raise ValueError("SSML speak element must only contain voices")
+        if voice.get('name') not in voice_speakers:
+            raise ValueError(f"Voice {voice.get('name')} is not allowed")
+        speaker = voice_speakers[voice.get('name')]
+        validate_ssml_elements(voice, [get_ssml_style_name(style)
+                                       for style in speaker_styles[speaker]])
+
 
 def add_ssml_and_style(line, line_style):
-    azure_openai_client = AzureOpenAI(
-        api_key=os.environ['AZURE_OPENAI_KEY'],
-        azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-        api_version=os.environ['AZURE_OPENAI_API_VERSION']
-    )
+    azure_openai_client = get_azure_openai_client()
     prompt_template = """Given following text and its entonation, rewrite the text with SSML
     Text: {text}
     Intonation:
@@ -250,74 +1515,893 @@ def add_ssml_and_style(line, line_style):
     return result
 
 
+def add_ssml_and_style_with_retry(line, line_style):
+    """Add the SSML style to a line, retrying when the call fails
+
+    A line that still fails after ssml_line_retries attempts is kept without
+    style, so that one line does not fail the whole podcast.
+
+    Args:
+        line (str): Text of the line
+        line_style (str): Intonation of the line
+
+    Returns:
+        Text of the line with SSML
+    """
+    for attempt in range(1, ssml_line_retries + 1):
+        try:
+            return add_ssml_and_style(line, line_style)
+        except Exception as e:
+            print(f"Error adding SSML to line (attempt {attempt}): {e}")
+            if attempt < ssml_line_retries:
+                time.sleep(2 ** attempt)
+    return escape(line)
+
+
+def style_script_line(line):
+    """Style a line of the script with SSML in the voice of its speaker
+
+    In llm mode, a line the model did not return as valid SSML is styled
+    with the rules.
+
+    Args:
+        line (dict): Line of the script with the speaker, the intonation and
+            the text
+
+    Returns:
+        Voice element of the line
+    """
+    if ssml_mode == 'rules':
+        styled_line = add_ssml_style_with_rules(
+            line['text'], line['intonation'], line['speaker'])
+    else:
+        styled_line = add_ssml_and_style_with_retry(
+            line['text'], line['intonation'])
+        if not validate_ssml_line(styled_line, line['speaker']):
+            styled_line = add_ssml_style_with_rules(
+                line['text'], line['intonation'], line['speaker'])
+
+    return f"<voice name='{speaker_voices[line['speaker']]}'>{styled_line}</voice>"
+
+
 def generate_ssml_script(podcast_script_text):
-    podcast_script_json = json.loads(str(podcast_script_text))
-    ssml_text = "<speak version='1.0' xmlns:mstts='https://www.w3.org/2001/mstts' xml:lang='en-US'>"
-    for line in podcast_script_json['text']:
-        speaker = line['speaker']
-        text = line['text']
-        if speaker == 'Bill':
+    lines = list(repair_script_lines(
+        parse_script(str(podcast_script_text))['text']))
 
-            ssml_text += f"<voice name='en-US-AndrewMultilingualNeural'>{add_ssml_and_style(line['text'], line['intonation'])}</voice>"
+    # The lines are styled concurrently, map returns them in script order.
+    with ThreadPoolExecutor(max_workers=ssml_max_concurrency) as executor:
+        voices = list(executor.map(style_script_line, lines))
 
-        else:
-            ssml_text += f"<voice name='en-US-AriaNeural'>{add_ssml_and_style(line['text'], line['intonation'])}</voice>"
-    ssml_text += "</speak>"
+    ssml_text = ssml_speak_start + "".join(voices) + "</speak>"
+    validate_ssml(ssml_text)
     return ssml_text
 
 
-def generate_podcast_audio(id, ssml_script):
-    speech_key = os.getenv("AZURE_SPEECH_KEY")
-    service_region = os.getenv("AZURE_SPEECH_REGION")
+def get_script_response_format(whole_script):
+    """Get the JSON schema constraining the script written by the model
+
+    Each line is constrained to a speaker and one of the intonations of its
+    voice.
+
+    Args:
+        whole_script (bool): Schema of the whole script if True, of a single
+            line otherwise
+
+    Returns:
+        Response format of the chat completion
+    """
+    line_schemas = [{
+        "type": "object",
+        "properties": {
+            "speaker": {"type": "string", "enum": [speaker]},
+            "intonation": {"type": "string", "enum": styles},
+            "text": {"type": "string"}
+        },
+        "required": ["speaker", "intonation", "text"],
+        "additionalProperties": False
+    } for speaker, styles in speaker_styles.items()]
+    if whole_script:
+        properties = {"title": {"type": "string"},
+                      "text": {"type": "array",
+                               "items": {"anyOf": line_schemas}}}
+    else:
+        properties = {"line": {"anyOf": line_schemas}}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "podcast_script" if whole_script else "podcast_line",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def parse_script(podcast_script_text):
+    """Parse the script written by the model, keeping the lines of a script
+    that is not valid JSON
+
+    Args:
+        podcast_script_text (str): Script written by the model
+
+    Returns:
+        Dictionary with the title and the lines of the script
+    """
+    try:
+        podcast_script = json.loads(podcast_script_text)
+        if isinstance(podcast_script, dict) and \
+                isinstance(podcast_script.get('text'), list):
+            return podcast_script
+    except json.JSONDecodeError:
+        pass
+    title_match = re.search(r'"title"\s*:\s*"((?:[^"\\]|\\.)*)"',
+                            podcast_script_text)
+    return {
+        "title": json.loads(f'"{title_match.group(1)}"') if title_match else "",
+        "text": ScriptLineParser().feed(podcast_script_text)
+    }
+
+
+def validate_script_line(line):
+    """Check a line of the script
+
+    Args:
+        line: Line of the script
+
+    Returns:
+        Reason why the line is invalid or None if it is valid
+    """
+    if not isinstance(line, dict) or "invalid_json" in line:
+        return "the line is not a valid JSON object"
+    if line.get('speaker') not in speaker_styles:
+        return f"the speaker must be one of {list(speaker_styles)}"
+    if line.get('intonation') not in speaker_styles[line['speaker']]:
+        return (f"the intonation of {line['speaker']} must be one of "
+                f"{speaker_styles[line['speaker']]}")
+    if not isinstance(line.get('text'), str) or not line['text'].strip():
+        return "the text must be a non empty string"
+    return None
+
+
+def repair_script_line(line, error, previous_line):
+    """Regenerate an invalid line of the script
+
+    Only the line is sent to the model, with the reason why it is invalid
+    and the previous line for context. If the model does not return a valid
+    line, the speaker and the intonation are fixed by rules, or the line is
+    dropped if it has no text.
+
+    Args:
+        line: Invalid line of the script
+        error (str): Reason why the line is invalid
+        previous_line (dict): Previous line of the script or None
+
+    Returns:
+        Valid line or None if the line is dropped
+    """
+    azure_openai_client = get_azure_openai_client()
+    raw_line = line.get("invalid_json") if isinstance(line, dict) and \
+        "invalid_json" in line else json.dumps(line)
+    for attempt in range(podcast_repair_retries):
+        try:
+            content = azure_openai_client.chat.completions.create(
+                model="gpt-4o",
+                temperature=0 if attempt == 0 else 0.5,
+                top_p=1,
+                response_format=get_script_response_format(False),
+                messages=[
+                    {"role": "system", "content": "You fix the lines of podcast scripts between the host Bill and the cohost Melinda."},
+                    {"role": "user", "content": (
+                        f"This line of the script is invalid because {error}:"
+                        f"\n{raw_line}\n\nPrevious line: "
+                        f"{json.dumps(previous_line)}\n\nRewrite the line "
+                        "keeping its text.")},
+                ]).choices[0].message.content
+            repaired_line = json.loads(content)["line"]
+            if validate_script_line(repaired_line) is None:
+                return repaired_line
+        except Exception as e:
+            print(f"Error repairing script line (attempt {attempt + 1}): {e}")
+
+    if not isinstance(line, dict) or not isinstance(line.get('text'), str) \
+            or not line['text'].strip():
+        print(f"Dropping script line: {raw_line}")
+        return None
+    speaker = line.get('speaker')
+    if speaker not in speaker_styles:
+        speaker = 'Melinda' if previous_line and \
+            previous_line['speaker'] == 'Bill' else 'Bill'
+    intonation = line.get('intonation')
+    if intonation not in speaker_styles[speaker]:
+        intonation = 'Default'
+    return {"speaker": speaker, "intonation": intonation,
+            "text": line['text']}
+
+
+def repair_script_lines(lines):
+    """Validate the lines of the script as they arrive and repair only the
+    invalid ones
+
+    Args:
+        lines: Iterator over the lines of the script
+
+    Yields:
+        Valid lines of the script
+    """
+    previous_line = None
+    for line in lines:
+        error = validate_script_line(line)
+        if error is not None:
+            print(f"Invalid script line, {error}: {line}")
+            line = repair_script_line(line, error, previous_line)
+            if line is None:
+                continue
+        previous_line = line
+        yield line
+
+
+class ScriptLineParser:
+    """Incremental parser of the JSON script written by the model
+
+    The script is fed as it is streamed and each entry of its text array is
+    returned as soon as its closing brace has been read. Anything before
+    the JSON object, like a code fence, is ignored and an entry that is not
+    valid JSON is returned as {"invalid_json": entry} to be repaired.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.containers = []
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.last_string = None
+        self.key = None
+        self.entry_start = None
+
+    def feed(self, text: str) -> list:
+        """Parse the next part of the script
+
+        Args:
+            text (str): Text streamed by the model
+
+        Returns:
+            List with the lines of the script completed by the text
+        """
+        self.buffer += text
+        lines = []
+        while self.position < len(self.buffer):
+            character = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif character == '\\':
+                    self.escaped = True
+                elif character == '"':
+                    self.in_string = False
+                    self.last_string = self.buffer[
+                        self.string_start:self.position + 1]
+            elif not self.containers and character != '{':
+                pass
+            elif character == '"':
+                self.in_string = True
+                self.string_start = self.position
+            elif character == ':' and len(self.containers) == 1:
+                self.key = json.loads(self.last_string)
+            elif character in '{[':
+                self.containers.append(character)
+                if self.containers == ['{', '[', '{'] and self.key == 'text':
+                    self.entry_start = self.position
+            elif character in '}]' and self.containers:
+                self.containers.pop()
+                if self.entry_start is not None and \
+                        self.containers == ['{', '[']:
+                    entry = self.buffer[self.entry_start:self.position + 1]
+                    try:
+                        lines.append(json.loads(entry))
+                    except json.JSONDecodeError:
+                        lines.append({"invalid_json": entry})
+                    self.entry_start = None
+            self.position += 1
+        return lines
+
+
+def stream_script_lines(question_answer_chain, podcast_prompt, context,
+                        script_chunks):
+    """Stream the script from the model and yield its lines as they are
+    written
+
+    Args:
+        question_answer_chain: Chain generating the script
+        podcast_prompt (str): Prompt of the script
+        context (list): Documents retrieved for the podcast
+        script_chunks (list): Filled with the text streamed by the model
+
+    Yields:
+        Lines of the script with the speaker, the intonation and the text
+    """
+    parser = ScriptLineParser()
+    for chunk in question_answer_chain.stream(
+            {"input": podcast_prompt, "context": context}):
+        script_chunks.append(chunk)
+        yield from parser.feed(chunk)
+
+
+def stream_ssml_segments(lines, voices):
+    """Style the lines of the script concurrently as they arrive and yield
+    the SSML of each one, in script order
 
+    Args:
+        lines: Iterator over the lines of the script
+        voices (list): Filled with the voice element of each line
+
+    Yields:
+        SSML of each line, validated
+    """
+    for voice in iter_in_order(style_script_line, lines, ssml_max_concurrency):
+        voices.append(voice)
+        segment_ssml = ssml_speak_start + voice + "</speak>"
+        validate_ssml(segment_ssml)
+        yield segment_ssml
+
+
+def iter_in_order(function, items, max_workers):
+    """Apply a function concurrently to items as they arrive and yield the
+    results in the order of the items
+
+    Unlike ThreadPoolExecutor.map, the items are not all read before the
+    first result is returned, so the items can come from a stream.
+
+    Args:
+        function: Function applied to each item
+        items: Iterable over the items
+        max_workers (int): Number of items processed at the same time
+
+    Yields:
+        Result of the function for each item
+    """
+    # At most max_workers results wait to be read, so the items are not read
+    # much faster than the results. When the generator is closed, or a
+    # result raises, the items not processed yet are cancelled.
+    pending = queue.Queue(maxsize=max_workers)
+    closed = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def put(future):
+        while not closed.is_set():
+            try:
+                pending.put(future, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        if future is not None:
+            future.cancel()
+        return False
+
+    def submit_items():
+        try:
+            for item in items:
+                if closed.is_set() or not put(
+                        executor.submit(function, item)):
+                    return
+        except Exception as e:
+            failed = Future()
+            failed.set_exception(e)
+            put(failed)
+            return
+        put(None)
+
+    threading.Thread(target=submit_items, daemon=True).start()
+    try:
+        while True:
+            future = pending.get()
+            if future is None:
+                break
+            yield future.result()
+    finally:
+        closed.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                future = pending.get_nowait()
+            except queue.Empty:
+                break
+            if future is not None:
+                future.cancel()
+
+
+def split_ssml_segments(ssml_script):
+    """Split the SSML of a podcast in segments synthesized separately
+
+    There is one segment per speaker turn, or consecutive turns are grouped
+    up to speech_segment_max_chars characters when it is set.
+
+    Args:
+        ssml_script (str): SSML of the podcast
+
+    Returns:
+        List with the SSML of each segment
+    """
+    speak_start = re.match(r"<speak[^>]*>", ssml_script).group(0)
+    voices = re.findall(r"<voice\b.*?</voice>", ssml_script, flags=re.S)
+    groups = []
+    for voice in voices:
+        if len(groups) > 0 and speech_segment_max_chars > 0 and \
+                len(groups[-1]) + len(voice) <= speech_segment_max_chars:
+            groups[-1] += voice
+        else:
+            groups.append(voice)
+    return [f"{speak_start}{group}</speak>" for group in groups]
+
+
+def synthesize_with_azure(segment_ssml):
+    """Synthesize a segment with Azure AI Speech
+
+    Args:
+        segment_ssml (str): SSML of the segment
+
+    Returns:
+        Audio of the segment as 24 kHz 16 bits mono PCM
+    """
+    speech_config = speechsdk.SpeechConfig(
+        subscription=os.getenv("AZURE_SPEECH_KEY"),
+        region=os.getenv("AZURE_SPEECH_REGION"))
+    speech_config.set_speech_synthesis_output_format(
+        speechsdk.SpeechSynthesisOutputFormat.Raw24Khz16BitMonoPcm)
+    speech_synthesizer = speechsdk.SpeechSynthesizer(
+        speech_config=speech_config, audio_config=None)
+    result = speech_synthesizer.speak_ssml_async(segment_ssml).get()
+    if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+        raise Exception(f"Speech synthesis failed: {result.reason} "
+                        f"{result.cancellation_details}")
+    return result.audio_data
+
+
+def synthesize_locally(segment_ssml):
+    """Local stand-in for the speech service, used for tests
+
+    It returns silence whose length depends on the length of the text.
+
+    Args:
+        segment_ssml (str): SSML of the segment
+
+    Returns:
+        Audio of the segment as 24 kHz 16 bits mono PCM
+    """
+    text = re.sub(r"<[^>]+>", "", segment_ssml)
+    duration = max(0.5, len(text) / 15)
+    return bytes(2 * int(duration * speech_sample_rate))
+
+
+speech_backends = {
+    "azure": synthesize_with_azure,
+    "local": synthesize_locally,
+}
+
+
+def get_speech_cache():
+    """Get the connection to the local audio segment cache, created on first
+    use
+
+    Returns:
+        SQLite connection
+    """
+    if "speech_cache" not in openai_clients:
+        cache_folder = os.path.dirname(speech_cache_path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        speech_cache = sqlite3.connect(
+            speech_cache_path, check_same_thread=False)
+        speech_cache.execute(
+            "CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, "
+            "audio BLOB, size INTEGER, last_used REAL)")
+        openai_clients["speech_cache"] = speech_cache
+    return openai_clients["speech_cache"]
+
+
+def find_cached_speech(key):
+    """Find the audio of a segment in the cache
+
+    Args:
+        key (str): Hash of the backend, voice, style and text of the segment
+
+    Returns:
+        Audio of the segment or None
+    """
+    with speech_cache_lock:
+        cache = get_speech_cache()
+        row = cache.execute(
+            "SELECT audio FROM segments WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with cache:
+            cache.execute("UPDATE segments SET last_used = ? WHERE key = ?",
+                          (time.time(), key))
+        return row[0]
+
+
+def cache_speech(key, audio):
+    """Store the audio of a segment, evicting the least recently used ones
+
+    Args:
+        key (str): Hash of the backend, voice, style and text of the segment
+        audio (bytes): Audio of the segment
+    """
+    with speech_cache_lock:
+        cache = get_speech_cache()
+        with cache:
+            cache.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)",
+                          (key, audio, len(audio), time.time()))
+            total_size = cache.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+            for old_key, size in cache.execute(
+                    "SELECT key, size FROM segments ORDER BY last_used"
+                    ).fetchall():
+                if total_size <= speech_cache_max_bytes:
+                    break
+                cache.execute("DELETE FROM segments WHERE key = ?", (old_key,))
+                total_size -= size
+
+
+def synthesize_segment(segment_ssml):
+    """Synthesize a segment, or take it from the cache if it did not change
+
+    Args:
+        segment_ssml (str): SSML of the segment
+
+    Returns:
+        Audio of the segment as 24 kHz 16 bits mono PCM
+    """
+    key = hashlib.sha256(
+        f"{speech_backend}|{speech_sample_rate}|{segment_ssml}".encode(
+            "utf-8")).hexdigest()
+    audio = find_cached_speech(key)
+    if audio is not None:
+        return audio
+
+    synthesize = speech_backends[speech_backend]
     retry = 1
-   
-    while retry <= 3:
-        speech_config = speechsdk.SpeechConfig(
-            subscription=speech_key, region=service_region)
+    while True:
+        try:
+            audio = synthesize(segment_ssml)
+            break
+        except Exception as e:
+            print(f"Error synthesizing segment (attempt {retry}): {e}")
+            if retry >= 3:
+                raise
+            time.sleep(2 ** retry)
+            retry += 1
+    cache_speech(key, audio)
+    return audio
+
+
+def start_audio_encoder():
+    """Start ffmpeg encoding the PCM written to its standard input to the
+    podcast audio format on its standard output
+
+    Returns:
+        ffmpeg process
+    """
+    codec, muxer, _, _ = podcast_audio_formats[podcast_audio_format]
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error',
+               '-f', 's16le', '-ar', str(speech_sample_rate), '-ac', '1',
+               '-i', 'pipe:0', '-c:a', codec]
+    if podcast_audio_format != "wav":
+        command += ['-b:a', podcast_audio_bitrate]
+    command += ['-f', muxer, 'pipe:1']
+    return subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
 
-        speech_synthesizer = speechsdk.SpeechSynthesizer(
-            speech_config=speech_config)
 
-        result = speech_synthesizer.speak_ssml_async(ssml_script).get()
-        stream = speechsdk.AudioDataStream(result)
-        id_without_hyphens = str(id).replace("-", "")
-        podcast_filename = f"{id_without_hyphens}.wav"
-        stream.save_to_wav_file(get_file(podcast_filename))
+def feed_audio_encoder(encoder, segment_audios, audio_stats):
+    """Write the audio of the segments to the encoder as they are synthesized
 
-        print(stream.status)
-        
-        blob_url_with_sas = write_to_blob(podcast_filename)
-        return blob_url_with_sas
+    Args:
+        encoder: ffmpeg process
+        segment_audios: Iterator over the PCM audio of the segments, in order
+        audio_stats (dict): Statistics of the audio, updated with the size
+            of the PCM audio, the synthesis time and the error if any
+    """
+    try:
+        for segment_audio in segment_audios:
+            encoder.stdin.write(segment_audio)
+            audio_stats["wav_size"] += len(segment_audio)
+            audio_stats["segments"] += 1
+    except Exception as e:
+        audio_stats["error"] = e
+    finally:
+        audio_stats["synthesis_seconds"] = round(
+            time.time() - audio_stats["started_at"], 3)
+        try:
+            encoder.stdin.close()
+        except OSError:
+            # The encoder was killed after a failed upload.
+            pass
+
+
+def stage_audio_stream(blob_client, stream):
+    """Upload a stream to Blob Storage as staged blocks, not committed
 
-        retry += 1
-    return ""
+    Args:
+        blob_client: Client of the blob
+        stream: File-like object read until its end
+
+    Returns:
+        Tuple with the staged blocks and their size in bytes
+    """
+    blocks = []
+    size = 0
+    while True:
+        data = stream.read(podcast_upload_block_bytes)
+        if not data:
+            break
+        block_id = base64.b64encode(
+            f"{len(blocks):08d}".encode("utf-8")).decode("utf-8")
+        blob_client.stage_block(block_id=block_id, data=data)
+        blocks.append(BlobBlock(block_id=block_id))
+        size += len(data)
+    return blocks, size
 
-def write_to_blob(file_name: str):
+
+def generate_podcast_audio(id, segment_audios):
+    """Encode the podcast and upload it to Blob Storage
+
+    The segments are written in order to an encoder, as they are
+    synthesized, whose output is uploaded as staged blocks, so synthesis,
+    encoding and upload overlap and no file is written.
+
+    Args:
+        id (str): Id of the output
+        segment_audios: Iterator over the PCM audio of the segments, in order
+
+    Returns:
+        Tuple with the URL of the podcast and the statistics of the audio
+    """
+    _, _, extension, content_type = podcast_audio_formats[
+        podcast_audio_format]
+    id_without_hyphens = str(id).replace("-", "")
+    podcast_filename = f"{id_without_hyphens}.{extension}"
+
+    audio_stats = {"format": podcast_audio_format,
+                   "bitrate": podcast_audio_bitrate,
+                   "wav_size": 0,
+                   "segments": 0,
+                   "started_at": time.time()}
     blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=file_name)
-    with open(get_file(file_name), "rb") as data:
-        result = blob_client.upload_blob(
-            data, blob_type="BlockBlob", overwrite=True)
+        container=container_name, blob=podcast_filename)
+    encoder = start_audio_encoder()
+    feeder = threading.Thread(
+        target=feed_audio_encoder,
+        args=(encoder, segment_audios, audio_stats))
+    feeder.start()
+    try:
+        blocks, size = stage_audio_stream(blob_client, encoder.stdout)
+    except BaseException:
+        # The encoder is killed so that the feeder blocked writing to it
+        # stops instead of leaking with the process.
+        encoder.kill()
+        raise
+    finally:
+        feeder.join()
+        encoder.stdout.close()
+        encoder.wait()
+    if "error" in audio_stats:
+        raise audio_stats["error"]
+    if encoder.returncode != 0:
+        raise Exception("ffmpeg failed to encode the podcast audio")
+    # The blocks are only committed once the whole podcast has been
+    # synthesized and encoded, so a failed synthesis does not publish a
+    # truncated podcast.
+    blob_client.commit_block_list(
+        blocks, content_settings=ContentSettings(content_type=content_type))
+
+    # The WAV file would have had a 44 bytes header and the same PCM audio.
+    # The upload tail is the time spent after the end of the synthesis,
+    # when the whole file used to be uploaded.
+    audio_stats["wav_size"] += 44
+    audio_stats["size"] = size
+    audio_stats["size_saved"] = audio_stats["wav_size"] - size
+    audio_stats["total_seconds"] = round(
+        time.time() - audio_stats.pop("started_at"), 3)
+    audio_stats["upload_tail_seconds"] = round(
+        audio_stats["total_seconds"] - audio_stats["synthesis_seconds"], 3)
+    print(f"Synthesized {audio_stats['segments']} segments: {audio_stats}")
+
     blob_url_with_sas = f"{blob_client.url}?{downloads_sas_token}"
-    return blob_url_with_sas
+    return blob_url_with_sas, audio_stats
 
 
-def get_file(file_name: str):
-    """Get file path
+def start_hls_encoder(segment_folder):
+    """Start ffmpeg encoding the PCM written to its standard input to AAC in
+    MPEG-TS segments of the podcast playlist
+
+    A single encoder is used for the whole podcast, so the AAC stream and its
+    timestamps are continuous from one segment to the next. Each segment is
+    added to the segment list once it is closed.
 
     Args:
-        file_name (str): File name
+        segment_folder (str): Folder where the segments and the segment list
+            are written
 
     Returns:
-        File path
+        ffmpeg process
     """
-    output_folder = 'outputs'
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    return os.path.join(output_folder, file_name)
+    return subprocess.Popen([
+        'ffmpeg', '-nostdin', '-loglevel', 'error',
+        '-f', 's16le', '-ar', str(speech_sample_rate), '-ac', '1',
+        '-i', 'pipe:0', '-c:a', 'aac', '-b:a', podcast_audio_bitrate,
+        '-f', 'segment', '-segment_time', str(podcast_hls_segment_seconds),
+        '-segment_format', 'mpegts',
+        '-segment_list', os.path.join(segment_folder, 'segments.csv'),
+        '-segment_list_type', 'csv',
+        os.path.join(segment_folder, 'segment_%05d.ts')
+    ], stdin=subprocess.PIPE)
+
+
+def read_hls_segment_list(segment_folder):
+    """Read the segments closed so far by the HLS encoder
+
+    Args:
+        segment_folder (str): Folder where the segments and the segment list
+            are written
+
+    Returns:
+        List of tuples with the file name and the duration of the segments
+    """
+    segment_list_path = os.path.join(segment_folder, 'segments.csv')
+    if not os.path.exists(segment_list_path):
+        return []
+    with open(segment_list_path, 'r') as segment_list:
+        lines = segment_list.read().split("\n")
+    # The last line is empty, or not completely written yet. Segments without
+    # audio are not published.
+    segments = []
+    for line in lines[:-1]:
+        segment_name, start, end = line.rsplit(",", 2)
+        if float(end) > float(start):
+            segments.append((segment_name, float(end) - float(start)))
+    return segments
+
+
+def get_hls_playlist(segments, ended):
+    """Get the HLS playlist of the segments published so far
+
+    Args:
+        segments (list): Tuples with the URL and the duration of the segments
+        ended (bool): Whether all the segments have been published
+
+    Returns:
+        Content of the playlist
+    """
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:EVENT",
+             f"#EXT-X-TARGETDURATION:{podcast_hls_segment_seconds}",
+             "#EXT-X-MEDIA-SEQUENCE:0"]
+    for segment_url, duration in segments:
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(segment_url)
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def upload_blob(blob_name, data, content_type, cache_control=None):
+    """Upload data to Blob Storage
+
+    Args:
+        blob_name (str): Name of the blob
+        data (bytes): Content of the blob
+        content_type (str): Content type of the blob
+        cache_control (str): Cache control of the blob
+
+    Returns:
+        URL of the blob with the SAS token
+    """
+    blob_client = blob_service_client.get_blob_client(
+        container=container_name, blob=blob_name)
+    blob_client.upload_blob(
+        data, blob_type="BlockBlob", overwrite=True,
+        content_settings=ContentSettings(content_type=content_type,
+                                         cache_control=cache_control))
+    return f"{blob_client.url}?{downloads_sas_token}"
+
+
+def generate_podcast_hls(id, segment_audios, on_first_segment):
+    """Synthesize the podcast as an HLS playlist published progressively
+
+    The synthesized audio is written to a single encoder cutting it in
+    segments of podcast_hls_segment_seconds seconds, each one is uploaded as
+    soon as it is closed and the playlist is updated, so the podcast can be
+    played while the next segments are synthesized.
+
+    Args:
+        id (str): Id of the output
+        segment_audios: Iterator over the PCM audio of the segments, in order
+        on_first_segment: Called with the URL of the playlist once the first
+            segment has been published
+
+    Returns:
+        Tuple with the URL of the playlist and the statistics of the audio
+    """
+    id_without_hyphens = str(id).replace("-", "")
+    playlist_name = f"{id_without_hyphens}/playlist.m3u8"
+
+    audio_stats = {"format": "hls", "bitrate": podcast_audio_bitrate,
+                   "wav_size": 0,
+                   "segments": 0,
+                   "size": 0,
+                   "started_at": time.time()}
+    published_segments = []
+    playlist_url = None
+
+    def publish_segments(segment_folder, ended):
+        nonlocal playlist_url
+        closed_segments = read_hls_segment_list(segment_folder)
+        new_segments = closed_segments[len(published_segments):]
+        for segment_name, duration in new_segments:
+            segment_path = os.path.join(segment_folder, segment_name)
+            with open(segment_path, 'rb') as segment_file:
+                segment = segment_file.read()
+            os.remove(segment_path)
+            segment_url = upload_blob(
+                f"{id_without_hyphens}/{segment_name}", segment,
+                "video/mp2t")
+            published_segments.append((segment_url, duration))
+            audio_stats["size"] += len(segment)
+        if not new_segments and not ended:
+            return
+        first_segment = playlist_url is None
+        playlist_url = upload_blob(
+            playlist_name, get_hls_playlist(published_segments, ended),
+            "application/vnd.apple.mpegurl", cache_control="no-cache")
+        if first_segment:
+            audio_stats["first_segment_seconds"] = round(
+                time.time() - audio_stats["started_at"], 3)
+            on_first_segment(playlist_url)
+
+    with tempfile.TemporaryDirectory() as segment_folder:
+        encoder = start_hls_encoder(segment_folder)
+        feeder = threading.Thread(
+            target=feed_audio_encoder,
+            args=(encoder, segment_audios, audio_stats))
+        feeder.start()
+        try:
+            # The segments are published as the encoder closes them, until
+            # the feeder closes its input and it exits.
+            while encoder.poll() is None:
+                publish_segments(segment_folder, False)
+                time.sleep(0.5)
+            feeder.join()
+            if "error" in audio_stats:
+                raise audio_stats["error"]
+            if encoder.returncode != 0:
+                raise Exception("ffmpeg failed to encode the podcast segments")
+            if audio_stats["wav_size"] == 0:
+                raise Exception("No audio was synthesized for the podcast")
+            publish_segments(segment_folder, True)
+        except BaseException:
+            # The encoder is killed so that the feeder blocked writing to it
+            # stops instead of leaking with the process.
+            encoder.kill()
+            raise
+        finally:
+            feeder.join()
+            encoder.wait()
+
+    # The WAV file would have had a 44 bytes header and the same PCM audio.
+    audio_stats["wav_size"] += 44
+    audio_stats["segments"] = len(published_segments)
+    audio_stats["size_saved"] = audio_stats["wav_size"] - audio_stats["size"]
+    audio_stats["total_seconds"] = round(
+        time.time() - audio_stats.pop("started_at"), 3)
+    print(f"Published {len(published_segments)} segments: {audio_stats}")
+    return playlist_url, audio_stats
 
 
-while (True):
+# The tests import this module, only poll the queues when it is run.
+if __name__ == "__main__":
     asyncio.run(main())
-    asyncio.sleep(5)
@@ -0,0 +1,235 @@
+"""Tests of the scheduling of the jobs of the podcast generator, of the
+repair of the script and of its SSML"""
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+# The clients are created when the module is imported, they do not connect
+# until they are used.
+os.environ.setdefault(
+    "STORAGE_CONNECTION_STRING",
+    "DefaultEndpointsProtocol=https;AccountName=test;"
+    "AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+os.environ.setdefault("AZURE_OPENAI_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://test.openai.azure.com")
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-06-01")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS", "embeddings")
+# The LLM response cache is opened with the embeddings model, on import.
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(
+    tempfile.mkdtemp(), "llm_responses.db"))
+
+import podcast_generator  # noqa: E402
+from podcast_generator import JobScheduler  # noqa: E402
+from podcast_generator import add_ssml_style_with_rules  # noqa: E402
+from podcast_generator import repair_script_line  # noqa: E402
+from podcast_generator import repair_script_lines  # noqa: E402
+from podcast_generator import validate_script_line  # noqa: E402
+from podcast_generator import validate_ssml  # noqa: E402
+from podcast_generator import validate_ssml_line  # noqa: E402
+
+
+def pop_jobs(scheduler):
+    jobs = []
+    while True:
+        picked = scheduler.pop()
+        if picked is None:
+            return jobs
+        priority, job, _ = picked
+        jobs.append((priority, job["id"]))
+
+
+def test_scheduler_takes_interactive_jobs_first():
+    scheduler = JobScheduler(["interactive", "batch"], 0)
+    scheduler.push("batch", {"id": "b1"})
+    scheduler.push("interactive", {"id": "i1"})
+    scheduler.push("batch", {"id": "b2"})
+    scheduler.push("interactive", {"id": "i2"})
+
+    assert pop_jobs(scheduler) == [
+        ("interactive", "i1"), ("interactive", "i2"),
+        ("batch", "b1"), ("batch", "b2")]
+
+
+def test_scheduler_serves_tenants_in_turn():
+    scheduler = JobScheduler(["interactive", "batch"], 0)
+    for index in range(3):
+        scheduler.push("interactive", {"id": f"a{index}", "tenant_id": "a"})
+    scheduler.push("interactive", {"id": "b0", "tenant_id": "b"})
+    scheduler.push("interactive", {"id": "c0"})
+
+    assert [job for _, job in pop_jobs(scheduler)] == [
+        "a0", "b0", "c0", "a1", "a2"]
+
+
+def test_scheduler_takes_a_batch_job_every_batch_every_picks():
+    scheduler = JobScheduler(["interactive", "batch"], 3)
+    for index in range(5):
+        scheduler.push("interactive", {"id": f"i{index}"})
+    scheduler.push("batch", {"id": "b0"})
+    scheduler.push("batch", {"id": "b1"})
+
+    assert pop_jobs(scheduler) == [
+        ("interactive", "i0"), ("interactive", "i1"), ("batch", "b0"),
+        ("interactive", "i2"), ("interactive", "i3"), ("batch", "b1"),
+        ("interactive", "i4")]
+
+
+def test_scheduler_records_the_wait_of_the_jobs():
+    scheduler = JobScheduler(["interactive", "batch"], 0)
+    scheduler.push("batch", {"id": "b0", "enqueued_at": 0})
+    scheduler.push("batch", {"id": "b1"})
+    scheduler.pop()
+
+    metrics = scheduler.get_metrics()
+    assert metrics["batch"]["started"] == 1
+    assert metrics["batch"]["pending"] == 1
+    assert metrics["batch"]["max_wait"] > 0
+    assert metrics["interactive"]["started"] == 0
+
+
+def test_validate_script_line_reports_malformed_lines():
+    assert validate_script_line(
+        {"speaker": "Bill", "intonation": "Cheerful", "text": "Hi"}) is None
+    assert "JSON" in validate_script_line({"invalid_json": '{"speaker": '})
+    assert "JSON" in validate_script_line(["Bill", "Hi"])
+    assert "speaker" in validate_script_line(
+        {"speaker": "Bob", "intonation": "Default", "text": "Hi"})
+    assert "intonation" in validate_script_line(
+        {"speaker": "Bill", "intonation": "Chat", "text": "Hi"})
+    assert "text" in validate_script_line(
+        {"speaker": "Melinda", "intonation": "Chat", "text": " "})
+    assert "text" in validate_script_line(
+        {"speaker": "Melinda", "intonation": "Chat"})
+
+
+class FakeAzureOpenAIClient:
+    """Client answering the chat completions with the given contents"""
+
+    def __init__(self, contents):
+        self.contents = list(contents)
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        content = self.contents.pop(0)
+        return SimpleNamespace(choices=[SimpleNamespace(
+            message=SimpleNamespace(content=content))])
+
+
+def test_repair_script_line_uses_the_repaired_line(monkeypatch):
+    repaired_line = {"speaker": "Melinda", "intonation": "Chat",
+                     "text": "Hello"}
+    client = FakeAzureOpenAIClient(
+        ["not json", json.dumps({"line": repaired_line})])
+    monkeypatch.setattr(podcast_generator, "get_azure_openai_client",
+                        lambda: client)
+    monkeypatch.setattr(podcast_generator, "podcast_repair_retries", 2)
+
+    line = {"speaker": "Melinda", "intonation": "Bored", "text": "Hello"}
+    assert repair_script_line(
+        line, validate_script_line(line), None) == repaired_line
+    assert client.contents == []
+
+
+def test_repair_script_line_falls_back_to_rules(monkeypatch):
+    monkeypatch.setattr(podcast_generator, "podcast_repair_retries", 0)
+    previous_line = {"speaker": "Bill", "intonation": "Default",
+                     "text": "Welcome"}
+
+    line = {"speaker": "Bob", "intonation": "Chat", "text": "Thanks"}
+    assert repair_script_line(line, "", previous_line) == {
+        "speaker": "Melinda", "intonation": "Chat", "text": "Thanks"}
+    line = {"speaker": "Bill", "intonation": "Chat", "text": "Thanks"}
+    assert repair_script_line(line, "", previous_line) == {
+        "speaker": "Bill", "intonation": "Default", "text": "Thanks"}
+    assert repair_script_line(
+        {"invalid_json": '{"speaker": "Bill", "te'}, "",
+        previous_line) is None
+    assert repair_script_line(
+        {"speaker": "Bill", "intonation": "Sad", "text": ""}, "",
+        previous_line) is None
+
+
+def test_repair_script_lines_keeps_valid_lines_and_drops_empty_ones(
+        monkeypatch):
+    monkeypatch.setattr(podcast_generator, "podcast_repair_retries", 0)
+    lines = [
+        {"speaker": "Bill", "intonation": "Cheerful", "text": "Welcome"},
+        {"invalid_json": "{"},
+        {"speaker": "Ann", "intonation": "Default", "text": "Thanks"},
+        {"speaker": "Bill", "intonation": "Default", "text": "Let's start"}
+    ]
+
+    assert list(repair_script_lines(iter(lines))) == [
+        lines[0],
+        {"speaker": "Melinda", "intonation": "Default", "text": "Thanks"},
+        lines[3]]
+
+
+def test_add_ssml_style_with_rules_maps_the_intonation():
+    assert add_ssml_style_with_rules(
+        "Great news", "Cheerful", "Bill") == (
+        '<mstts:express-as style="cheerful" styledegree="1.2">'
+        'Great news</mstts:express-as>')
+    assert add_ssml_style_with_rules(
+        "Welcome", "Narration - professional", "Melinda") == (
+        '<mstts:express-as style="narration-professional" styledegree="1">'
+        'Welcome</mstts:express-as>')
+
+
+def test_add_ssml_style_with_rules_raises_the_degree_of_exclamations():
+    assert add_ssml_style_with_rules("Wow!", "Excited", "Melinda") == (
+        '<mstts:express-as style="excited" styledegree="1.6">'
+        'Wow!</mstts:express-as>')
+    assert add_ssml_style_with_rules("Stop!", "Shouting", "Bill") == (
+        '<mstts:express-as style="shouting" styledegree="1.7">'
+        'Stop!</mstts:express-as>')
+
+
+def test_add_ssml_style_with_rules_keeps_unsupported_styles_plain():
+    assert add_ssml_style_with_rules("Hello", "Default", "Bill") == "Hello"
+    assert add_ssml_style_with_rules("Hello", "Chat", "Bill") == "Hello"
+    assert add_ssml_style_with_rules("Hello", "Bored", "Melinda") == "Hello"
+
+
+def test_add_ssml_style_with_rules_escapes_the_text():
+    styled_line = add_ssml_style_with_rules(
+        "Q&A <live> tonight!", "Friendly", "Melinda")
+
+    assert "Q&amp;A &lt;live&gt; tonight!" in styled_line
+    assert validate_ssml_line(styled_line)
+
+
+def test_validate_ssml_line_checks_the_attributes():
+    assert validate_ssml_line('<prosody rate="medium">Hello</prosody>')
+    assert validate_ssml_line('<prosody rate="+10%">Hello</prosody>')
+    assert validate_ssml_line('<prosody rate="0.9">Hello</prosody>')
+    assert not validate_ssml_line('<prosody rate="+300%">Hello</prosody>')
+    assert not validate_ssml_line('<prosody rate="quick">Hello</prosody>')
+    assert not validate_ssml_line('<prosody pitch="high">Hello</prosody>')
+    assert not validate_ssml_line(
+        '<mstts:express-as style="cheerful" styledegree="high">'
+        'Hello</mstts:express-as>')
+    assert validate_ssml_line(
+        '<mstts:express-as style="chat">Hello</mstts:express-as>',
+        "Melinda")
+    assert not validate_ssml_line(
+        '<mstts:express-as style="chat">Hello</mstts:express-as>', "Bill")
+
+
+def test_validate_ssml_checks_the_styles_of_each_voice():
+    speak_start = podcast_generator.ssml_speak_start
+    chat_line = '<mstts:express-as style="chat">Hello</mstts:express-as>'
+
+    validate_ssml(f"{speak_start}<voice name='en-US-AriaNeural'>"
+                  f"{chat_line}</voice></speak>")
+    with pytest.raises(ValueError, match="Style chat"):
+        validate_ssml(f"{speak_start}"
+                      f"<voice name='en-US-AndrewMultilingualNeural'>"
+                      f"{chat_line}</voice></speak>")
+    with pytest.raises(ValueError, match="Voice"):
+        validate_ssml(f"{speak_start}<voice name='en-US-GuyNeural'>"
+                      "Hello</voice></speak>")
@@ -2,15 +2,23 @@ from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from azure.cosmos import CosmosClient
+from azure.cosmos.aio import CosmosClient, ContainerProxy
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_core.documents.base import Document
+from openai import AsyncAzureOpenAI
 import logging
 import uuid
 import datetime
 import os
+import httpx
+import importlib.util
+import contextlib
+import aiohttp
+import asyncio
 
 # Load the environment variables
 load_dotenv(override=True)
@@ -25,6 +33,28 @@ cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
 azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
 azure_search_admin_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
 
+# Maximum number of words of the digest of a subject, rolled up from the
+# summaries of its inputs, and size of the parts summarized together when
+# the summaries are longer.
+subject_digest_max_words = int(os.getenv("SUBJECT_DIGEST_MAX_WORDS", "1500"))
+subject_digest_chunk_chars = int(
+    os.getenv("SUBJECT_DIGEST_CHUNK_CHARS", "12000"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+# Maximum number of connections of the Cosmos DB client, created once at
+# startup and shared by all the requests.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "100"))
+cosmos_clients = {}
+
 class InputSubjectSpace(BaseModel):
     subject: str
 
@@ -36,9 +66,36 @@ class SubjectSpace(BaseModel):
     last_updated: str
     inputs: list
     index_name: str
+    digest: str = ''
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=cosmosdb_max_connections)) as session:
+        async with CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=AioHttpTransport(
+                    session=session, session_owner=False)) as client:
+            cosmos_clients["client"] = client
+            yield
+    cosmos_clients.clear()
+    if "async_http" in openai_clients:
+        await openai_clients.pop("async_http").aclose()
+        openai_clients.pop("async_azure_openai", None)
 
 
-app = FastAPI()
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached"""
+    if container_name not in cosmos_clients:
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Disable CORS checking
 app.add_middleware(
@@ -49,29 +106,79 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the embeddings, which are computed by the sync
+    AzureSearch client in threads, created on first use"""
+    if "http" not in openai_clients:
+        openai_clients["http"] = httpx.Client(**get_http_client_options())
+    return openai_clients["http"]
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get the async HTTP client of the process, created on first use"""
+    if "async_http" not in openai_clients:
+        openai_clients["async_http"] = httpx.AsyncClient(
+            **get_http_client_options())
+    return openai_clients["async_http"]
+
+
+def get_async_azure_openai_client() -> AsyncAzureOpenAI:
+    """Get the async Azure OpenAI client of the process, created on first use"""
+    if "async_azure_openai" not in openai_clients:
+        openai_clients["async_azure_openai"] = AsyncAzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_async_http_client()
+        )
+    return openai_clients["async_azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
 # Define the embeddings model
-azure_openai_embeddings = AzureOpenAIEmbeddings(
-    api_key=os.environ['AZURE_OPENAI_KEY'],
-    azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
-    api_version=os.environ['AZURE_OPENAI_API_VERSION'],
-    azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS']
-)
+azure_openai_embeddings = get_azure_openai_embeddings()
 
 
 @app.get("/subject")
 async def get_subjects():
     """Get all subjects in the subject space.
     """
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
     subjects = []
 
     logger.info("Querying subjects")
-    for item in container.query_items(
-        query="SELECT * FROM subjects",
-        enable_cross_partition_query=True
+    async for item in container.query_items(
+        query="SELECT * FROM subjects"
     ):
         subjects.append(item)
 
@@ -82,11 +189,13 @@ async def get_subjects():
 async def get_subject(subject_id: str):
     """Get a subject in the subject space.
     """
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
-    subject = container.read_item(item=subject_id, partition_key=subject_id)
+    try:
+        subject = await container.read_item(
+            item=subject_id, partition_key=subject_id)
+    except CosmosResourceNotFoundError:
+        raise HTTPException(status_code=404, detail="Subject not found")
     return subject
 
 
@@ -94,12 +203,11 @@ async def get_subject(subject_id: str):
 async def get_subject_inputs(subject_id: str):
     """Get all inputs for a subject in the subject space.
     """
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
-    subject = container.read_item(item=subject_id, partition_key=subject_id)
-    inputs = get_inputs(subject.get('inputs'))
+    subject = await container.read_item(
+        item=subject_id, partition_key=subject_id)
+    inputs = await get_inputs(subject.get('inputs'))
     return inputs
 
 
@@ -109,13 +217,13 @@ async def create_subject(inputSubjectSpace: InputSubjectSpace):
     """
     logger.info("Creating a subject.")
 
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
     now_string = datetime.datetime.now().isoformat()
 
-    inputs = retrieve(inputSubjectSpace.subject)
+    # The search and the indexing use the sync AzureSearch client, they run
+    # in threads so that they do not block the event loop.
+    inputs = await asyncio.to_thread(retrieve, inputSubjectSpace.subject)
 
     if len(inputs) == 0:
         raise HTTPException(
@@ -124,7 +232,10 @@ async def create_subject(inputSubjectSpace: InputSubjectSpace):
     id = str(uuid.uuid4())
     index_name = id.replace('-', '')
 
-    create_index(index_name, inputs)
+    input_records = await get_inputs(inputs)
+    await asyncio.to_thread(create_index, index_name, input_records)
+    digest = await build_subject_digest(
+        inputSubjectSpace.subject, input_records)
 
     subject = SubjectSpace(
         id=id,
@@ -132,10 +243,11 @@ async def create_subject(inputSubjectSpace: InputSubjectSpace):
         date=now_string,
         last_updated=now_string,
         inputs=inputs,
-        index_name=index_name
+        index_name=index_name,
+        digest=digest
     )
 
-    container.create_item(body=subject.model_dump())
+    await container.create_item(body=subject.model_dump())
     return subject
 
 
@@ -143,15 +255,16 @@ async def create_subject(inputSubjectSpace: InputSubjectSpace):
 async def update_subject(subject_id: str, inputSubjectSpace: InputSubjectSpace):
     """Update a subject in the subject space.
     """
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
-    subject = container.read_item(item=subject_id, partition_key=subject_id)
-    subject.subject = inputSubjectSpace.subject
-    subject.last_updated = datetime.datetime.now().isoformat()
+    subject = await container.read_item(
+        item=subject_id, partition_key=subject_id)
+    subject['subject'] = inputSubjectSpace.subject
+    subject['last_updated'] = datetime.datetime.now().isoformat()
+    subject['digest'] = await build_subject_digest(
+        subject['subject'], await get_inputs(subject['inputs']))
 
-    container.upsert_item(body=subject)
+    await container.upsert_item(body=subject)
     return subject
 
 
@@ -159,28 +272,23 @@ async def update_subject(subject_id: str, inputSubjectSpace: InputSubjectSpace):
 async def delete_subject(subject_id: str):
     """Delete a subject in the subject space.
     """
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("subjects")
+    container = get_cosmos_container("subjects")
 
-    container.delete_item(item=subject_id, partition_key=subject_id)
+    await container.delete_item(item=subject_id, partition_key=subject_id)
     return {"message": "Subject deleted"}
 
 
-def get_inputs(ids):
+async def get_inputs(ids):
     """Get all inputs for a subject in the subject space.
     """
     id_list = ', '.join([f'\"{id}\"' for id in ids])
     query = f"SELECT * FROM c WHERE c.id IN ({id_list})"
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database = client.get_database_client("autopodcaster")
-    container = database.get_container_client("inputs")
+    container = get_cosmos_container("inputs")
     inputs = container.query_items(
-        query=query,
-        enable_cross_partition_query=True
+        query=query
     )
     inputs_list = []
-    for input in inputs:
+    async for input in inputs:
         inputs_list.append(input)
     return inputs_list
 
@@ -206,8 +314,7 @@ def retrieve(subject: str):
     return unique_ids
 
 
-def create_index(index_name, input_ids):
-    inputs = get_inputs(input_ids)
+def create_index(index_name, inputs):
     documents = []
     for input in inputs:
         document = Document(
@@ -235,3 +342,62 @@ def create_index(index_name, input_ids):
         embedding_function=azure_openai_embeddings.embed_query,
     )
     vector_store.add_documents(documents=splits)
+
+
+async def summarize_digest_part(subject: str, text: str) -> str:
+    """Summarize a part of the digest of a subject
+
+    Args:
+        subject (str): Subject
+        text (str): Summaries of inputs of the subject
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_async_azure_openai_client()
+    return (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                "Merge the following summaries of documents about "
+                f"\"{subject}\" in a single summary of the topics, facts "
+                "and conclusions relevant to the subject, keeping the title "
+                "of the documents they come from. Return only the summary."
+                f"\n\n{text}")},
+        ])).choices[0].message.content.strip()
+
+
+async def build_subject_digest(subject: str, inputs: list) -> str:
+    """Roll the summaries of the inputs of a subject up in a digest
+
+    The digest lists the summary of each input. When it is longer than
+    subject_digest_max_words words, it is split in parts that are
+    summarized concurrently until it fits, so its size is bounded whatever
+    the number of inputs. The model is called with the async client so the
+    event loop of the API keeps serving the other requests.
+
+    Args:
+        subject (str): Subject
+        inputs (list): Inputs of the subject
+
+    Returns:
+        Digest of the subject
+    """
+    digest = '\n\n'.join(
+        f"{input['title']}: "
+        f"{input.get('summary') or input.get('description') or ''}".strip()
+        for input in inputs)
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=subject_digest_chunk_chars,
+        chunk_overlap=0
+    )
+    while len(digest.split()) > subject_digest_max_words:
+        parts = text_splitter.split_text(digest)
+        digest = '\n\n'.join(await asyncio.gather(
+            *[summarize_digest_part(subject, part) for part in parts]))
+        if len(parts) == 1:
+            break
+    return digest
@@ -0,0 +1,48 @@
+"""Tests of the extraction of the audio segments and of the local
+transcription backend"""
+import shutil
+import subprocess
+
+import pytest
+
+import video_indexer
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None,
+                                reason="ffmpeg is not installed")
+
+
+def make_clip(path, seconds):
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:a', 'aac', path
+    ], check=True)
+
+
+def test_audio_segments_are_transcribed_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_indexer, "video_segment_seconds", 2)
+    clip_path = str(tmp_path / "clip.m4a")
+    make_clip(clip_path, 5)
+    segment_folder = tmp_path / "segments"
+    segment_folder.mkdir()
+
+    transcripts = [
+        video_indexer.transcribe_locally(segment_path, index)
+        for index, segment_path in video_indexer.iter_audio_segments(
+            clip_path, str(segment_folder), 2)]
+
+    assert len(transcripts) == 3
+    assert transcripts[0].startswith("Segment 0 from 0s to 2s (")
+    assert transcripts[2].startswith("Segment 2 from 4s to 6s (")
+
+
+def test_audio_segments_fail_on_unreadable_media(tmp_path):
+    media_path = tmp_path / "clip.m4a"
+    media_path.write_bytes(b"not a media file")
+    segment_folder = tmp_path / "segments"
+    segment_folder.mkdir()
+
+    with pytest.raises(Exception, match="ffmpeg failed"):
+        list(video_indexer.iter_audio_segments(
+            str(media_path), str(segment_folder), 2))
+
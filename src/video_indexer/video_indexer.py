@@ -0,0 +1,495 @@
+import os
+import httpx
+import importlib.util
+import json
+import time
+import uuid
+import tempfile
+import subprocess
+import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from azure.servicebus.aio import ServiceBusClient
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from openai import AzureOpenAI
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain_community.vectorstores.azuresearch import AzureSearch
+from pytubefix import YouTube
+
+load_dotenv(override=True)
+
+servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
+cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
+status_endpoint = os.getenv("STATUS_ENDPOINT")
+
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# Length of the audio segments, number of segments transcribed in parallel
+# and speech to text backend used to transcribe them.
+video_segment_seconds = int(os.getenv("VIDEO_SEGMENT_SECONDS", "300"))
+video_transcription_workers = int(
+    os.getenv("VIDEO_TRANSCRIPTION_WORKERS", "4"))
+video_transcription_backend = os.getenv(
+    "VIDEO_TRANSCRIPTION_BACKEND", "azure_openai")
+
+# Container of the uploaded recordings, the blob client is created on first
+# use so that the URLs can be indexed without a storage account.
+container_name = "uploads"
+blob_clients = {}
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+input_summary_workers = int(os.getenv("INPUT_SUMMARY_WORKERS", "4"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+
+class Input:
+    id: str
+    title: str
+    date: str
+    last_updated: str
+    author: str
+    description: str
+    source: str
+    type: str
+    thumbnail_url: str
+    topics: list
+    entities: list
+    content: str
+    summary: str
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "date": self.date,
+            "last_updated": self.last_updated,
+            "author": self.author,
+            "description": self.description,
+            "source": self.source,
+            "type": self.type,
+            "thumbnail_url": self.thumbnail_url,
+            "topics": self.topics,
+            "entities": self.entities,
+            "content": self.content,
+            "summary": self.summary
+        }
+
+
+async def main():
+    async with ServiceBusClient.from_connection_string(
+            conn_str=servicebus_connection_string) as servicebus_client:
+        async with servicebus_client:
+            receiver = servicebus_client.get_queue_receiver('video')
+            async with receiver:
+                received_messages = await receiver.receive_messages(
+                    max_message_count=1, max_wait_time=5)
+                for message in received_messages:
+                    video_input = json.loads(str(message))
+                    # The uploaded recordings are read from their blob, the
+                    # other inputs from their URL.
+                    file_name = video_input.get('file_name')
+                    video_url = video_input.get('input') or \
+                        video_input['file_location']
+                    update_status(video_input['request_id'], "Indexing")
+                    await receiver.complete_message(message)
+                    input = index_video(video_url, file_name)
+                    update_status(video_input['request_id'], "Indexed")
+                    await save_to_cosmosdb(input)
+                    update_status(video_input['request_id'], "Saved")
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so that the
+    # loop is not blocked while it is written.
+    container = get_cosmos_container("inputs")
+    await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        openai_clients["http"] = httpx.Client(**get_http_client_options())
+    return openai_clients["http"]
+
+
+def get_azure_openai_client() -> AzureOpenAI:
+    """Get the Azure OpenAI client of the process, created on first use"""
+    if "azure_openai" not in openai_clients:
+        openai_clients["azure_openai"] = AzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_http_client()
+        )
+    return openai_clients["azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_azure_openai_client()
+    return azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ]).choices[0].message.content.strip()
+
+
+def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    with ThreadPoolExecutor(max_workers=input_summary_workers) as executor:
+        while len(parts) > 1:
+            summaries = executor.map(
+                lambda part: summarize_text(title, part), parts)
+            parts = text_splitter.split_text('\n\n'.join(summaries))
+    return summarize_text(title, parts[0])
+
+
+def update_status(request_id: str, status: str):
+    status = {"status": status}
+    requests.post(
+        f"{status_endpoint}/status/{request_id}", json=status)
+
+
+def transcribe_with_azure_openai(segment_path: str, index: int) -> str:
+    """Transcribe an audio segment with the Azure OpenAI whisper model
+
+    Args:
+        segment_path (str): Path of the audio segment
+        index (int): Index of the segment in the recording
+
+    Returns:
+        Transcript of the segment
+    """
+    azure_openai_client = get_azure_openai_client()
+    with open(segment_path, "rb") as segment_file:
+        transcription = azure_openai_client.audio.transcriptions.create(
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_WHISPER", "whisper"),
+            file=segment_file
+        )
+    return transcription.text
+
+
+def transcribe_locally(segment_path: str, index: int) -> str:
+    """Local stand-in for the speech to text service, used for tests
+
+    It does not recognize speech, it only describes the segment so that the
+    rest of the pipeline can run without calling the service.
+
+    Args:
+        segment_path (str): Path of the audio segment
+        index (int): Index of the segment in the recording
+
+    Returns:
+        Placeholder transcript of the segment
+    """
+    start = index * video_segment_seconds
+    size = os.path.getsize(segment_path)
+    return (f"Segment {index} from {start}s to "
+            f"{start + video_segment_seconds}s ({size} bytes of audio).")
+
+
+transcription_backends = {
+    "azure_openai": transcribe_with_azure_openai,
+    "local": transcribe_locally,
+}
+
+
+def index_video(video_url: str, file_name: str = None) -> Input:
+    transcribe = transcription_backends[video_transcription_backend]
+
+    with tempfile.TemporaryDirectory() as working_folder:
+        title, author, media_source = get_media_source(
+            video_url, working_folder, file_name)
+
+        input = Input()
+        input.id = str(uuid.uuid4())
+        input.title = title
+        input.date = ''
+        input.last_updated = ''
+        input.author = author
+        input.description = ''
+        input.source = video_url
+        input.type = 'video'
+        input.thumbnail_url = ''
+        input.topics = []
+        input.entities = []
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1000,
+            chunk_overlap=200
+        )
+
+        azure_openai_embeddings = get_azure_openai_embeddings()
+
+        index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
+        if index_name is None or index_name == "":
+            index_name = "knowledgebase"
+
+        vector_store = AzureSearch(
+            azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+            azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
+            index_name=index_name,
+            embedding_function=azure_openai_embeddings.embed_query,
+        )
+
+        transcripts = {}
+
+        def add_transcript(index: int, segment_path: str, text: str):
+            os.remove(segment_path)
+            transcripts[index] = text
+            start = index * video_segment_seconds
+            document = Document(
+                page_content=text,
+                metadata={
+                    "id": input.id,
+                    "title": title,
+                    "source": video_url,
+                    "description": '',
+                    "thumbnail_url": '',
+                    "page": index,
+                    "start": start,
+                    "end": start + video_segment_seconds,
+                    "type": 'video'
+                }
+            )
+            splits = text_splitter.split_documents([document])
+            if len(splits) > 0:
+                vector_store.add_documents(documents=splits)
+
+        # Segments are transcribed as soon as ffmpeg has written them and
+        # each transcript is embedded as soon as it is available, while the
+        # other segments are still being extracted or transcribed.
+        segment_folder = os.path.join(working_folder, 'segments')
+        os.makedirs(segment_folder)
+        with ThreadPoolExecutor(
+                max_workers=video_transcription_workers) as executor:
+            pending = {}
+            for index, segment_path in iter_audio_segments(
+                    media_source, segment_folder, video_segment_seconds):
+                future = executor.submit(transcribe, segment_path, index)
+                pending[future] = (index, segment_path)
+                for done in [future for future in pending if future.done()]:
+                    add_transcript(*pending.pop(done), done.result())
+            for done in as_completed(pending):
+                add_transcript(*pending[done], done.result())
+
+    input.content = '\n\n'.join(
+        [transcripts[index] for index in sorted(transcripts)])
+    input.summary = summarize_input(input.title, input.content)
+
+    return input
+
+
+def get_blob_service_client() -> BlobServiceClient:
+    """Get the blob service client of the process, created on first use"""
+    if "blob_service" not in blob_clients:
+        blob_clients["blob_service"] = BlobServiceClient.from_connection_string(
+            os.getenv("STORAGE_CONNECTION_STRING"))
+    return blob_clients["blob_service"]
+
+
+def get_media_source(video_url: str, working_folder: str,
+                     file_name: str = None):
+    """Get the title, author and the media that ffmpeg reads the audio from
+
+    Uploaded recordings are downloaded from the uploads container and
+    YouTube videos are downloaded as audio only, other URLs are read by
+    ffmpeg directly.
+
+    Args:
+        video_url (str): URL of the video or audio recording
+        working_folder (str): Folder where the audio can be downloaded
+        file_name (str): Name of the blob of an uploaded recording
+
+    Returns:
+        Tuple with the title, the author and the path or URL of the media
+    """
+    if file_name is not None:
+        blob_client = get_blob_service_client().get_blob_client(
+            container=container_name, blob=file_name)
+        file_path = os.path.join(working_folder, os.path.basename(file_name))
+        with open(file_path, "wb") as file:
+            blob_client.download_blob().readinto(file)
+        return file_name, '', file_path
+    if 'youtube.com' in video_url or 'youtu.be' in video_url:
+        youtube = YouTube(video_url)
+        audio_path = youtube.streams.get_audio_only().download(
+            output_path=working_folder)
+        return youtube.title, youtube.author, audio_path
+    title = os.path.basename(video_url.split('?')[0]) or 'Unknown Title'
+    return title, '', video_url
+
+
+def iter_audio_segments(media_source: str, segment_folder: str,
+                        segment_seconds: int):
+    """Extract the audio with ffmpeg and yield the segments as they are written
+
+    ffmpeg writes mono 16 kHz segments of segment_seconds seconds; a segment
+    is complete once the next one has been started or ffmpeg has exited.
+
+    Args:
+        media_source (str): Path or URL of the media
+        segment_folder (str): Folder where the segments are written
+        segment_seconds (int): Length of the segments in seconds
+
+    Yields:
+        Tuple with the index and the path of each segment
+    """
+    def segment_path(index):
+        return os.path.join(segment_folder, f"segment_{index:05d}.wav")
+
+    process = subprocess.Popen([
+        'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', media_source,
+        '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'pcm_s16le',
+        '-f', 'segment', '-segment_time', str(segment_seconds),
+        os.path.join(segment_folder, 'segment_%05d.wav')
+    ])
+
+    # ffmpeg is killed if the segments are not all consumed, when the
+    # transcription of a segment fails or the generator is closed.
+    try:
+        index = 0
+        while True:
+            if os.path.exists(segment_path(index + 1)):
+                yield index, segment_path(index)
+                index += 1
+            elif process.poll() is not None:
+                break
+            else:
+                time.sleep(0.5)
+
+        if process.returncode != 0:
+            raise Exception(
+                f"ffmpeg failed to extract the audio of {media_source}")
+
+        while os.path.exists(segment_path(index)):
+            yield index, segment_path(index)
+            index += 1
+    finally:
+        process.kill()
+        process.wait()
+
+
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+
+# The tests import this module, only poll the queue when it is run.
+if __name__ == "__main__":
+    asyncio.run(run())
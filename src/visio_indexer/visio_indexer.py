@@ -1,13 +1,24 @@
 import os
+import httpx
+import threading
+import importlib.util
 import io
 import uuid
 import json
+import time
+import base64
+import sqlite3
+import hashlib
+import zipfile
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from azure.servicebus.aio import ServiceBusClient
-from azure.cosmos import CosmosClient
-from openai import AzureOpenAI
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from openai import AsyncAzureOpenAI
 from langchain_core.documents.base import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
@@ -22,6 +33,64 @@ servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
 cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
 status_endpoint = os.getenv("STATUS_ENDPOINT")
 
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# Local cache of the descriptions, keyed by the perceptual hash of the
+# rendered page. Pages whose hashes differ by at most
+# description_cache_max_distance bits are considered the same.
+description_cache_path = os.getenv(
+    "DESCRIPTION_CACHE_PATH", os.path.join("cache", "descriptions.db"))
+description_cache_max_distance = int(
+    os.getenv("DESCRIPTION_CACHE_MAX_DISTANCE", "4"))
+# A cached description is only reused for an image whose aspect ratio differs
+# by at most description_cache_max_aspect_ratio_difference.
+description_cache_max_aspect_ratio_difference = float(
+    os.getenv("DESCRIPTION_CACHE_MAX_ASPECT_RATIO_DIFFERENCE", "0.05"))
+description_cache_max_entries = int(
+    os.getenv("DESCRIPTION_CACHE_MAX_ENTRIES", "10000"))
+description_cache = None
+
+# Number of processes rendering the pages and maximum number of page
+# descriptions requested at the same time.
+visio_render_processes = int(
+    os.getenv("VISIO_RENDER_PROCESSES", os.cpu_count() or 1))
+visio_max_concurrent_descriptions = int(
+    os.getenv("VISIO_MAX_CONCURRENT_DESCRIPTIONS", "8"))
+worker_visio = None
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+# Persistent cache of the chat completions sent with temperature 0, whose
+# responses are deterministic. Bypassing the cache sends every prompt to the
+# model again and refreshes the cached responses.
+llm_cache_path = os.getenv(
+    "LLM_CACHE_PATH", os.path.join("cache", "llm_responses.db"))
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+llm_cache_max_age_days = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30"))
+llm_cache_bypass = os.getenv("LLM_CACHE_BYPASS", "false").lower() == "true"
+
 class Input:
     id: str
     title: str
@@ -35,6 +104,7 @@ class Input:
     topics: list
     entities: list
     content: str
+    summary: str
 
     def to_dict(self):
         return {
@@ -49,7 +119,8 @@ class Input:
             "thumbnail_url": self.thumbnail_url,
             "topics": self.topics,
             "entities": self.entities,
-            "content": self.content
+            "content": self.content,
+            "summary": self.summary
         }
 
 async def main():
@@ -65,19 +136,342 @@ async def main():
                     visio_input = json.loads(str(message))
                     visio_url = visio_input['input']
                     update_status(visio_input['request_id'], "Indexing")
-                    input = index_visio(visio_url)
+                    input = await index_visio(visio_url)
                     update_status(visio_input['request_id'], "Indexed")
-                    save_to_cosmosdb(input)
+                    await save_to_cosmosdb(input)
                     update_status(visio_input['request_id'], "Saved")
                     await receiver.complete_message(message)
+                    print(f"LLM cache: {get_llm_response_cache().get_metrics()}")
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so that the
+    # loop is not blocked while it is written.
+    container = get_cosmos_container("inputs")
+    await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+class LLMResponseCache:
+    """Persistent cache of the chat completion responses of temperature 0
+    prompts, keyed by the hash of the deployment, the messages and the
+    parameters of the request
+
+    The entries older than max_age_days are dropped and the least recently
+    used ones are evicted when the cache is larger than max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age_days: float,
+                 bypass: bool):
+        cache_folder = os.path.dirname(path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "status INTEGER, headers TEXT, body BLOB, size INTEGER, "
+            "created_at REAL, last_used REAL)")
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, request: httpx.Request):
+        """Get the cache key of a request
+
+        Args:
+            request (httpx.Request): Request sent to Azure OpenAI
+
+        Returns:
+            Cache key, or None if the response of the request is not
+            deterministic or not a chat completion
+        """
+        if request.method != "POST" or \
+                not request.url.path.endswith("/chat/completions"):
+            return None
+        body = json.loads(request.content)
+        if body.get("temperature") != 0 or body.get("stream"):
+            return None
+        key = json.dumps({"path": request.url.path, "body": body},
+                         sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Get a cached response
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Tuple with the status code, the headers and the body, or None
+        """
+        if self.bypass:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body FROM responses WHERE key = ? "
+                "AND created_at >= ?",
+                (key, time.time() - self.max_age_seconds)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key))
+        return row[0], json.loads(row[1]), row[2]
+
+    def put(self, key: str, status: int, headers: dict, body: bytes):
+        """Store a response and evict the old and least recently used ones
+
+        Args:
+            key (str): Cache key
+            status (int): Status code
+            headers (dict): Headers
+            body (bytes): Body
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, json.dumps(headers), body, len(body), now, now))
+            self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (now - self.max_age_seconds,))
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, size in self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                    ).fetchall():
+                if total_size <= self.max_bytes:
+                    break
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (old_key,))
+                total_size -= size
+
+    def get_metrics(self):
+        """Get the hit rate metrics of the cache
+
+        Returns:
+            Dictionary with the number of hits and misses and the hit rate
+        """
+        requests_count = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests_count if requests_count else 0.0
+        }
+
+def build_cached_response(request: httpx.Request, status: int,
+                          headers: dict, body: bytes) -> httpx.Response:
+    """Build the response returned by the caching transports"""
+    return httpx.Response(status, headers=headers, content=body,
+                          request=request)
+
+def get_cacheable_headers(response: httpx.Response) -> dict:
+    """Get the headers of a response that still apply to its decoded body"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length",
+                                    "transfer-encoding")}
+
+class CachingTransport(httpx.BaseTransport):
+    """HTTP transport answering the deterministic chat completions from the
+    LLM response cache"""
+
+    def __init__(self, transport: httpx.BaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = self.transport.handle_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
+
+    def close(self):
+        self.transport.close()
+
+class AsyncCachingTransport(httpx.AsyncBaseTransport):
+    """Async HTTP transport answering the deterministic chat completions
+    from the LLM response cache"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport,
+                 cache: LLMResponseCache):
+        self.transport = transport
+        self.cache = cache
+
+    async def handle_async_request(
+            self, request: httpx.Request) -> httpx.Response:
+        key = self.cache.get_key(request)
+        if key is not None:
+            cached_response = self.cache.get(key)
+            if cached_response is not None:
+                return build_cached_response(request, *cached_response)
+        response = await self.transport.handle_async_request(request)
+        if key is None or response.status_code != 200:
+            return response
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        headers = get_cacheable_headers(response)
+        self.cache.put(key, response.status_code, headers, body)
+        return build_cached_response(request, response.status_code, headers,
+                                     body)
 
-def save_to_cosmosdb(input: Input):
-    client = CosmosClient.from_connection_string(cosmosdb_connection_string)
-    database_name = "autopodcaster"
-    database = client.get_database_client(database_name)
-    container_name = "inputs"
-    container = database.get_container_client(container_name)
-    container.create_item(body=input.to_dict())
+    async def aclose(self):
+        await self.transport.aclose()
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Get the LLM response cache of the process, created on first use"""
+    if "llm_cache" not in openai_clients:
+        openai_clients["llm_cache"] = LLMResponseCache(
+            llm_cache_path, llm_cache_max_bytes, llm_cache_max_age_days,
+            llm_cache_bypass)
+    return openai_clients["llm_cache"]
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["http"] = httpx.Client(
+            timeout=options.pop("timeout"),
+            transport=CachingTransport(httpx.HTTPTransport(**options),
+                                       get_llm_response_cache()))
+    return openai_clients["http"]
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get the async HTTP client of the process, created on first use"""
+    if "async_http" not in openai_clients:
+        options = get_http_client_options()
+        openai_clients["async_http"] = httpx.AsyncClient(
+            timeout=options.pop("timeout"),
+            transport=AsyncCachingTransport(
+                httpx.AsyncHTTPTransport(**options),
+                get_llm_response_cache()))
+    return openai_clients["async_http"]
+
+def get_async_azure_openai_client() -> AsyncAzureOpenAI:
+    """Get the async Azure OpenAI client of the process, created on first use"""
+    if "async_azure_openai" not in openai_clients:
+        openai_clients["async_azure_openai"] = AsyncAzureOpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            azure_endpoint=os.environ['OPENAI_AZURE_ENDPOINT'],
+            api_version=os.environ['OPENAI_API_VERSION'],
+            http_client=get_async_http_client()
+        )
+    return openai_clients["async_azure_openai"]
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['OPENAI_API_KEY'],
+            azure_endpoint=os.environ['OPENAI_AZURE_ENDPOINT'],
+            api_version=os.environ['OPENAI_API_VERSION'],
+            azure_deployment=os.environ['OPENAI_AZURE_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+async def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_async_azure_openai_client()
+    return (await azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ])).choices[0].message.content.strip()
+
+async def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    while len(parts) > 1:
+        summaries = await asyncio.gather(
+            *[summarize_text(title, part) for part in parts])
+        parts = text_splitter.split_text('\n\n'.join(summaries))
+    return await summarize_text(title, parts[0])
 
 def update_status(request_id: str, status: str):
     status = {"status": status}
@@ -89,8 +483,332 @@ def num_tokens_from_string(string: str, encoding_name: str) -> int:
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
-def index_visio(visio_url: str):
-    visio_file = requests.get(visio_url).content
+def compute_image_hash(image: Image.Image) -> int:
+    """Compute the perceptual (difference) hash of an image
+
+    The hash does not change when the image is re-saved, re-encoded or
+    resized, and only a few bits change for small edits.
+
+    Args:
+        image (Image.Image): Image
+
+    Returns:
+        64 bits hash of the image
+    """
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    image_hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            image_hash = (image_hash << 1) | (1 if left > right else 0)
+    return image_hash
+
+def get_description_cache():
+    """Get the connection to the local description cache, created on first use
+
+    Returns:
+        SQLite connection
+    """
+    global description_cache
+    if description_cache is None:
+        cache_folder = os.path.dirname(description_cache_path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        description_cache = sqlite3.connect(
+            description_cache_path, check_same_thread=False)
+        description_cache.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions (hash TEXT PRIMARY KEY, "
+            "title TEXT, description TEXT, full_text TEXT, last_used REAL, "
+            "aspect_ratio REAL)")
+        # The caches created before the aspect ratio was stored get the
+        # column, their entries are never matched and are evicted over time.
+        columns = [column[1] for column in description_cache.execute(
+            "PRAGMA table_info(descriptions)")]
+        if "aspect_ratio" not in columns:
+            description_cache.execute(
+                "ALTER TABLE descriptions ADD COLUMN aspect_ratio REAL")
+        description_cache.execute(
+            "CREATE INDEX IF NOT EXISTS descriptions_aspect_ratio ON "
+            "descriptions (aspect_ratio)")
+    return description_cache
+
+
+def is_low_detail_hash(image_hash: int) -> bool:
+    """Check if a perceptual hash is too close to the one of a blank image
+
+    A blank or nearly uniform image has almost no bit set, so all such
+    images would match each other.
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+
+    Returns:
+        True if the hash is within twice the maximum distance of the hash of
+        a blank image
+    """
+    return bin(image_hash).count('1') <= 2 * description_cache_max_distance
+
+
+def find_cached_description(image_hash: int, aspect_ratio: float):
+    """Find the description of an image with the same or a close perceptual
+    hash and the same aspect ratio
+
+    The exact hash is looked up first, the cached hashes are only compared
+    when it is missing and then only with the images of the same aspect
+    ratio.
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+        aspect_ratio (float): Width of the image divided by its height
+
+    Returns:
+        Tuple with the title, the description and the full text, or None
+    """
+    if is_low_detail_hash(image_hash):
+        return None
+    cache = get_description_cache()
+    tolerance = 1 + description_cache_max_aspect_ratio_difference
+    min_aspect_ratio = aspect_ratio / tolerance
+    max_aspect_ratio = aspect_ratio * tolerance
+    best_match = cache.execute(
+        "SELECT hash, title, description, full_text FROM descriptions "
+        "WHERE hash = ? AND aspect_ratio BETWEEN ? AND ?",
+        (f"{image_hash:016x}", min_aspect_ratio, max_aspect_ratio)).fetchone()
+    best_distance = 0
+    if best_match is None and description_cache_max_distance > 0:
+        best_distance = description_cache_max_distance + 1
+        for cached_hash, title, description, full_text in cache.execute(
+                "SELECT hash, title, description, full_text FROM descriptions "
+                "WHERE aspect_ratio BETWEEN ? AND ?",
+                (min_aspect_ratio, max_aspect_ratio)):
+            distance = bin(int(cached_hash, 16) ^ image_hash).count('1')
+            if distance < best_distance:
+                best_match = (cached_hash, title, description, full_text)
+                best_distance = distance
+    if best_match is None:
+        return None
+    with cache:
+        cache.execute("UPDATE descriptions SET last_used = ? WHERE hash = ?",
+                      (time.time(), best_match[0]))
+    print(f"Description cache hit (distance {best_distance})")
+    return best_match[1:]
+
+
+def cache_description(image_hash: int, aspect_ratio: float, title: str,
+                      description: str, full_text: str):
+    """Store the description of an image, evicting the least recently used
+
+    Args:
+        image_hash (int): Perceptual hash of the image
+        aspect_ratio (float): Width of the image divided by its height
+        title (str): Title
+        description (str): Description
+        full_text (str): Full text
+    """
+    if is_low_detail_hash(image_hash):
+        return
+    cache = get_description_cache()
+    with cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO descriptions (hash, title, description, "
+            "full_text, last_used, aspect_ratio) VALUES (?, ?, ?, ?, ?, ?)",
+            (f"{image_hash:016x}", title, description, full_text, time.time(),
+             aspect_ratio))
+        cache.execute(
+            "DELETE FROM descriptions WHERE hash NOT IN (SELECT hash FROM "
+            "descriptions ORDER BY last_used DESC LIMIT ?)",
+            (description_cache_max_entries,))
+
+def get_page_cache():
+    """Get the connection to the local page cache, created on first use
+
+    The pages are stored in the same database as the descriptions.
+
+    Returns:
+        SQLite connection
+    """
+    cache = get_description_cache()
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS pages (hash TEXT PRIMARY KEY, "
+        "image BLOB, description TEXT, last_used REAL)")
+    return cache
+
+def find_cached_page(content_hash: str):
+    """Find the render and the description of a page by its content hash
+
+    Args:
+        content_hash (str): Content hash of the page
+
+    Returns:
+        Tuple with the PNG image and the description, or None
+    """
+    cache = get_page_cache()
+    row = cache.execute(
+        "SELECT image, description FROM pages WHERE hash = ?",
+        (content_hash,)).fetchone()
+    if row is None:
+        return None
+    with cache:
+        cache.execute("UPDATE pages SET last_used = ? WHERE hash = ?",
+                      (time.time(), content_hash))
+    return row
+
+def cache_page(content_hash: str, image: bytes, description: str):
+    """Store the render and the description of a page
+
+    Args:
+        content_hash (str): Content hash of the page
+        image (bytes): PNG image of the page
+        description (str): Description of the page
+    """
+    cache = get_page_cache()
+    with cache:
+        cache.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                      (content_hash, image, description, time.time()))
+        cache.execute(
+            "DELETE FROM pages WHERE hash NOT IN (SELECT hash FROM pages "
+            "ORDER BY last_used DESC LIMIT ?)",
+            (description_cache_max_entries,))
+
+def get_page_content_hashes(visio_file: bytes, page_count: int):
+    """Compute the content hash of each page of a Visio file
+
+    For .vsdx files it is the hash of the page XML, combined with the hash
+    of the parts shared by all pages (masters, media...). For other files
+    it is the hash of the whole file and the page number.
+
+    Args:
+        visio_file (bytes): Content of the Visio file
+        page_count (int): Number of pages
+
+    Returns:
+        List with the content hash of each page
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(visio_file)) as vsdx:
+            names = sorted(vsdx.namelist())
+            page_names = [f"visio/pages/page{page + 1}.xml"
+                          for page in range(page_count)]
+            shared_hash = hashlib.sha256()
+            for name in names:
+                if not name.startswith('visio/pages/'):
+                    shared_hash.update(name.encode())
+                    shared_hash.update(vsdx.read(name))
+            content_hashes = []
+            for page, page_name in enumerate(page_names):
+                page_hash = shared_hash.copy()
+                if page_name in names:
+                    page_hash.update(vsdx.read(page_name))
+                else:
+                    page_hash.update(visio_file + str(page).encode())
+                content_hashes.append(page_hash.hexdigest())
+            return content_hashes
+    except zipfile.BadZipFile:
+        return [hashlib.sha256(visio_file + str(page).encode()).hexdigest()
+                for page in range(page_count)]
+
+def load_worker_visio(visio_file: bytes):
+    """Load the Visio file once in each render worker process
+
+    Args:
+        visio_file (bytes): Content of the Visio file
+    """
+    global worker_visio
+    worker_visio = pyvisio.VisioFile(io.BytesIO(visio_file))
+
+def render_page(page: int) -> bytes:
+    """Render a page of the Visio file loaded in the worker process
+
+    Args:
+        page (int): Page number
+
+    Returns:
+        PNG image of the page
+    """
+    image = worker_visio.pages[page].render()
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+async def describe_page(azure_openai_client: AsyncAzureOpenAI, semaphore,
+                        title: str, description: str, page: int,
+                        page_image: bytes) -> str:
+    """Generate the description of a rendered page
+
+    Args:
+        azure_openai_client (AsyncAzureOpenAI): Azure OpenAI client
+        semaphore (asyncio.Semaphore): Limit of concurrent requests
+        title (str): Title of the diagram
+        description (str): Description of the diagram
+        page (int): Page number
+        page_image (bytes): PNG image of the page
+
+    Returns:
+        Description of the page
+    """
+    # Create the prompt to generate description using GPT-4o
+    prompt_template = """Given the title, the description and the image of page {page} of a Visio diagram, generate a detailed description of the diagram on this page.
+
+    Title: {title}
+    Description:
+    {description}
+    """
+
+    image = Image.open(io.BytesIO(page_image))
+
+    # The same page, or a re-saved copy of it, was maybe already described.
+    image_hash = compute_image_hash(image)
+    aspect_ratio = image.size[0] / image.size[1]
+    cached_description = find_cached_description(image_hash, aspect_ratio)
+    if cached_description is not None:
+        return cached_description[2]
+
+    prompt = prompt_template.format(
+        page=page + 1, title=title, description=description)
+    base64_image = base64.b64encode(page_image).decode("utf-8")
+    async with semaphore:
+        generated_description = (await azure_openai_client.chat.completions.create(
+            model="gpt-4o",
+            temperature=0,
+            top_p=1,
+            messages=[
+                {"role": "user", "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/png;base64,{base64_image}"
+                        }
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]},
+            ],
+        )).choices[0].message.content
+    cache_description(image_hash, aspect_ratio, title, description,
+                      generated_description)
+    return generated_description
+
+def download_visio(visio_url: str) -> bytes:
+    """Download a Visio file in memory
+
+    Args:
+        visio_url (str): URL of the Visio file
+
+    Returns:
+        Content of the file
+    """
+    buffer = io.BytesIO()
+    with requests.get(visio_url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            buffer.write(chunk)
+    return buffer.getvalue()
+
+async def index_visio(visio_url: str):
+    visio_file = download_visio(visio_url)
     visio = pyvisio.VisioFile(io.BytesIO(visio_file))
 
     title = visio.title
@@ -110,55 +828,68 @@ def index_visio(visio_url: str):
     input.topics = []
     input.entities = []
 
-    # Convert Visio to image
-    image = visio.pages[0].render()
-    image_file_name = f"{input.id}.png"
-    image.save(image_file_name)
+    page_count = len(visio.pages)
+    content_hashes = get_page_content_hashes(visio_file, page_count)
 
-    # Create the prompt to generate description using GPT-4
-    prompt_template = """Given the title and description of a Visio diagram, generate a detailed description of the diagram.
+    # Create the gpt-4o model client
+    azure_openai_client = get_async_azure_openai_client()
+    semaphore = asyncio.Semaphore(visio_max_concurrent_descriptions)
+    loop = asyncio.get_running_loop()
 
-    Title: {title}
-    Description:
-    {description}
-    """
+    # Pages that did not change since they were last indexed are taken from
+    # the page cache, the others are rendered in parallel worker processes
+    # and each page is described as soon as it is rendered.
+    cached_pages = [find_cached_page(content_hash)
+                    for content_hash in content_hashes]
+    pages_to_render = [page for page in range(page_count)
+                       if cached_pages[page] is None]
+    executor = None
+    if len(pages_to_render) > 1 and visio_render_processes > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=min(visio_render_processes, len(pages_to_render)),
+            initializer=load_worker_visio, initargs=(visio_file,))
+    elif len(pages_to_render) > 0:
+        load_worker_visio(visio_file)
 
-    # Create the gpt-4 model client
-    azure_openai_client = AzureOpenAI(
-        api_key=os.environ['OPENAI_API_KEY'],
-        azure_endpoint=os.environ['OPENAI_AZURE_ENDPOINT'],
-        api_version=os.environ['OPENAI_API_VERSION']
-    )
+    async def process_page(page: int) -> str:
+        if cached_pages[page] is not None:
+            return cached_pages[page][1]
+        if executor is not None:
+            page_image = await loop.run_in_executor(executor, render_page, page)
+        else:
+            page_image = render_page(page)
+        page_description = await describe_page(
+            azure_openai_client, semaphore, title, description, page,
+            page_image)
+        cache_page(content_hashes[page], page_image, page_description)
+        return page_description
 
-    encoding_name = 'gpt-4'
+    try:
+        page_descriptions = await asyncio.gather(
+            *[process_page(page) for page in range(page_count)])
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    prompt = prompt_template.format(
-        title=title, description=description)
-    generated_description = azure_openai_client.chat.completions.create(
-        model="gpt-4",
-        temperature=0,
-        top_p=1,
-        messages=[
-            {"role": "user", "content": prompt},
-        ],
-    ).choices[0].message.content
-
-    input.content = generated_description
-
-    # Create langchain document
-    document = Document(
-        page_content=generated_description,
-        metadata={
-            "title": title,
-            "source": url,
-            "description": description,
-            "thumbnail_url": '',
-            "page": 0,
-            "type": "visio"
-        }
-    )
+    input.content = '\n\n'.join(page_descriptions)
+    input.summary = await summarize_input(input.title, input.content)
 
-    documents = [document]  # List of documents to be processed
+    # Create langchain documents, one per page
+    documents = [
+        Document(
+            page_content=page_description,
+            metadata={
+                "id": input.id,
+                "title": title,
+                "source": url,
+                "description": description,
+                "thumbnail_url": '',
+                "page": page,
+                "type": "visio"
+            }
+        )
+        for page, page_description in enumerate(page_descriptions)
+    ]
 
     # Split the document in chunks of maximum 1000 characters with 200 characters overlap using langchain
     text_splitter = RecursiveCharacterTextSplitter(
@@ -168,12 +899,7 @@ def index_visio(visio_url: str):
     splits = text_splitter.split_documents(documents)
 
     # Define the embeddings model
-    azure_openai_embeddings = AzureOpenAIEmbeddings(
-        api_key=os.environ['OPENAI_API_KEY'],
-        azure_endpoint=os.environ['OPENAI_AZURE_ENDPOINT'],
-        api_version=os.environ['OPENAI_API_VERSION'],
-        azure_deployment=os.environ['OPENAI_AZURE_DEPLOYMENT_EMBEDDINGS']
-    )
+    azure_openai_embeddings = get_azure_openai_embeddings()
 
     # Create the vector store
     index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
@@ -187,6 +913,15 @@ def index_visio(visio_url: str):
 
     return input
 
-while (True):
-    asyncio.run(main())
-    asyncio.sleep(5)
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+# The render worker processes re-import this module, only poll the queue
+# from the main process.
+if __name__ == "__main__":
+    asyncio.run(run())
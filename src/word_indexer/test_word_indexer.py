@@ -0,0 +1,105 @@
+"""Tests of the heading-aware sections of the Word documents"""
+import os
+import zipfile
+
+# The clients are created when the module is imported, they do not connect
+# until they are used.
+os.environ.setdefault(
+    "STORAGE_CONNECTION_STRING",
+    "DefaultEndpointsProtocol=https;AccountName=test;"
+    "AccountKey=dGVzdA==;EndpointSuffix=core.windows.net")
+
+from word_indexer import iter_sections  # noqa: E402
+
+W_NAMESPACE_URI = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+
+def paragraph(text, style=None, outline_level=None):
+    properties = ""
+    if style is not None:
+        properties += f'<w:pStyle w:val="{style}"/>'
+    if outline_level is not None:
+        properties += f'<w:outlineLvl w:val="{outline_level}"/>'
+    if properties:
+        properties = f"<w:pPr>{properties}</w:pPr>"
+    return f"<w:p>{properties}<w:r><w:t>{text}</w:t></w:r></w:p>"
+
+
+def make_docx(path, paragraphs):
+    document = (f'<w:document xmlns:w="{W_NAMESPACE_URI}"><w:body>'
+                f'{"".join(paragraphs)}</w:body></w:document>')
+    with zipfile.ZipFile(path, "w") as docx:
+        docx.writestr("word/document.xml", document)
+    return str(path)
+
+
+def test_sections_follow_the_headings(tmp_path):
+    file_path = make_docx(tmp_path / "document.docx", [
+        paragraph("Report", style="Title"),
+        paragraph("Introduction text."),
+        paragraph("Context", style="Heading1"),
+        paragraph("Context text."),
+        paragraph("Details", style="Heading2"),
+        paragraph("Details text."),
+        paragraph("Results", outline_level=0),
+        paragraph("Results text.")
+    ])
+
+    sections = list(iter_sections(file_path, 1000))
+
+    assert sections == [
+        {"headings": ["Report"], "content": "Report\n\nIntroduction text."},
+        {"headings": ["Report", "Context"],
+         "content": "Context\n\nContext text."},
+        {"headings": ["Report", "Context", "Details"],
+         "content": "Details\n\nDetails text."},
+        {"headings": ["Report", "Results"],
+         "content": "Results\n\nResults text."}]
+
+
+def test_long_sections_are_split(tmp_path):
+    file_path = make_docx(tmp_path / "document.docx", [
+        paragraph("Chapter", style="Heading1"),
+        paragraph("a" * 40),
+        paragraph("b" * 40),
+        paragraph("c" * 40)
+    ])
+
+    sections = list(iter_sections(file_path, 60))
+
+    assert [section["content"] for section in sections] == [
+        f"Chapter\n\n{'a' * 40}\n\n{'b' * 40}", f"Chapter\n\n{'c' * 40}"]
+    assert all(section["headings"] == ["Chapter"] for section in sections)
+
+
+def test_empty_headings_and_paragraphs_are_skipped(tmp_path):
+    file_path = make_docx(tmp_path / "document.docx", [
+        paragraph("", style="Heading1"),
+        paragraph("Text before any heading."),
+        paragraph(""),
+        paragraph("Empty chapter", style="Heading1"),
+        paragraph("Next chapter", style="Heading1"),
+        paragraph("Text.")
+    ])
+
+    sections = list(iter_sections(file_path, 1000))
+
+    assert sections == [
+        {"headings": [], "content": "Text before any heading."},
+        {"headings": ["Next chapter"], "content": "Next chapter\n\nText."}]
+
+
+def test_body_text_outline_level_is_not_a_heading(tmp_path):
+    file_path = make_docx(tmp_path / "document.docx", [
+        paragraph("Chapter", outline_level=0),
+        paragraph("Body text.", outline_level=9),
+        paragraph("Section", outline_level=8),
+        paragraph("Section text.")
+    ])
+
+    sections = list(iter_sections(file_path, 1000))
+
+    assert sections == [
+        {"headings": ["Chapter"], "content": "Chapter\n\nBody text."},
+        {"headings": ["Chapter", "Section"],
+         "content": "Section\n\nSection text."}]
@@ -0,0 +1,505 @@
+import os
+import httpx
+import importlib.util
+import re
+import json
+import uuid
+import zipfile
+import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from azure.servicebus.aio import ServiceBusClient
+from azure.storage.blob import BlobServiceClient
+from azure.cosmos import CosmosClient, ContainerProxy
+from azure.core.pipeline.transport import RequestsTransport
+from openai import AzureOpenAI
+from langchain_core.documents.base import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain_community.vectorstores.azuresearch import AzureSearch
+
+load_dotenv(override=True)
+
+servicebus_connection_string = os.getenv("SERVICEBUS_CONNECTION_STRING")
+cosmosdb_connection_string = os.getenv("COSMOSDB_CONNECTION_STRING")
+status_endpoint = os.getenv("STATUS_ENDPOINT")
+blob_service_client = BlobServiceClient.from_connection_string(
+    os.getenv("STORAGE_CONNECTION_STRING"))
+container_name = "uploads"
+
+# Maximum number of connections of the Cosmos DB client, created on first
+# use and shared by all the messages of the process.
+cosmosdb_max_connections = int(os.getenv("COSMOSDB_MAX_CONNECTIONS", "10"))
+cosmos_clients = {}
+
+# Maximum number of retries of the writes throttled by Cosmos DB (429), after
+# the delay it asks for.
+cosmosdb_write_retries = int(os.getenv("COSMOSDB_WRITE_RETRIES", "9"))
+
+# Number of sections chunked and embedded together and maximum size of a
+# section before it is emitted, even if no new heading was found.
+word_section_batch_size = int(os.getenv("WORD_SECTION_BATCH_SIZE", "20"))
+word_max_section_chars = int(os.getenv("WORD_MAX_SECTION_CHARS", "8000"))
+
+# Summary of each input, used to build the digests of the subjects: inputs
+# longer than the maximum number of words are summarized by parts of the
+# given number of characters, the parts being summarized concurrently.
+input_summary_max_words = int(os.getenv("INPUT_SUMMARY_MAX_WORDS", "150"))
+input_summary_chunk_chars = int(
+    os.getenv("INPUT_SUMMARY_CHUNK_CHARS", "12000"))
+input_summary_workers = int(os.getenv("INPUT_SUMMARY_WORKERS", "4"))
+
+# Connection pool shared by all the Azure OpenAI clients of the process:
+# connections are kept alive between calls and HTTP/2 is used when the h2
+# package is installed.
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+openai_http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+openai_clients = {}
+
+W_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+CORE_NAMESPACES = {
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'dcterms': 'http://purl.org/dc/terms/',
+}
+HEADING_STYLE_PATTERN = re.compile(r'^heading\s?(\d)$', re.IGNORECASE)
+
+
+class Input:
+    id: str
+    title: str
+    date: str
+    last_updated: str
+    author: str
+    description: str
+    source: str
+    type: str
+    thumbnail_url: str
+    topics: list
+    entities: list
+    content: str
+    summary: str
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "date": self.date,
+            "last_updated": self.last_updated,
+            "author": self.author,
+            "description": self.description,
+            "source": self.source,
+            "type": self.type,
+            "thumbnail_url": self.thumbnail_url,
+            "topics": self.topics,
+            "entities": self.entities,
+            "content": self.content,
+            "summary": self.summary
+        }
+
+
+async def main():
+    async with ServiceBusClient.from_connection_string(
+            conn_str=servicebus_connection_string) as servicebus_client:
+        async with servicebus_client:
+            receiver = servicebus_client.get_queue_receiver('word')
+            async with receiver:
+                received_messages = await receiver.receive_messages(
+                    max_message_count=1, max_wait_time=5)
+                for message in received_messages:
+                    print(str(message))
+                    word_input = json.loads(str(message))
+                    file_location = word_input['file_name']
+                    update_status(word_input['request_id'], "Indexing")
+                    await receiver.complete_message(message)
+                    input = index_word(file_location)
+                    update_status(word_input['request_id'], "Indexed")
+                    await save_to_cosmosdb(input)
+                    update_status(word_input['request_id'], "Saved")
+
+
+def get_cosmos_container(container_name: str) -> ContainerProxy:
+    """Get a container of the database, its handle is cached and the Cosmos
+    DB client is created on first use with a pool of connections"""
+    if container_name not in cosmos_clients:
+        if "client" not in cosmos_clients:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                pool_maxsize=cosmosdb_max_connections))
+            cosmos_clients["client"] = CosmosClient.from_connection_string(
+                cosmosdb_connection_string,
+                transport=RequestsTransport(
+                    session=session, session_owner=False),
+                retry_total=cosmosdb_write_retries)
+        database = cosmos_clients["client"].get_database_client(
+            "autopodcaster")
+        cosmos_clients[container_name] = database.get_container_client(
+            container_name)
+    return cosmos_clients[container_name]
+
+
+async def save_to_cosmosdb(input: Input):
+    # The input is written from a thread on the pooled client, so that the
+    # loop is not blocked while it is written.
+    container = get_cosmos_container("inputs")
+    await asyncio.to_thread(container.upsert_item, body=input.to_dict())
+
+
+def get_http_client_options():
+    """Get the options of the HTTP clients used by the Azure OpenAI clients
+
+    Returns:
+        Dictionary with the pool limits, the timeout and the HTTP/2 flag
+    """
+    return {
+        "limits": httpx.Limits(
+            max_connections=openai_max_connections,
+            max_keepalive_connections=openai_max_keepalive_connections,
+            keepalive_expiry=openai_keepalive_expiry),
+        "timeout": httpx.Timeout(600.0, connect=5.0),
+        "http2": openai_http2 and importlib.util.find_spec("h2") is not None
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """Get the HTTP client of the process, created on first use"""
+    if "http" not in openai_clients:
+        openai_clients["http"] = httpx.Client(**get_http_client_options())
+    return openai_clients["http"]
+
+
+def get_azure_openai_client() -> AzureOpenAI:
+    """Get the Azure OpenAI client of the process, created on first use"""
+    if "azure_openai" not in openai_clients:
+        openai_clients["azure_openai"] = AzureOpenAI(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            http_client=get_http_client()
+        )
+    return openai_clients["azure_openai"]
+
+
+def get_azure_openai_embeddings() -> AzureOpenAIEmbeddings:
+    """Get the embeddings model of the process, created on first use"""
+    if "embeddings" not in openai_clients:
+        openai_clients["embeddings"] = AzureOpenAIEmbeddings(
+            api_key=os.environ['AZURE_OPENAI_KEY'],
+            azure_endpoint=os.environ['AZURE_OPENAI_ENDPOINT'],
+            api_version=os.environ['AZURE_OPENAI_API_VERSION'],
+            azure_deployment=os.environ['AZURE_OPENAI_DEPLOYMENT_EMBEDDINGS'],
+            http_client=get_http_client()
+        )
+    return openai_clients["embeddings"]
+
+
+def summarize_text(title: str, text: str) -> str:
+    """Summarize a part of an input
+
+    Args:
+        title (str): Title of the input
+        text (str): Part of the content of the input
+
+    Returns:
+        Summary of the part
+    """
+    azure_openai_client = get_azure_openai_client()
+    return azure_openai_client.chat.completions.create(
+        model="gpt-4o",
+        temperature=0,
+        top_p=1,
+        messages=[
+            {"role": "system", "content": "You summarize documents."},
+            {"role": "user", "content": (
+                f"Summarize the following part of the document \"{title}\" "
+                f"in at most {input_summary_max_words} words. Keep the key "
+                "topics, facts, names and conclusions. Return only the "
+                f"summary.\n\n{text}")},
+        ]).choices[0].message.content.strip()
+
+
+def summarize_input(title: str, content: str) -> str:
+    """Summarize an input hierarchically
+
+    Short inputs are kept as they are. Longer inputs are split in parts
+    that are summarized concurrently, then the summaries are split and
+    summarized again until a single summary is left, so the size of the
+    summary does not depend on the size of the input.
+
+    Args:
+        title (str): Title of the input
+        content (str): Content of the input
+
+    Returns:
+        Summary of the input
+    """
+    if len(content.split()) <= input_summary_max_words:
+        return content
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=input_summary_chunk_chars,
+        chunk_overlap=0
+    )
+    parts = text_splitter.split_text(content)
+    with ThreadPoolExecutor(max_workers=input_summary_workers) as executor:
+        while len(parts) > 1:
+            summaries = executor.map(
+                lambda part: summarize_text(title, part), parts)
+            parts = text_splitter.split_text('\n\n'.join(summaries))
+    return summarize_text(title, parts[0])
+
+
+def update_status(request_id: str, status: str):
+    status = {"status": status}
+    requests.post(
+        f"{status_endpoint}/status/{request_id}", json=status)
+
+
+def index_word(file_location: str):
+    blob_client = blob_service_client.get_blob_client(
+        container=container_name, blob=file_location)
+    download_file_path = get_file(file_location)
+    with open(download_file_path, "wb") as download_file:
+        blob_client.download_blob().readinto(download_file)
+
+    properties = read_core_properties(download_file_path)
+    title = properties.get('title') or 'Unknown Title'
+    description = properties.get('description', '')
+    url = file_location
+
+    input = Input()
+    input.id = str(uuid.uuid4())
+    input.title = title
+    input.date = properties.get('created', '')
+    input.last_updated = properties.get('modified', '')
+    input.author = properties.get('creator', '')
+    input.description = description
+    input.source = url
+    input.type = 'word'
+    input.thumbnail_url = ''
+    input.topics = []
+    input.entities = []
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200
+    )
+
+    azure_openai_embeddings = get_azure_openai_embeddings()
+
+    index_name = os.getenv("AZURE_SEARCH_INDEX_NAME")
+    if index_name is None or index_name == "":
+        index_name = "knowledgebase"
+
+    vector_store = AzureSearch(
+        azure_search_endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
+        azure_search_key=os.getenv("AZURE_SEARCH_ADMIN_KEY"),
+        index_name=index_name,
+        embedding_function=azure_openai_embeddings.embed_query,
+    )
+
+    # The sections are parsed while the document is read and chunked and
+    # embedded in batches, so only one batch is kept as documents at a time.
+    section_contents = []
+    documents = []
+    for section in iter_sections(download_file_path, word_max_section_chars):
+        document = Document(
+            page_content=section['content'],
+            metadata={
+                "id": input.id,
+                "title": title,
+                "source": url,
+                "description": description,
+                "thumbnail_url": '',
+                "section": ' > '.join(section['headings']),
+                "type": 'word'
+            }
+        )
+        documents.append(document)
+        section_contents.append(section['content'])
+        if len(documents) >= word_section_batch_size:
+            vector_store.add_documents(
+                documents=text_splitter.split_documents(documents))
+            documents = []
+
+    if len(documents) > 0:
+        vector_store.add_documents(
+            documents=text_splitter.split_documents(documents))
+
+    input.content = '\n\n'.join(section_contents)
+    input.summary = summarize_input(input.title, input.content)
+
+    os.remove(download_file_path)
+
+    return input
+
+
+def read_core_properties(file_path: str):
+    """Read the core properties (title, author, dates...) of a Word document
+
+    Args:
+        file_path (str): Path of the .docx file
+
+    Returns:
+        Dictionary with the core properties found in docProps/core.xml
+    """
+    properties = {}
+    with zipfile.ZipFile(file_path) as docx:
+        if 'docProps/core.xml' not in docx.namelist():
+            return properties
+        root = ET.fromstring(docx.read('docProps/core.xml'))
+    for prefix, name in [('dc', 'title'), ('dc', 'description'),
+                         ('dc', 'creator'), ('dcterms', 'created'),
+                         ('dcterms', 'modified')]:
+        element = root.find(f'{prefix}:{name}', CORE_NAMESPACES)
+        if element is not None and element.text:
+            properties[name] = element.text.strip()
+    return properties
+
+
+def get_heading_level(paragraph):
+    """Get the heading level of a paragraph
+
+    Args:
+        paragraph: w:p element
+
+    Returns:
+        Heading level (0 for the title) or None if it is not a heading
+    """
+    properties = paragraph.find(f'{W_NAMESPACE}pPr')
+    if properties is None:
+        return None
+    style = properties.find(f'{W_NAMESPACE}pStyle')
+    if style is not None:
+        style_id = style.get(f'{W_NAMESPACE}val', '')
+        if style_id.lower() == 'title':
+            return 0
+        match = HEADING_STYLE_PATTERN.match(style_id)
+        if match:
+            return int(match.group(1))
+    outline_level = properties.find(f'{W_NAMESPACE}outlineLvl')
+    if outline_level is not None:
+        # Outline levels 0 to 8 are the heading levels 1 to 9, level 9 is
+        # body text.
+        level = int(outline_level.get(f'{W_NAMESPACE}val', '0'))
+        if level < 9:
+            return level + 1
+    return None
+
+
+def get_paragraph_text(paragraph):
+    """Get the text of a paragraph
+
+    Args:
+        paragraph: w:p element
+
+    Returns:
+        Text of the paragraph
+    """
+    text = []
+    for element in paragraph.iter():
+        if element.tag == f'{W_NAMESPACE}t' and element.text:
+            text.append(element.text)
+        elif element.tag == f'{W_NAMESPACE}tab':
+            text.append('\t')
+        elif element.tag in (f'{W_NAMESPACE}br', f'{W_NAMESPACE}cr'):
+            text.append('\n')
+    return ''.join(text).strip()
+
+
+def iter_sections(file_path: str, max_section_chars: int):
+    """Parse word/document.xml incrementally and yield heading-aware sections
+
+    The XML is read with iterparse and each block of the body is cleared
+    once parsed, so the memory used does not depend on the document size.
+
+    Args:
+        file_path (str): Path of the .docx file
+        max_section_chars (int): Size after which a section is emitted
+
+    Yields:
+        Dictionary with the headings leading to the section and its content
+    """
+    headings = []
+    paragraphs = []
+    size = 0
+
+    def section():
+        heading_lines = [heading for _, heading in headings]
+        content = '\n\n'.join(heading_lines[-1:] + paragraphs)
+        return {'headings': heading_lines, 'content': content}
+
+    with zipfile.ZipFile(file_path) as docx:
+        with docx.open('word/document.xml') as document_xml:
+            body = None
+            depth = 0
+            for event, element in ET.iterparse(
+                    document_xml, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if element.tag == f'{W_NAMESPACE}body':
+                        body = element
+                    continue
+                depth -= 1
+
+                if element.tag == f'{W_NAMESPACE}p':
+                    text = get_paragraph_text(element)
+                    level = get_heading_level(element)
+                    if text and level is not None:
+                        if paragraphs:
+                            yield section()
+                        paragraphs = []
+                        size = 0
+                        headings = [(heading_level, heading)
+                                    for heading_level, heading in headings
+                                    if heading_level < level]
+                        headings.append((level, text))
+                    elif text:
+                        paragraphs.append(text)
+                        size += len(text)
+                        if size >= max_section_chars:
+                            yield section()
+                            paragraphs = []
+                            size = 0
+                    element.clear()
+
+                # Drop the blocks of the body (paragraphs, tables...) once
+                # they have been parsed.
+                if body is not None and depth == 2:
+                    body.clear()
+
+    if paragraphs:
+        yield section()
+
+
+def get_file(file_name: str):
+    """Get file path
+
+    Args:
+        file_name (str): File name
+
+    Returns:
+        File path
+    """
+    output_folder = 'outputs'
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    return os.path.join(output_folder, file_name)
+
+
+async def run():
+    # A single event loop is used for the whole process, so that the
+    # connections of the async clients are reused from one message to the
+    # next.
+    while (True):
+        await main()
+        await asyncio.sleep(5)
+
+
+# The tests import this module, only poll the queue when it is run.
+if __name__ == "__main__":
+    asyncio.run(run())